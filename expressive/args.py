@@ -53,6 +53,22 @@ class AbsArguments(Arguments):
     # Only turn this on for small problems
     entropy_variant: str = "unconditional" # [unconditional, exact_conditional, boia]
 
+    # DataLoader workers. If None, uses the default of the experiment
+    num_workers: Optional[int] = None
+    persistent_workers: bool = False
+    # Number of batches prepared ahead in a background thread. 0 disables prefetching
+    prefetch_lookahead: int = 2
+    # Memory budget (in GB) for evaluation. If set, evaluation data is re-batched into the largest chunks
+    #  that fit, based on the memory used for the first batch (CUDA only)
+    eval_memory_budget: Optional[float] = None
+    # Fixed number of examples per evaluation chunk. Overrides eval_memory_budget
+    eval_chunk_size: Optional[int] = None
+
+    # Number of most recent checkpoints to keep (at least 1). If None, keeps all
+    keep_checkpoints: Optional[int] = None
+    # When resuming, also restore the RNG states to continue exactly as if training was never interrupted
+    exact_resume: bool = False
+
 
 class MNISTArguments(Tap):
     N: int = 4
@@ -63,6 +79,8 @@ class MNISTArguments(Tap):
     layers: int = 1
     embedding_size: int = 64
     config_file: str = None
+    # Keep MNIST in memory as a single tensor and load whole batches at once
+    in_memory_data: bool = True
 
    
 
@@ -77,6 +95,13 @@ class PathPlanningArguments(AbsArguments):
     val_every_epochs: int = 5
     model: str = "CombResnet18"
     use_ray: bool = True
+    # Solver for the shortest paths in y_from_w. "batched" solves all samples at once on the device,
+    #  "dijkstra" solves them one by one on CPU (with ray if use_ray), "astar" likewise with goal-directed search,
+    #  "pool" solves them in chunks on a persistent process pool with shared_memory buffers,
+    #  "incremental" repairs the paths of the previous sampling step where few cells changed. All give the same paths.
+    shortest_path_solver: str = "batched"
+    # Number of processes of the pool solver. None uses all CPUs
+    shortest_path_workers: Optional[int] = None
     loss_S: int = 16
     variational_K: int = 4
     test_K: int = 4
@@ -85,6 +110,9 @@ class PathPlanningArguments(AbsArguments):
     save_model: bool = True
     model_dir: str = "models/path_planning"
     wandb_resume_id: Optional[str] = None
+    # Memory-map the maps and normalise them per batch, with statistics of the train split for all splits.
+    #  If False, each split is loaded in memory and normalised with its own statistics.
+    mmap_data: bool = False
 
     # Tuned hyperparameters 
     beta: float = 12.0
@@ -100,7 +128,14 @@ class PathPlanningArguments(AbsArguments):
     y_embed: bool = False
     costs: List[float] = [0.8, 1.2, 5.3, 7.7, 9.2]
 
-class PathPlanningEvalArguments(PathPlanningArguments):
+class EvalHarnessArguments(Tap):
+    # Number of checkpoints evaluated in parallel, in forked processes sharing the datasets. 0 evaluates them in order
+    eval_workers: int = 0
+    # Skip checkpoints that already have results in the output of an earlier, interrupted evaluation
+    resume_eval: bool = False
+
+
+class PathPlanningEvalArguments(PathPlanningArguments, EvalHarnessArguments):
     eval_at_epoch: List[int] 
     run_ids: List[str] 
     test: bool = True
@@ -125,6 +160,10 @@ class RSBenchArguments(AbsArguments):
     model: str = "nesydiffusion"
     task: str = "addition"
     boia_ood_knowledge: bool = False
+    # Read BOIA from the contiguous arrays created by pack_boia.py, instead of one file per sample
+    boia_packed: bool = False
+    # Materialise the filtered MNIST splits and OOD sets once under data/split_cache and memory-map them afterwards
+    split_cache: bool = True
     save_model: bool = True
     run_id: str = ""
     epochs: int = 500
@@ -146,7 +185,7 @@ class RSBenchArguments(AbsArguments):
     # Majority voting samples much higher in RSbench to get accurate ECE estimates and because of small size
     test_L: int = 1000
 
-class RSBenchEvalArguments(RSBenchArguments):
+class RSBenchEvalArguments(RSBenchArguments, EvalHarnessArguments):
     run_ids: List[str]
     test: bool = True
     model_dir: str = "models"
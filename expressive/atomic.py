@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator
+
+
+def _remove(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+@contextmanager
+def atomic_write(path: str, directory: bool = False) -> Iterator[str]:
+    """
+    Yields a temporary path next to path, unique to this writer and with the same extension, to write a file
+     (or a directory, if directory) to. Once written, it is moved to path, so readers never see a partial file and
+     concurrent writers never write into each other's files. If writing fails, it is removed.
+    A directory is not moved over an existing one: the directory of the writer that finished first is kept.
+    """
+    parent = os.path.dirname(path) or "."
+    prefix = os.path.basename(path) + "."
+    if directory:
+        tmp_path = tempfile.mkdtemp(dir=parent, prefix=prefix, suffix=".tmp")
+    else:
+        fd, tmp_path = tempfile.mkstemp(dir=parent, prefix=prefix, suffix=".tmp" + os.path.splitext(path)[1])
+        os.close(fd)
+    # mkstemp and mkdtemp give access only to their owner, the written files get the usual permissions
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_path, (0o777 if directory else 0o666) & ~umask)
+    try:
+        yield tmp_path
+    except BaseException:
+        _remove(tmp_path)
+        raise
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        _remove(tmp_path)
+        if not (directory and os.path.isdir(path)):
+            raise
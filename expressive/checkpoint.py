@@ -0,0 +1,171 @@
+import glob
+import os
+import random
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import torch
+from torch import nn
+
+from expressive.atomic import atomic_write
+from expressive.methods import logger
+
+
+def _to_cpu(obj: Any) -> Any:
+    # Copies all tensors, since training continues to update them in-place while writing
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state() -> Dict[str, Any]:
+    state = {
+        "torch": torch.get_rng_state(),
+        "numpy": np.random.get_state(),
+        "python": random.getstate(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: Dict[str, Any]):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def model_path(directory: str, epoch: int) -> str:
+    return f"{directory}/model_{epoch}.pth"
+
+
+def state_path(directory: str, epoch: int) -> str:
+    return f"{directory}/state_{epoch}.pth"
+
+
+def saved_epochs(directory: str, prefix: str = "model") -> List[int]:
+    files = glob.glob(f"{directory}/{prefix}_*.pth")
+    epochs = []
+    for f in files:
+        match = re.fullmatch(rf"{prefix}_(\d+)\.pth", os.path.basename(f))
+        if match:
+            epochs.append(int(match.group(1)))
+    return sorted(epochs)
+
+
+class CheckpointManager:
+    """
+    Saves checkpoints without blocking training.
+    The state is copied to CPU on the calling thread, and written to disk in a background thread.
+
+    Every checkpoint consists of two files, so that model files stay loadable with model.load_state_dict(torch.load(...)):
+    - model_{epoch}.pth: The model weights
+    - state_{epoch}.pth: The optimizer state, epoch, global logging step and RNG states. Written after the weights,
+        so its presence means the checkpoint is complete.
+    Files are written to a temporary file first and then renamed, so a checkpoint is never partially written.
+    If keep_last is set (at least 1), only the keep_last most recent checkpoints are kept.
+    on_saved is called (from the writer thread) with the path of the model file after it is written, eg wandb.save
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        keep_last: Optional[int] = None,
+        on_saved: Optional[Callable[[str], Any]] = None,
+    ):
+        if keep_last is not None and keep_last < 1:
+            raise ValueError(f"keep_last must be at least 1, or None to keep all checkpoints, got {keep_last}")
+        self.directory = directory
+        self.keep_last = keep_last
+        self.on_saved = on_saved
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending: List[Future] = []
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, epoch: int, model: nn.Module, optim: Optional[torch.optim.Optimizer] = None):
+        self._check_pending()
+        model_state = _to_cpu(model.state_dict())
+        state = {
+            "epoch": epoch,
+            "global_step": logger.GLOBAL_ITERATIONS,
+            "optimizer": _to_cpu(optim.state_dict()) if optim is not None else None,
+            "rng": get_rng_state(),
+        }
+        self.pending.append(self.executor.submit(self._write, epoch, model_state, state))
+
+    def _write(self, epoch: int, model_state: dict, state: dict):
+        path = model_path(self.directory, epoch)
+        _atomic_save(model_state, path)
+        _atomic_save(state, state_path(self.directory, epoch))
+        if self.keep_last is not None:
+            for old_epoch in saved_epochs(self.directory)[: -self.keep_last]:
+                for old_path in [state_path(self.directory, old_epoch), model_path(self.directory, old_epoch)]:
+                    if os.path.exists(old_path):
+                        os.remove(old_path)
+        if self.on_saved is not None:
+            self.on_saved(path)
+
+    def _check_pending(self):
+        # Raise errors of finished writes on the training thread
+        for future in [f for f in self.pending if f.done()]:
+            self.pending.remove(future)
+            future.result()
+
+    def wait(self):
+        """Blocks until all checkpoints are written."""
+        for future in self.pending:
+            future.result()
+        self.pending = []
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+def _atomic_save(obj: Any, path: str):
+    with atomic_write(path) as tmp_path:
+        torch.save(obj, tmp_path)
+
+
+def resume(
+    directory: str,
+    model: nn.Module,
+    optim: Optional[torch.optim.Optimizer] = None,
+    exact: bool = False,
+    map_location: Optional[torch.device] = None,
+) -> int:
+    """
+    Loads the latest checkpoint in directory into the model and optimizer, and restores the global logging step.
+    If exact, also restores the RNG states, so that training continues as if it was never interrupted.
+    Falls back to loading only the weights for checkpoints saved without state.
+    Returns the epoch of the loaded checkpoint.
+    """
+    complete_epochs = [e for e in saved_epochs(directory, "state") if os.path.exists(model_path(directory, e))]
+    if not complete_epochs:
+        model_epochs = saved_epochs(directory)
+        if not model_epochs:
+            raise ValueError(f"No model files found in {directory}")
+        epoch = model_epochs[-1]
+        model.load_state_dict(torch.load(model_path(directory, epoch), map_location=map_location))
+        print(f"Loaded model from {model_path(directory, epoch)} (no optimizer or RNG state found)")
+        return epoch
+
+    epoch = complete_epochs[-1]
+    model.load_state_dict(torch.load(model_path(directory, epoch), map_location=map_location))
+    # The state file contains RNG states, which are not plain tensors
+    state = torch.load(state_path(directory, epoch), map_location="cpu", weights_only=False)
+    if optim is not None and state["optimizer"] is not None:
+        optim.load_state_dict(state["optimizer"])
+    logger.GLOBAL_ITERATIONS = state["global_step"]
+    if exact:
+        set_rng_state(state["rng"])
+    print(f"Resumed from {model_path(directory, epoch)} at epoch {epoch}, step {state['global_step']}")
+    return state["epoch"]
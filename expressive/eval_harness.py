@@ -0,0 +1,99 @@
+import json
+import multiprocessing
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional
+
+import pandas as pd
+
+from expressive.atomic import atomic_write
+
+# Evaluation function, set in the parent process before the workers are forked, so they inherit it
+#  together with everything it refers to (datasets, memory maps, arguments) without pickling
+_EVALUATE: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None
+
+
+class ResultWriter:
+    """
+    Writes every result as soon as it is available: appended as a line to a JSON lines file,
+     and the CSV with all results so far is rewritten (so it stays valid if the evaluation is interrupted).
+    If resume, results already in the JSON lines file are kept.
+    """
+
+    def __init__(self, csv_path: str, resume: bool = False):
+        self.csv_path = csv_path
+        self.jsonl_path = os.path.splitext(csv_path)[0] + ".jsonl"
+        os.makedirs(os.path.dirname(csv_path) or ".", exist_ok=True)
+        self.rows: List[Dict[str, Any]] = []
+        if resume and os.path.exists(self.jsonl_path):
+            with open(self.jsonl_path) as f:
+                self.rows = [json.loads(line) for line in f if line.strip()]
+        elif os.path.exists(self.jsonl_path):
+            os.remove(self.jsonl_path)
+
+    def write(self, result: Dict[str, Any]):
+        self.rows.append(result)
+        with open(self.jsonl_path, "a") as f:
+            f.write(json.dumps(result) + "\n")
+        with atomic_write(self.csv_path) as tmp_path:
+            pd.DataFrame(self.rows).to_csv(tmp_path, index=False)
+
+
+def _job_key(job: Dict[str, Any]) -> str:
+    return json.dumps(job, sort_keys=True)
+
+
+def _run(job: Dict[str, Any]) -> Dict[str, Any]:
+    return _EVALUATE(job)
+
+
+def evaluate_checkpoints(
+    jobs: List[Dict[str, Any]],
+    evaluate: Callable[[Dict[str, Any]], Dict[str, Any]],
+    writer: ResultWriter,
+    num_workers: int = 0,
+) -> List[Dict[str, Any]]:
+    """
+    Evaluates every job (eg. {"run_id": ..., "epoch": ...}) with evaluate, which returns a dict of metrics.
+    The job is added to its result, and the result is written by writer as soon as it finishes.
+    Jobs with a result already in writer (when resuming) are skipped.
+
+    With num_workers > 0, jobs run in parallel in forked worker processes. They share the datasets
+     loaded by the parent, so evaluate should create or load everything per job that is not shared (eg. the model),
+     and the parent should not initialise CUDA before.
+    A failing job is reported and skipped, and does not stop the other jobs.
+    Returns the results of all jobs in writer, including earlier ones.
+    """
+    global _EVALUATE
+    keys = list(jobs[0].keys()) if jobs else []
+    done = {_job_key({k: row.get(k) for k in keys}) for row in writer.rows}
+    todo = [job for job in jobs if _job_key(job) not in done]
+    if len(todo) < len(jobs):
+        print(f"Skipping {len(jobs) - len(todo)} jobs with existing results")
+
+    def finish(job: Dict[str, Any], result: Dict[str, Any]):
+        result = {**result, **job}
+        print(result)
+        writer.write(result)
+
+    if num_workers <= 0:
+        for job in todo:
+            try:
+                finish(job, evaluate(job))
+            except Exception:
+                print(f"Evaluation of {job} failed:\n{traceback.format_exc()}")
+        return writer.rows
+
+    _EVALUATE = evaluate
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=context) as executor:
+        futures = {executor.submit(_run, job): job for job in todo}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                finish(job, future.result())
+            except Exception:
+                print(f"Evaluation of {job} failed:\n{traceback.format_exc()}")
+    _EVALUATE = None
+    return writer.rows
@@ -5,6 +5,7 @@ from torch import Tensor
 from torch.nn import Linear
 
 from expressive.args import MNISTAbsorbingArguments
+from expressive.experiments.mnist_op.digits import add_base10, vector_to_base10
 from expressive.experiments.mnist_op.models import MNISTEncoder
 from expressive.methods.base_model import BaseNeSyDiffusion, Problem
 from expressive.methods.cond_model import CondNeSyDiffusion
@@ -13,24 +14,6 @@ from expressive.models.diffusion_model import WY_DATA, UnmaskingModel
 from expressive.models.dit import hidden_size
 
 
-def vector_to_base10(w: torch.Tensor, N: int) -> torch.Tensor:
-    device = w.device
-    w = w.to(torch.int64)  # Convert to int64 for higher precision
-
-    w_D = torch.zeros((*w.shape, N), dtype=torch.int64, device="cpu")
-    if device.type == "mps":
-        w = w.cpu()
-    else:
-        w = w
-
-    for i in range(N):
-        w_D[..., i] = (w // (10 ** (N - 1 - i))) % 10
-
-    w_D = w_D.to(device)
-    assert torch.all(torch.logical_and(0 <= w_D, w_D < 10))
-    return w_D
-
-
 class MNISTAbsorbModel(UnmaskingModel):
     def __init__(self, args: MNISTAbsorbingArguments) -> None:
         super().__init__(
@@ -64,20 +47,8 @@ class MNISTAddProblem(Problem):
 
     def y_from_w(self, w_SKB2xN: torch.Tensor) -> torch.Tensor:
         assert (w_SKB2xN < 10).all()  # Have to make sure no masked values are present
-        stack1_SKBN = torch.stack(
-            [10 ** (self.N - i - 1) * w_SKB2xN[..., i] for i in range(self.N)], -1
-        )
-        stack2_SKBN = torch.stack(
-            [10 ** (self.N - i - 1) * w_SKB2xN[..., self.N + i] for i in range(self.N)],
-            -1,
-        )
-
-        n1_SKB = stack1_SKBN.sum(-1)
-        n2_SKB = stack2_SKBN.sum(-1)
-        ty_SKB = n1_SKB + n2_SKB
-        ty_SKBY = vector_to_base10(ty_SKB, self.N + 1)
-
-        return ty_SKBY
+        # Add the two numbers digit-wise, so this stays exact for any N
+        return add_base10(w_SKB2xN[..., : self.N], w_SKB2xN[..., self.N :])
 
 def create_mnistadd(args: MNISTAbsorbingArguments) -> BaseNeSyDiffusion:
     model = MNISTAbsorbModel(args)
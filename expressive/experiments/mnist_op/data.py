@@ -1,11 +1,14 @@
-from typing import Callable, List, Tuple
+from typing import Callable, List, Optional, Sequence, Tuple, Union
 
 import pdb
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset
+from torch import Tensor
+from torch.utils.data import BatchSampler, DataLoader, Dataset, RandomSampler, SequentialSampler
 from torchvision import datasets, transforms
 
+from expressive.prefetch import loader_worker_kwargs
+
 
 def create_nary_multidigit_operation(
     arity: int, op: Callable[[list[int]], int]
@@ -23,6 +26,24 @@ def create_nary_multidigit_operation(
     return generic_operation
 
 
+def create_vectorised_nary_multidigit_operation(
+    arity: int, op: Callable[[Tensor], Tensor]
+) -> Callable[[Tensor], Tensor]:
+    """
+    Vectorised version of create_nary_multidigit_operation.
+    op reduces the last dimension of a tensor of numbers, eg lambda n_BA: n_BA.sum(-1)
+    """
+    def generic_operation(operands_BO: Tensor) -> Tensor:
+        numbers = []
+        for group_BD in torch.tensor_split(operands_BO, arity, dim=-1):
+            D = group_BD.shape[-1]
+            powers_D = 10 ** torch.arange(D - 1, -1, -1, dtype=torch.int64, device=operands_BO.device)
+            numbers.append((group_BD.to(torch.int64) * powers_D).sum(-1))
+        return op(torch.stack(numbers, dim=-1))
+
+    return generic_operation
+
+
 def get_mnist_dataloaders(
     count_train: int,
     count_test: int,
@@ -184,6 +205,95 @@ class MNISTOperationDataset(Dataset):
         print("The shuffle function is called but should not be used??")
 
 
+class BatchedMNISTOperationDataset(Dataset):
+    """
+    In-memory variant of MNISTOperationDataset that returns whole batches at once.
+
+    The normalised images are stored as one contiguous tensor, and the operand indices and labels are
+    precomputed for all samples. Indexing with a list of indices (as done by a BatchSampler) returns
+    the batch in the same format as a DataLoader over MNISTOperationDataset.
+
+    Args:
+        images: Normalised images, shape (N, 1, 28, 28).
+        targets: Digit labels, shape (N,).
+        count: Number of samples to include in the dataset.
+        n_operands: Number of operands for the operation (default is 2).
+        op: Vectorised operation to apply to the labels, see create_vectorised_nary_multidigit_operation.
+        seed: Random seed for reproducibility.
+
+    Raises:
+        ValueError: If the requested number of samples exceeds available samples.
+    """
+
+    def __init__(
+        self,
+        images: Tensor,
+        targets: Tensor,
+        count: int,
+        n_operands: int = 2,
+        op: Callable[[Tensor], Tensor] = lambda operands_BO: operands_BO.sum(-1),
+        seed: int = 42,
+    ) -> None:
+        self.count = count
+        self.n_operands = n_operands
+
+        if count * n_operands > len(images):
+            raise ValueError(
+                f"The dataset has {len(images)} samples, \
+                Cannot fetch {count} examples for each {n_operands} operands."
+            )
+
+        # Same operand assignment as MNISTOperationDataset
+        gen = torch.Generator().manual_seed(seed)
+        perm = torch.randperm(len(images), generator=gen)
+        self.indices_BO = perm[: count * n_operands].reshape(n_operands, count).T.contiguous()
+
+        self.images = images
+        self.digits_BO = targets[self.indices_BO].long()
+        self.labels_B = op(self.digits_BO)
+
+    def __len__(self) -> int:
+        """Returns the number of samples in the dataset."""
+        return self.count
+
+    def __getitem__(self, idx: Union[int, Sequence[int]]) -> Tuple[Tensor, ...]:
+        """
+        Retrieves the sample (or batch of samples) at the specified index (or indices).
+
+        Returns:
+            Tuple containing:
+            - img_tuple (x[0:n_operands]): Tuple of tensors representing the images (operands).
+            - label_tuple (x[n_operands:2*n_operands]): Tuple of tensors representing individual labels.
+            - label (x[2*n_operands]): Tensor representing the computed label.
+        """
+        idx = torch.as_tensor(idx)
+        imgs_BO1HW = self.images[self.indices_BO[idx]]
+        digits_BO = self.digits_BO[idx]
+        img_tuple = tuple(imgs_BO1HW[..., i, :, :, :] for i in range(self.n_operands))
+        label_tuple = tuple(digits_BO[..., i] for i in range(self.n_operands))
+        return img_tuple + label_tuple + (self.labels_B[idx],)
+
+
+def _normalised_mnist(dataset: datasets.MNIST, indices: Optional[Sequence[int]] = None) -> Tuple[Tensor, Tensor]:
+    """Applies ToTensor and Normalize to the full MNIST dataset at once."""
+    images, targets = dataset.data, dataset.targets
+    if indices is not None:
+        indices = torch.as_tensor(indices)
+        images, targets = images[indices], targets[indices]
+    images_N1HW = ((images.float() / 255.0 - 0.1307) / 0.3081).unsqueeze(1).contiguous()
+    return images_N1HW, targets
+
+
+def _batched_loader(dataset: Dataset, batch_size: int, shuffle: bool, **loader_kwargs) -> DataLoader:
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(
+        dataset,
+        sampler=BatchSampler(sampler, batch_size=batch_size, drop_last=False),
+        batch_size=None,
+        **loader_kwargs,
+    )
+
+
 def get_mnist_op_dataloaders(
     count_train: int,
     count_val: int,
@@ -193,6 +303,9 @@ def get_mnist_op_dataloaders(
     op: Callable[[List[int]], int] = sum,
     seed: int = 42,
     shuffle: bool = True,
+    vectorised_op: Optional[Callable[[Tensor], Tensor]] = None,
+    num_workers: Optional[int] = None,
+    persistent_workers: bool = False,
 ) -> Tuple[DataLoader, DataLoader]:
     """
     Returns DataLoader instances for an operation on MNIST images.
@@ -204,15 +317,23 @@ def get_mnist_op_dataloaders(
         n_operands: Number of operands (images) for the operation (default is 2).
         op: Operation to apply to the labels, defaults to addition.
         seed: Random seed for reproducibility.
+        vectorised_op: If given, uses the in-memory BatchedMNISTOperationDataset with this operation
+            instead of op, which loads whole batches by indexing into a single tensor.
+        num_workers: Number of DataLoader worker processes (default is 0).
+        persistent_workers: Whether to keep the DataLoader workers alive between epochs.
 
     Returns:
         Tuple containing:
         - train_loader: DataLoader for the training dataset with operations.
         - test_loader: DataLoader for the test dataset with operations.
     """
+    loader_kwargs = loader_worker_kwargs(num_workers, persistent_workers)
     transform = transforms.Compose(
         [transforms.ToTensor(), transforms.Normalize((0.1307,), (0.3081,))]
     )
+    if vectorised_op is not None:
+        # The batched datasets apply the transform themselves
+        transform = None
 
     # Load MNIST dataset
     # Load MNIST dataset for training
@@ -235,6 +356,24 @@ def get_mnist_op_dataloaders(
         root="./data", train=False, download=True, transform=transform
     )
 
+    if vectorised_op is not None:
+        datasets_and_counts = [
+            (_normalised_mnist(full_train_dataset, train_dataset.indices), count_train),
+            (_normalised_mnist(full_train_dataset, val_dataset.indices), count_val),
+            (_normalised_mnist(test_dataset), count_test),
+        ]
+        train_set, val_set, test_set = [
+            BatchedMNISTOperationDataset(
+                images, targets, count, n_operands=n_operands, op=vectorised_op, seed=seed
+            )
+            for (images, targets), count in datasets_and_counts
+        ]
+        return (
+            _batched_loader(train_set, batch_size, shuffle, **loader_kwargs),
+            _batched_loader(val_set, batch_size, False, **loader_kwargs),
+            _batched_loader(test_set, batch_size, False, **loader_kwargs),
+        )
+
     # Create operation datasets
     op_train_dataset = MNISTOperationDataset(
         train_dataset, count_train, n_operands=n_operands, op=op, seed=seed
@@ -248,13 +387,13 @@ def get_mnist_op_dataloaders(
 
     # Create DataLoaders
     train_loader = DataLoader(
-        op_train_dataset, batch_size=batch_size, shuffle=shuffle, num_workers=0
+        op_train_dataset, batch_size=batch_size, shuffle=shuffle, **loader_kwargs
     )
     val_loader = DataLoader(
-        op_val_dataset, batch_size=batch_size, shuffle=False, num_workers=0
+        op_val_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs
     )
     test_loader = DataLoader(
-        op_test_dataset, batch_size=batch_size, shuffle=False, num_workers=0
+        op_test_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs
     )
 
     return train_loader, val_loader, test_loader
@@ -0,0 +1,59 @@
+from functools import lru_cache
+
+import torch
+from torch import Tensor
+
+# 10**18 is the largest power of 10 that fits in int64
+MAX_INT64_DIGITS = 19
+
+
+@lru_cache(maxsize=None)
+def _powers_of_10(N: int, device: torch.device) -> Tensor:
+    """
+    Powers of 10 for the digit positions of an N-digit number, most significant digit first.
+    Positions that cannot be represented in int64 get a power of 0, as those digits are always 0 for int64 inputs.
+    """
+    exps = range(N - 1, -1, -1)
+    return torch.tensor(
+        [10**e if e < MAX_INT64_DIGITS else 0 for e in exps], dtype=torch.int64, device=device
+    )
+
+
+def vector_to_base10(w: Tensor, N: int) -> Tensor:
+    """
+    Converts integers to their N base-10 digits, most significant digit first.
+    Shape (...) -> (..., N)
+    """
+    device = w.device
+    if device.type == "mps":
+        # Integer division on int64 is not supported on MPS
+        w = w.cpu()
+    w = w.to(torch.int64)
+    powers_N = _powers_of_10(N, w.device)
+    # Avoid division by zero for the unrepresentable positions, and set those digits to 0
+    w_D = (w[..., None] // powers_N.clamp(min=1)) % 10 * (powers_N > 0)
+    assert torch.all(torch.logical_and(0 <= w_D, w_D < 10))
+    return w_D.to(device)
+
+
+def add_base10(a_N: Tensor, b_N: Tensor) -> Tensor:
+    """
+    Digit-wise addition of two N-digit numbers (most significant digit first) with carry propagation.
+    Exact for any N, since it never materialises the integers.
+    Shape (..., N), (..., N) -> (..., N + 1)
+    """
+    # Work with the least significant digit first
+    s_N = (a_N.to(torch.int64) + b_N.to(torch.int64)).flip(-1)
+    N = s_N.shape[-1]
+    # A digit sum of 9 propagates the incoming carry. Any other digit sum decides the carry by itself:
+    #  it generates a carry if it is >= 10, and kills it otherwise.
+    # The carry out of position i is thus decided by the closest position j <= i that does not propagate.
+    pos_N = torch.arange(N, device=s_N.device).expand_as(s_N)
+    decider_N = torch.where(s_N != 9, pos_N, -1).cummax(dim=-1).values
+    generates_N = s_N >= 10
+    carry_out_N = torch.gather(generates_N, -1, decider_N.clamp(min=0)) & (decider_N >= 0)
+    carry_out_N = carry_out_N.to(torch.int64)
+
+    carry_in_N = torch.cat([torch.zeros_like(carry_out_N[..., :1]), carry_out_N[..., :-1]], dim=-1)
+    digits_N = (s_N + carry_in_N) % 10
+    return torch.cat([digits_N, carry_out_N[..., -1:]], dim=-1).flip(-1)
@@ -2,7 +2,10 @@ from __future__ import annotations
 import math
 import os
 import time
+from typing import Tuple
 
+from expressive.checkpoint import CheckpointManager
+from expressive.prefetch import Prefetcher
 from expressive.util import get_device
 from torch.utils.data import DataLoader
 import torch
@@ -16,9 +19,11 @@ from expressive.experiments.mnist_op.absorbing_mnist import (
 from expressive.args import MNISTAbsorbingArguments
 from expressive.experiments.mnist_op.data import (
     create_nary_multidigit_operation,
+    create_vectorised_nary_multidigit_operation,
     get_mnist_op_dataloaders,
 )
 
+from expressive.methods.evaluation import eval_chunks
 from expressive.methods.logger import (
     TestLog,
     TrainingLog,
@@ -29,25 +34,28 @@ from expressive.methods.logger import (
 SWEEP = True
 
 
+def prepare_batch(batch) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # Returns the images, the digits of the label, and the individual digit labels (w)
+    mn_digits, label_digits, label = (
+        batch[: 2 * args.N],
+        batch[2 * args.N : -1],
+        batch[-1],
+    )
+    x = torch.cat(mn_digits, dim=1)
+    return x, vector_to_base10(label, args.N + 1), torch.stack(label_digits, dim=-1)
+
+
 def test(
     val_loader: DataLoader,
     test_logger: TestLog,
     model: MNISTAddProblem,
     device: torch.device,
 ):
-    for i, batch in enumerate(val_loader):
-        mn_digits, label_digits, label = (
-            batch[: 2 * args.N],
-            batch[2 * args.N : -1],
-            batch[-1],
-        )
-        x = torch.cat(mn_digits, dim=1)
-        model.evaluate(
-            x.to(device),
-            vector_to_base10(label.to(device), args.N + 1),
-            torch.stack(label_digits, dim=-1).to(device),
-            test_logger.log,
-        )
+    prefetcher = Prefetcher(val_loader, prepare_batch, device, args.prefetch_lookahead)
+    for i, (x, label, w_labels) in enumerate(
+        eval_chunks(prefetcher, args.eval_memory_budget, args.eval_chunk_size)
+    ):
+        model.evaluate(x, label, w_labels, test_logger.log)
         if args.DEBUG:
             break
     test_logger.push(len(val_loader))
@@ -75,6 +83,10 @@ def main():
 
     bin_op = sum if args.op == "sum" else math.prod if args.op == "product" else None
     op = create_nary_multidigit_operation(arity, bin_op)
+    vectorised_op = None
+    if args.in_memory_data:
+        bin_op_vec = (lambda n: n.sum(-1)) if args.op == "sum" else (lambda n: n.prod(-1)) if args.op == "product" else None
+        vectorised_op = create_vectorised_nary_multidigit_operation(arity, bin_op_vec)
 
     if args.DEBUG:
         # Enable anomaly detection in PyTorch for debugging NaNs
@@ -101,7 +113,11 @@ def main():
         op=op,
         # This shuffle is very weird...
         shuffle=True,
+        vectorised_op=vectorised_op,
+        num_workers=args.num_workers,
+        persistent_workers=args.persistent_workers,
     )
+    train_prefetcher = Prefetcher(train_loader, prepare_batch, device, args.prefetch_lookahead)
 
     log_iterations = len(train_loader) // args.log_per_epoch
 
@@ -113,20 +129,15 @@ def main():
         model.parameters(), lr=args.lr, betas=(0.9, 0.999), eps=1e-08, weight_decay=0.0
     )
 
-    os.makedirs(f"models/{run.id}", exist_ok=True)
+    checkpoints = CheckpointManager(f"models/{run.id}", keep_last=args.keep_checkpoints, on_saved=wandb.save)
     for epoch in range(args.epochs):
         print("----------------------------------------")
         print("NEW EPOCH", epoch)
 
         start_epoch_time = time.time()
 
-        for i, batch in enumerate(train_loader):
+        for i, (x, label, w_labels) in enumerate(train_prefetcher):
             optim.zero_grad()
-            mn_digits, label, w_labels = batch[: 2 * args.N], batch[-1], batch[2 * args.N : -1]
-
-            x = torch.cat(mn_digits, dim=1).to(device)
-            w_labels = torch.stack(w_labels, dim=1).to(device)
-            label = vector_to_base10(label.to(device), args.N + 1)
             loss = model.loss(x, label, train_logger.log, w_labels)
 
             loss.backward()
@@ -151,16 +162,15 @@ def main():
                 print(f"Test time: {test_time} seconds")
             
             print(f"Saving model to {run.id}")
-            wandb.save(f"model_{epoch}_{run.id}.pth")
-            torch.save(model.state_dict(), f"models/{run.id}/model_{epoch}.pth") 
+            checkpoints.save(epoch, model, optim)
             
 
     print("----- TESTING -----")
     test_logger = TestLogger(TestLog, args, "test")
     test(test_loader, test_logger, model, device)
     print(f"Saving model to {run.id}")
-    wandb.save(f"model_{epoch}_{run.id}.pth")
-    torch.save(model.state_dict(), f"models/{run.id}/model_{epoch}.pth") 
+    checkpoints.save(epoch, model, optim)
+    checkpoints.close()
 
 
 if __name__ == "__main__":
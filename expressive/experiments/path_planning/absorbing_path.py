@@ -6,6 +6,7 @@ import torch
 from torch import Tensor
 
 from expressive.experiments.path_planning.dijkstra import compute_shortest_path
+from expressive.experiments.path_planning.incremental import IncrementalSolvers
 from expressive.methods.base_model import BaseNeSyDiffusion, Problem
 from expressive.methods.cond_model import CondNeSyDiffusion
 from expressive.methods.simple_nesy_diff import SimpleNeSyDiffusion
@@ -42,6 +43,10 @@ class PathAbsorbing(Problem, nn.Module):
         # super().__init__(reverse, self.y_from_w, args)
         self.register_buffer("costs_t", torch.tensor(self.costs))
         self.debug = args.DEBUG
+        self.solver = args.shortest_path_solver
+        self.solver_workers = args.shortest_path_workers
+        # Search state carried along the sampling trajectory, for the incremental solver
+        self.incremental_solvers = IncrementalSolvers()
 
     @override
     def shape_w(self) -> torch.Size:
@@ -56,7 +61,12 @@ class PathAbsorbing(Problem, nn.Module):
         # Reshape to prepare for shortest path computations.
         w_KGG = w_SBW.reshape(prod(w_SBW.shape[:-1]), self.grid_size, self.grid_size)
         costs_KGG = self.costs_t[w_KGG]
-        y_KGG = compute_shortest_path(costs_KGG, debug=self.debug)
+        if self.solver == "incremental":
+            y_KGG = self.incremental_solvers(costs_KGG)
+        else:
+            y_KGG = compute_shortest_path(
+                costs_KGG, debug=self.debug, solver=self.solver, num_workers=self.solver_workers
+            )
         return y_KGG.reshape(w_SBW.shape).long()
 
     def eval_y(self, y_0_SBY: Tensor, y_0_BY: Tensor, w_0_BW: Tensor) -> Tensor:
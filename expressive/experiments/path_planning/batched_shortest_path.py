@@ -0,0 +1,170 @@
+from functools import lru_cache
+from typing import List, Tuple
+
+import torch
+from torch import Tensor
+
+from expressive.experiments.path_planning.dijkstra import DijkstraOutput
+
+
+def _deltas(neighbourhood_fn: str) -> List[Tuple[int, int]]:
+    if neighbourhood_fn == "8-grid":
+        return [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if (dx, dy) != (0, 0)]
+    elif neighbourhood_fn == "4-grid":
+        return [(1, 0), (0, 1), (0, -1), (-1, 0)]
+    raise Exception(f"neighbourhood_fn of {neighbourhood_fn} not possible")
+
+
+@lru_cache(maxsize=None)
+def _neighbour_table(H: int, W: int, neighbourhood_fn: str, device: torch.device) -> Tensor:
+    """
+    Returns the flat indices of the neighbours of each cell, shape (H*W, D).
+    Missing neighbours (outside the grid) point to the padding index H*W.
+    """
+    deltas = _deltas(neighbourhood_fn)
+    x_N = torch.arange(H).repeat_interleave(W)
+    y_N = torch.arange(W).repeat(H)
+    table = []
+    for dx, dy in deltas:
+        x_new, y_new = x_N + dx, y_N + dy
+        valid = (0 <= x_new) & (x_new < H) & (0 <= y_new) & (y_new < W)
+        table.append(torch.where(valid, x_new * W + y_new, H * W))
+    return torch.stack(table, dim=-1).to(device)
+
+
+def _gather_neighbours(values_BN: Tensor, nbr_ND: Tensor, pad_value: float) -> Tensor:
+    # Gathers the values of the neighbours of each cell, shape (B, N, D, ...)
+    pad = torch.full_like(values_BN[:, :1], pad_value)
+    return torch.cat([values_BN, pad], dim=1)[:, nbr_ND]
+
+
+def _pops_before(dist_BNx: Tensor, idx_Nx: Tensor, dist_BNy: Tensor, idx_Ny: Tensor) -> Tensor:
+    # Dijkstra pops the heap entries (cost, (x, y)) in lexicographic order, which is (cost, flat index)
+    return (dist_BNx < dist_BNy) | ((dist_BNx == dist_BNy) & (idx_Nx < idx_Ny))
+
+
+def _shortest_distances(weights_BHW: Tensor, neighbourhood_fn: str) -> Tensor:
+    """
+    Bellman-Ford with min-plus updates over all neighbours, run until no distance changes.
+    Neighbours are read from shifted slices of a padded grid of distances.
+    """
+    B, H, W = weights_BHW.shape
+    inf = torch.finfo(weights_BHW.dtype).max
+    deltas = _deltas(neighbourhood_fn)
+    dist_BHW = torch.full_like(weights_BHW, inf)
+    dist_BHW[:, 0, 0] = weights_BHW[:, 0, 0]
+    padded_BHW = torch.full((B, H + 2, W + 2), inf, dtype=weights_BHW.dtype, device=weights_BHW.device)
+    while True:
+        padded_BHW[:, 1:-1, 1:-1] = dist_BHW
+        nbr_min_BHW = padded_BHW[:, 1 + deltas[0][0] : 1 + deltas[0][0] + H, 1 + deltas[0][1] : 1 + deltas[0][1] + W]
+        for dx, dy in deltas[1:]:
+            nbr_min_BHW = torch.minimum(nbr_min_BHW, padded_BHW[:, 1 + dx : 1 + dx + H, 1 + dy : 1 + dy + W])
+        # Same addition (weight + distance) as in dijkstra, so the same rounding.
+        #  Since rounding is monotone, adding to the minimum is the same as the minimum of the additions.
+        new_dist_BHW = torch.minimum(dist_BHW, weights_BHW + nbr_min_BHW)
+        new_dist_BHW[:, 0, 0] = weights_BHW[:, 0, 0]
+        if torch.equal(new_dist_BHW, dist_BHW):
+            return dist_BHW
+        dist_BHW = new_dist_BHW
+
+
+def _uniqueness_extras(
+    weights_BN: Tensor, dist_BN: Tensor, nbr_ND: Tensor, optimal_BND: Tensor, nbr_dist_BND: Tensor
+) -> Tensor:
+    """
+    dijkstra counts paths in num_path by copying the count of the predecessor, and adding 1 for every
+     other relaxation that reaches the same cost before the node is settled. Since settled nodes are
+     re-expanded when their stale heap entries are popped, these also count.
+    Returns the number of such extra relaxations for each node.
+    """
+    B, N = dist_BN.shape
+    inf = torch.finfo(dist_BN.dtype).max
+    idx_N = torch.arange(N, device=dist_BN.device)
+    nbr_idx_ND = nbr_ND
+
+    # Stale heap entries of u: every strict improvement of the cost of u but the last.
+    # u is relaxed by its neighbours w that are popped before u, in pop order.
+    before_u_BND = _pops_before(nbr_dist_BND, nbr_idx_ND, dist_BN[:, :, None], idx_N[:, None])
+    cand_BND = torch.where(before_u_BND, weights_BN[:, :, None] + nbr_dist_BND, inf)
+    # earlier_BNDD[..., j, i]: neighbour i is popped before neighbour j
+    earlier_BNDD = _pops_before(
+        nbr_dist_BND[:, :, None, :], nbr_idx_ND[:, None, :], nbr_dist_BND[:, :, :, None], nbr_idx_ND[:, :, None]
+    ) & before_u_BND[:, :, None, :]
+    earlier_min_BND = torch.where(earlier_BNDD, cand_BND[:, :, None, :], inf).min(dim=-1)[0]
+    stale_BND = before_u_BND & (cand_BND < earlier_min_BND) & (cand_BND != dist_BN[:, :, None])
+    stale_cost_BND = torch.where(stale_BND, cand_BND, inf)
+
+    # Every stale entry of an optimal predecessor u that is popped before v adds one
+    stale_cost_BNDD = _gather_neighbours(stale_cost_BND, nbr_ND, inf)
+    stale_before_v_BNDD = _pops_before(
+        stale_cost_BNDD, nbr_idx_ND[:, :, None], dist_BN[:, :, None, None], idx_N[:, None, None]
+    )
+    num_stale_BN = (stale_before_v_BNDD & optimal_BND[..., None]).sum(dim=(-2, -1))
+    # Every optimal predecessor but the first one adds one
+    return optimal_BND.sum(-1).clamp(min=1) - 1 + num_stale_BN
+
+
+def batched_shortest_path(
+    batch_weights_BHW: Tensor,
+    neighbourhood_fn: str = "8-grid",
+    request_transitions: bool = False,
+    compute_unique: bool = False,
+) -> DijkstraOutput:
+    """
+    Computes the shortest (node-weighted) paths from the top-left to the bottom-right cell of a batch of grids,
+     relaxing all grids at once. Gives exactly the same paths as dijkstra, including how ties are broken:
+     the predecessor of a cell is its optimal neighbour that dijkstra pops from the heap first.
+
+    Returns a DijkstraOutput with:
+    - shortest_path: (B, H, W) float tensor with 1s on the path
+    - is_unique: (B,) bool tensor, same as in dijkstra. Only computed if compute_unique, None otherwise
+    - transitions: (B, H*W) tensor with the flat index of the predecessor of each cell, if request_transitions
+    """
+    B, H, W = batch_weights_BHW.shape
+    N = H * W
+    device = batch_weights_BHW.device
+    weights_BHW = batch_weights_BHW
+    if not weights_BHW.is_floating_point():
+        weights_BHW = weights_BHW.float()
+    weights_BN = weights_BHW.reshape(B, N)
+    nbr_ND = _neighbour_table(H, W, neighbourhood_fn, device)
+    idx_N = torch.arange(N, device=device)
+    inf = torch.finfo(weights_BN.dtype).max
+
+    dist_BN = _shortest_distances(weights_BHW, neighbourhood_fn).reshape(B, N)
+
+    # Optimal predecessors: neighbours that reach the distance of the cell, and are popped before it
+    nbr_dist_BND = _gather_neighbours(dist_BN, nbr_ND, inf)
+    optimal_BND = (weights_BN[:, :, None] + nbr_dist_BND == dist_BN[:, :, None]) & _pops_before(
+        nbr_dist_BND, nbr_ND, dist_BN[:, :, None], idx_N[:, None]
+    )
+    # The predecessor is the optimal one that is popped first: lowest distance, then lowest index
+    min_dist_BN = torch.where(optimal_BND, nbr_dist_BND, inf).min(dim=-1, keepdim=True)[0]
+    first_BND = optimal_BND & (nbr_dist_BND == min_dist_BN)
+    pred_BN = torch.where(first_BND, nbr_ND, N).min(dim=-1)[0]
+    pred_BN[:, 0] = 0
+
+    extras_BN = None
+    if compute_unique:
+        extras_BN = _uniqueness_extras(weights_BN, dist_BN, nbr_ND, optimal_BND, nbr_dist_BND)
+
+    # Trace back the paths of all grids at once
+    on_path_BN = torch.zeros_like(weights_BN)
+    range_B = torch.arange(B, device=device)
+    cur_B = torch.full((B,), N - 1, device=device, dtype=torch.long)
+    num_extra_B = torch.zeros((B,), device=device, dtype=torch.long)
+    on_path_BN[range_B, cur_B] = 1.0
+    while True:
+        not_done_B = cur_B != 0
+        if not not_done_B.any():
+            break
+        if extras_BN is not None:
+            num_extra_B += torch.where(not_done_B, extras_BN[range_B, cur_B], 0)
+        cur_B = pred_BN[range_B, cur_B]
+        on_path_BN[range_B, cur_B] = 1.0
+
+    return DijkstraOutput(
+        shortest_path=on_path_BN.reshape(B, H, W),
+        is_unique=num_extra_B == 0 if compute_unique else None,
+        transitions=pred_BN if request_transitions else None,
+    )
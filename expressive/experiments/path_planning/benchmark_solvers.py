@@ -0,0 +1,71 @@
+# Compares the throughput of the shortest path solvers of compute_shortest_path.
+# Usage: python -m expressive.experiments.path_planning.benchmark_solvers --num_grids 1024
+import multiprocessing
+import time
+from typing import List, Optional
+
+import torch
+from tap import Tap
+
+from expressive.experiments.path_planning.dijkstra import compute_shortest_path
+
+
+class BenchmarkArguments(Tap):
+    grid_sizes: List[int] = [12, 18, 24, 30]
+    # Number of grids per call of compute_shortest_path, eg. loss_S * batch_size
+    num_grids: int = 800
+    repeats: int = 3
+    costs: List[float] = [0.8, 1.2, 5.3, 7.7, 9.2]
+    solvers: List[str] = ["serial", "astar", "ray", "pool", "batched"]
+    num_workers: Optional[int] = None
+    device: str = "cpu"
+    seed: int = 0
+
+
+def run_solver(name: str, costs_BHW: torch.Tensor, num_workers: Optional[int]) -> torch.Tensor:
+    if name in ["serial", "ray"]:
+        return compute_shortest_path(costs_BHW, solver="dijkstra")
+    return compute_shortest_path(costs_BHW, solver=name, num_workers=num_workers)
+
+
+def main():
+    args = BenchmarkArguments(explicit_bool=True).parse_args()
+    torch.manual_seed(args.seed)
+    costs_t = torch.tensor(args.costs, device=args.device)
+
+    solvers = args.solvers
+    if "ray" in solvers:
+        try:
+            import ray
+        except ImportError:
+            print("ray is not installed, skipping")
+            solvers = [s for s in solvers if s != "ray"]
+
+    print(f"{'grid':>6} {'solver':>8} {'grids/s':>10} {'s/call':>8}")
+    for grid_size in args.grid_sizes:
+        w_BHW = torch.randint(0, len(args.costs), (args.num_grids, grid_size, grid_size), device=args.device)
+        costs_BHW = costs_t[w_BHW]
+        reference = None
+        for name in solvers:
+            # compute_shortest_path uses ray whenever it is initialised, so only start it for its own measurements
+            if name == "ray":
+                ray.init(num_cpus=args.num_workers or multiprocessing.cpu_count())
+            # Warm-up: starts the pool, exports the ray function
+            paths = run_solver(name, costs_BHW, args.num_workers)
+            start = time.time()
+            for _ in range(args.repeats):
+                paths = run_solver(name, costs_BHW, args.num_workers)
+            if args.device != "cpu":
+                torch.cuda.synchronize()
+            duration = (time.time() - start) / args.repeats
+            if name == "ray":
+                ray.shutdown()
+            if reference is None:
+                reference = paths
+            elif not torch.equal(paths.cpu(), reference.cpu()):
+                print(f"Warning: {name} gives different paths than {solvers[0]}")
+            print(f"{grid_size:>6} {name:>8} {args.num_grids / duration:>10.1f} {duration:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
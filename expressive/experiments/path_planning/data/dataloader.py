@@ -1,7 +1,65 @@
-from typing import Tuple
+import os
+from typing import List, Tuple
 
 import numpy as np
 import torch
+from torch.utils.data import default_collate
+
+from expressive.atomic import atomic_write
+
+
+class ShardedArray:
+    """
+    Read-only concatenation along the first axis of arrays stored in parts (eg. memory maps of
+     train_maps_part0.npy and train_maps_part1.npy), without copying them.
+    Supports integer, slice and integer array indexing on the first axis.
+    """
+
+    def __init__(self, parts: List[np.ndarray]):
+        self.parts = parts
+        self.offsets = np.cumsum([0] + [len(part) for part in parts])
+        self.shape = (int(self.offsets[-1]),) + parts[0].shape[1:]
+        self.dtype = parts[0].dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        array = np.concatenate(self.parts, axis=0)
+        return array if dtype is None else array.astype(dtype)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self[np.arange(len(self))[item]]
+        indices = np.asarray(item)
+        if indices.ndim == 0:
+            index = int(indices) % len(self)
+            part = np.searchsorted(self.offsets, index, side="right") - 1
+            return self.parts[part][index - self.offsets[part]]
+        indices = indices % len(self)
+        parts = np.searchsorted(self.offsets, indices, side="right") - 1
+        result = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        for part in np.unique(parts):
+            selected = parts == part
+            result[selected] = self.parts[part][indices[selected] - self.offsets[part]]
+        return result
+
+
+def load_split_array(directory: str, name: str, mmap: bool = False):
+    """
+    Loads directory/name.npy, or if it does not exist, the parts directory/name_part{i}.npy as a ShardedArray.
+    If mmap, the files are memory-mapped instead of read.
+    """
+    mmap_mode = "r" if mmap else None
+    path = f"{directory}/{name}.npy"
+    if os.path.exists(path):
+        return np.load(path, mmap_mode=mmap_mode)
+    parts = []
+    while os.path.exists(f"{directory}/{name}_part{len(parts)}.npy"):
+        parts.append(np.load(f"{directory}/{name}_part{len(parts)}.npy", mmap_mode=mmap_mode))
+    if not parts:
+        raise FileNotFoundError(f"Neither {path} nor its parts {name}_part0.npy, ... exist")
+    return parts[0] if len(parts) == 1 else ShardedArray(parts)
 
 
 class WCDataSet(torch.utils.data.Dataset):
@@ -9,10 +67,11 @@ class WCDataSet(torch.utils.data.Dataset):
     def __init__(self, N: int, base_path="data/", type="train"):
         super().__init__()
         self.N = N
-        self.maps = torch.tensor(np.load(base_path + f"warcraft_shortest_path/{N}x{N}/{type}_maps.npy"), dtype=torch.float)
-        self.paths = torch.tensor(np.load(base_path + f"warcraft_shortest_path/{N}x{N}/{type}_shortest_paths.npy"))\
+        directory = base_path + f"warcraft_shortest_path/{N}x{N}"
+        self.maps = torch.tensor(np.asarray(load_split_array(directory, f"{type}_maps")), dtype=torch.float)
+        self.paths = torch.tensor(np.asarray(load_split_array(directory, f"{type}_shortest_paths")))\
             .reshape(-1, self.N * self.N)
-        weights = np.load(base_path + f"warcraft_shortest_path/{N}x{N}/{type}_vertex_weights.npy")\
+        weights = np.asarray(load_split_array(directory, f"{type}_vertex_weights"))\
             .reshape(-1, self.N * self.N)
         self.weights = torch.tensor(weights, dtype=torch.float)
         self.num_classes = len(np.unique(self.weights))
@@ -32,10 +91,92 @@ class WCDataSet(torch.utils.data.Dataset):
     def __getitem__(self, item) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         return self.maps[item], self.paths[item], self.weights[item]
 
-def get_datasets(N, basepath="data/"):
-    train_dataset = WCDataSet(N, base_path=basepath, type="train")
-    val_dataset = WCDataSet(N, base_path=basepath, type="val")
-    test_dataset = WCDataSet(N, base_path=basepath, type="test")
+    # Maps are normalised on load
+    collate = staticmethod(default_collate)
+
+
+def map_stats_path(N: int, base_path="data/") -> str:
+    return base_path + f"warcraft_shortest_path/{N}x{N}/train_maps_stats.npz"
+
+
+def train_map_stats(N: int, base_path="data/", chunk_size: int = 1000) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the per-channel mean and std of the train maps.
+    Computed once, in chunks over the memory-mapped maps, and stored in a sidecar file next to the maps.
+    """
+    path = map_stats_path(N, base_path)
+    if not os.path.exists(path):
+        maps = load_split_array(base_path + f"warcraft_shortest_path/{N}x{N}", "train_maps", mmap=True)
+        sum_C = np.zeros(maps.shape[-1])
+        sum_sq_C = np.zeros(maps.shape[-1])
+        for start in range(0, maps.shape[0], chunk_size):
+            chunk = maps[start : start + chunk_size].astype(np.float64)
+            sum_C += chunk.sum(axis=(0, 1, 2))
+            sum_sq_C += (chunk**2).sum(axis=(0, 1, 2))
+        count = maps.shape[0] * maps.shape[1] * maps.shape[2]
+        mean_C = sum_C / count
+        # Unbiased, like torch.std
+        std_C = np.sqrt((sum_sq_C - count * mean_C**2) / (count - 1))
+        with atomic_write(path) as tmp_path:
+            np.savez(tmp_path, mean=mean_C, std=std_C)
+    stats = np.load(path)
+    return stats["mean"], stats["std"]
+
+
+class MemmapWCDataSet(torch.utils.data.Dataset):
+    """
+    Like WCDataSet, but memory-maps the maps and keeps them as stored (uint8), instead of loading a normalised
+     float copy of the split. Splits stored in parts are read directly, without merging them first. Maps are normalised per batch in collate, with the statistics of the train split
+     (see train_map_stats) for all splits.
+    """
+
+    def __init__(self, N: int, base_path="data/", type="train"):
+        super().__init__()
+        self.N = N
+        self.directory = base_path + f"warcraft_shortest_path/{N}x{N}"
+        self.type = type
+        # (num_maps, H, W, C). Sharded splits are concatenated virtually
+        self.maps = load_split_array(self.directory, f"{type}_maps", mmap=True)
+        self.paths = torch.from_numpy(np.asarray(load_split_array(self.directory, f"{type}_shortest_paths")))\
+            .reshape(-1, self.N * self.N)
+        weights = np.asarray(load_split_array(self.directory, f"{type}_vertex_weights"))\
+            .reshape(-1, self.N * self.N)
+        self.weights = torch.tensor(weights, dtype=torch.float)
+        self.num_classes = len(np.unique(weights))
+        self.num_maps = self.maps.shape[0]
+
+        mean_C, std_C = train_map_stats(N, base_path)
+        self.mean = torch.tensor(mean_C, dtype=torch.float).reshape(1, -1, 1, 1)
+        self.std = torch.tensor(std_C, dtype=torch.float).reshape(1, -1, 1, 1)
+
+    def __len__(self):
+        return self.num_maps
+
+    def __getstate__(self):
+        # Pickling a memory map copies its data, so workers started with spawn map the file again instead
+        state = self.__dict__.copy()
+        state["maps"] = None
+        return state
+
+    def __getitem__(self, item) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        if self.maps is None:
+            self.maps = load_split_array(self.directory, f"{self.type}_maps", mmap=True)
+        return torch.from_numpy(np.array(self.maps[item])), self.paths[item], self.weights[item]
+
+    def normalise(self, maps_BHWC: torch.Tensor) -> torch.Tensor:
+        maps_BCHW = maps_BHWC.permute(0, 3, 1, 2).float()
+        return (maps_BCHW - self.mean) / self.std
+
+    def collate(self, items: List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]):
+        maps, paths, weights = default_collate(items)
+        return self.normalise(maps), paths, weights
+
+
+def get_datasets(N, basepath="data/", mmap=False):
+    dataset_cls = MemmapWCDataSet if mmap else WCDataSet
+    train_dataset = dataset_cls(N, base_path=basepath, type="train")
+    val_dataset = dataset_cls(N, base_path=basepath, type="val")
+    test_dataset = dataset_cls(N, base_path=basepath, type="test")
     return train_dataset, val_dataset, test_dataset
 
 
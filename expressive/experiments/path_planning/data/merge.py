@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # From https://github.com/nec-research/tf-imle
+# Merging is optional: the dataloader also reads the parts directly.
 
 import numpy as np
 
+from expressive.atomic import atomic_write
+
 paths = [
     'warcraft_shortest_path/30x30/train_shortest_paths_part1.npy',
     'warcraft_shortest_path/30x30/train_maps_part1.npy',
@@ -16,14 +19,28 @@ paths = [
     'warcraft_shortest_path/24x24/train_vertex_weights_part1.npy'
 ]
 
-for path in paths:
-    path_a = path.replace("part1", "part0")
-    path_b = path
-    output_path = path.replace("_part1", "")
 
-    a = np.load(path_a)
-    b = np.load(path_b)
-    c = np.concatenate([a, b], axis=0)
+def merge(input_paths, output_path, chunk_size=1000):
+    # Streams the parts into a memory-mapped output file, so only chunk_size rows are in memory at a time
+    parts = [np.load(path, mmap_mode='r') for path in input_paths]
+    shape = (sum(len(part) for part in parts),) + parts[0].shape[1:]
+    with atomic_write(output_path) as tmp_path:
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=parts[0].dtype, shape=shape)
+        offset = 0
+        for part in parts:
+            for start in range(0, len(part), chunk_size):
+                chunk = part[start:start + chunk_size]
+                out[offset:offset + len(chunk)] = chunk
+                offset += len(chunk)
+        out.flush()
+        del out
+
+
+if __name__ == '__main__':
+    for path in paths:
+        path_a = path.replace("part1", "part0")
+        path_b = path
+        output_path = path.replace("_part1", "")
 
-    print(path_a, path_b, output_path)
-    np.save(output_path, c)
\ No newline at end of file
+        print(path_a, path_b, output_path)
+        merge([path_a, path_b], output_path)
@@ -1,16 +1,23 @@
 # -*- coding: utf-8 -*-
 # Code taken from https://github.com/uclnlp/torch-imle
 import itertools
+import math
+from array import array
 
 import numpy as np
 import heapq
-import ray
-from functools import partial
+from functools import lru_cache
 import torch
 import time
 
 from collections import namedtuple
 
+try:
+    import ray
+except ImportError:
+    # Optional, only used to parallelise the dijkstra solver
+    ray = None
+
 DijkstraOutput = namedtuple(
     "DijkstraOutput", ["shortest_path", "is_unique", "transitions"]
 )
@@ -41,66 +48,201 @@ def get_neighbourhood_func(neighbourhood_fn):
         raise Exception(f"neighbourhood_fn of {neighbourhood_fn} not possible")
 
 
+@lru_cache(maxsize=None)
+def _neighbour_lists(x_max, y_max, neighbourhood_fn):
+    # Flat indices (x * y_max + y) of the neighbours of each cell
+    neighbors_func = get_neighbourhood_func(neighbourhood_fn)
+    return tuple(
+        tuple(x_new * y_max + y_new for x_new, y_new in neighbors_func(x, y, x_max, y_max))
+        for x in range(x_max)
+        for y in range(y_max)
+    )
+
+
+def _rounding(dtype):
+    """
+    Returns a function that rounds a Python float to dtype. Sums are computed on Python floats (much faster
+     than numpy scalars), and rounded so that they equal the sums of the matrix dtype used by the original code.
+    For float32, rounding the exact float64 sum of two float32 numbers gives the float32 sum.
+    """
+    if dtype != np.float32:
+        return float
+    buffer = array("f", [0.0])
+
+    def round_f32(value):
+        buffer[0] = value
+        return buffer[0]
+
+    return round_f32
+
+
+def _on_path(matrix, pred):
+    # Traces back the path from the bottom-right cell using the flat predecessors
+    x_max, y_max = matrix.shape
+    on_path = np.zeros_like(matrix)
+    cur = x_max * y_max - 1
+    on_path.flat[cur] = 1
+    while cur != 0:
+        cur = pred[cur]
+        on_path.flat[cur] = 1.0
+    return on_path
+
+
+def _transitions_dict(pred, y_max):
+    return {divmod(v, y_max): divmod(u, y_max) for v, u in enumerate(pred) if u >= 0}
+
+
 def dijkstra(matrix, neighbourhood_fn="8-grid", request_transitions=False):
+    """
+    Dijkstra on a node-weighted grid, from the top-left to the bottom-right cell.
+    Cells are indexed by flat index, and the search stops once the target is settled (unless request_transitions,
+     which needs the predecessors of all cells).
+    is_unique counts, as in the original code, every relaxation that reaches the current cost of a cell again,
+     including those from stale heap entries of settled cells. Stale entries can never improve a cost,
+     so they only do this count instead of being expanded again.
+    """
     x_max, y_max = matrix.shape
-    neighbors_func = partial(
-        get_neighbourhood_func(neighbourhood_fn), x_max=x_max, y_max=y_max
+    N = x_max * y_max
+    target = N - 1
+    neighbours = _neighbour_lists(x_max, y_max, neighbourhood_fn)
+    rnd = _rounding(matrix.dtype)
+    weights = matrix.ravel().tolist()
+
+    costs = [math.inf] * N
+    costs[0] = weights[0]
+    num_path = [0] * N
+    num_path[0] = 1
+    pred = [-1] * N
+    certain = [False] * N
+    priority_queue = [(costs[0], 0)]
+
+    while priority_queue:
+        _, u = heapq.heappop(priority_queue)
+        cost_u = costs[u]
+        if certain[u]:
+            for v in neighbours[u]:
+                if not certain[v] and rnd(weights[v] + cost_u) == costs[v]:
+                    num_path[v] += 1
+            continue
+
+        for v in neighbours[u]:
+            if not certain[v]:
+                new_cost = rnd(weights[v] + cost_u)
+                if new_cost < costs[v]:
+                    costs[v] = new_cost
+                    heapq.heappush(priority_queue, (new_cost, v))
+                    pred[v] = u
+                    num_path[v] = num_path[u]
+                elif new_cost == costs[v]:
+                    num_path[v] += 1
+
+        certain[u] = True
+        # Nothing changes the path or the path count of a settled cell
+        if u == target and not request_transitions:
+            break
+
+    return DijkstraOutput(
+        shortest_path=_on_path(matrix, pred),
+        is_unique=num_path[target] == 1,
+        transitions=_transitions_dict(pred, y_max) if request_transitions else None,
     )
 
-    costs = np.full_like(matrix, 1.0e10)
-    costs[0][0] = matrix[0][0]
-    num_path = np.zeros_like(matrix)
-    num_path[0][0] = 1
-    priority_queue = [(matrix[0][0], (0, 0))]
-    certain = set()
-    transitions = dict()
+
+@lru_cache(maxsize=None)
+def _steps_to_target(x_max, y_max, neighbourhood_fn):
+    # Minimal number of cells entered to reach the target from each cell
+    if neighbourhood_fn == "8-grid":
+        return tuple(max(x_max - 1 - x, y_max - 1 - y) for x in range(x_max) for y in range(y_max))
+    return tuple((x_max - 1 - x) + (y_max - 1 - y) for x in range(x_max) for y in range(y_max))
+
+
+def astar(matrix, neighbourhood_fn="8-grid", request_transitions=False):
+    """
+    Goal-directed search from the top-left to the bottom-right cell, with heuristic
+     minimum cell cost * minimal number of steps to the target (Chebyshev distance for 8-grid, Manhattan for 4-grid).
+    Gives the same paths as dijkstra: the search continues until all cells that could tie with the target are settled,
+     and the predecessor of each cell on the path is then chosen as dijkstra does, as the optimal neighbour
+     with the lowest (cost, flat index).
+    is_unique is None, as the path count of dijkstra depends on the order in which it explores all cells
+     cheaper than the target. Use dijkstra if it is needed.
+    transitions only contain the cells settled by the search.
+    """
+    x_max, y_max = matrix.shape
+    N = x_max * y_max
+    target = N - 1
+    neighbours = _neighbour_lists(x_max, y_max, neighbourhood_fn)
+    rnd = _rounding(matrix.dtype)
+    weights = matrix.ravel().tolist()
+    # Slightly shrunk, so the heuristic stays consistent despite rounding of the costs
+    min_weight = min(weights) * (1 - 1e-3)
+    heuristic = [min_weight * steps for steps in _steps_to_target(x_max, y_max, neighbourhood_fn)]
+
+    costs = [math.inf] * N
+    costs[0] = weights[0]
+    certain = [False] * N
+    priority_queue = [(costs[0] + heuristic[0], 0)]
+    tolerance = math.inf
 
     while priority_queue:
-        cur_cost, (cur_x, cur_y) = heapq.heappop(priority_queue)
-        if (cur_x, cur_y) in certain:
-            pass
-
-        for x, y in neighbors_func(cur_x, cur_y):
-            if (x, y) not in certain:
-                if matrix[x][y] + costs[cur_x][cur_y] < costs[x][y]:
-                    costs[x][y] = matrix[x][y] + costs[cur_x][cur_y]
-                    heapq.heappush(priority_queue, (costs[x][y], (x, y)))
-                    transitions[(x, y)] = (cur_x, cur_y)
-                    num_path[x, y] = num_path[cur_x, cur_y]
-                elif matrix[x][y] + costs[cur_x][cur_y] == costs[x][y]:
-                    num_path[x, y] += 1
-
-        certain.add((cur_x, cur_y))
-    # retrieve the path
-    cur_x, cur_y = x_max - 1, y_max - 1
-    on_path = np.zeros_like(matrix)
-    on_path[-1][-1] = 1
-    while (cur_x, cur_y) != (0, 0):
-        cur_x, cur_y = transitions[(cur_x, cur_y)]
-        on_path[cur_x, cur_y] = 1.0
+        estimate, u = heapq.heappop(priority_queue)
+        if estimate > costs[target] + tolerance:
+            break
+        if certain[u]:
+            continue
+        certain[u] = True
+        if u == target:
+            tolerance = 1e-4 * costs[target]
+        cost_u = costs[u]
+        for v in neighbours[u]:
+            if not certain[v]:
+                new_cost = rnd(weights[v] + cost_u)
+                if new_cost < costs[v]:
+                    costs[v] = new_cost
+                    heapq.heappush(priority_queue, (new_cost + heuristic[v], v))
 
-    is_unique = num_path[-1, -1] == 1
+    def dijkstra_pred(v):
+        # The optimal neighbour that dijkstra pops first
+        return min(
+            (costs[u], u)
+            for u in neighbours[v]
+            if certain[u] and rnd(weights[v] + costs[u]) == costs[v] and (costs[u], u) < (costs[v], v)
+        )[1]
 
     if request_transitions:
-        return DijkstraOutput(
-            shortest_path=on_path, is_unique=is_unique, transitions=transitions
-        )
+        pred = [dijkstra_pred(v) if certain[v] and v != 0 else -1 for v in range(N)]
     else:
-        return DijkstraOutput(
-            shortest_path=on_path, is_unique=is_unique, transitions=None
-        )
+        pred = [-1] * N
+        cur = target
+        while cur != 0:
+            pred[cur] = dijkstra_pred(cur)
+            cur = pred[cur]
 
+    return DijkstraOutput(
+        shortest_path=_on_path(matrix, pred),
+        is_unique=None,
+        transitions=_transitions_dict(pred, y_max) if request_transitions else None,
+    )
+
+
+# Cached, so that ray.remote only wraps (and exports) each solver once
+@lru_cache(maxsize=None)
+def get_solver(neighbourhood_fn, request_transitions, search="dijkstra"):
+    search_fn = astar if search == "astar" else dijkstra
 
-def get_solver(neighbourhood_fn, request_transitions):
     def solver(matrix):
-        return dijkstra(matrix, neighbourhood_fn, request_transitions).shortest_path
+        return search_fn(matrix, neighbourhood_fn, request_transitions).shortest_path
 
     return solver
 
 
+_RAY_FUNCTIONS = {}
+
+
 def maybe_parallelize(function, arg_list):
-    if ray.is_initialized():
-        ray_fn = ray.remote(function)
+    if ray is not None and ray.is_initialized():
+        if function not in _RAY_FUNCTIONS:
+            _RAY_FUNCTIONS[function] = ray.remote(function)
+        ray_fn = _RAY_FUNCTIONS[function]
         return ray.get([ray_fn.remote(arg) for arg in arg_list])
     else:
         return [function(arg) for arg in arg_list]
@@ -111,17 +253,40 @@ def compute_shortest_path(
     neighbourhood_fn="8-grid",
     request_transitions=False,
     debug=False,
+    solver="dijkstra",
+    num_workers=None,
 ):
-    solver = get_solver(neighbourhood_fn, request_transitions)
-    weights = batch_weights_BHW.detach().cpu().numpy()
+    """
+    solver:
+    - "dijkstra" solves each grid separately on CPU (in parallel with ray if initialized)
+    - "astar" is the same as "dijkstra", with goal-directed search
+    - "pool" solves the grids with dijkstra in chunks on a persistent pool of num_workers processes (default: all CPUs)
+    - "batched" solves all grids at once with tensor operations on the device of the weights
+    All give the same paths.
+    """
     if debug:
         start = time.time()
-    shortest_paths = np.asarray(maybe_parallelize(solver, arg_list=list(weights)))
+    if solver == "batched":
+        # Imported here since these modules depend on this one
+        from expressive.experiments.path_planning.batched_shortest_path import batched_shortest_path
+
+        shortest_paths = batched_shortest_path(batch_weights_BHW.detach(), neighbourhood_fn).shortest_path
+    elif solver == "pool":
+        from expressive.experiments.path_planning.pool_backend import get_pool
+
+        weights = batch_weights_BHW.detach().cpu().numpy()
+        shortest_paths = torch.from_numpy(get_pool(num_workers).solve(weights, neighbourhood_fn))
+    elif solver in ["dijkstra", "astar"]:
+        weights = batch_weights_BHW.detach().cpu().numpy()
+        shortest_paths = np.asarray(
+            maybe_parallelize(get_solver(neighbourhood_fn, request_transitions, solver), arg_list=list(weights))
+        )
+        shortest_paths = torch.from_numpy(shortest_paths)
+    else:
+        raise ValueError(f"Unknown shortest path solver {solver}")
     if debug:
         end = time.time()
-        print(f"Number of paths: {len(weights)}")
+        print(f"Number of paths: {len(batch_weights_BHW)}")
         print(f"Time taken: {end - start} seconds")
-    shortest_paths = (
-        torch.from_numpy(shortest_paths).float().to(batch_weights_BHW.device)
-    )
+    shortest_paths = shortest_paths.float().to(batch_weights_BHW.device)
     return shortest_paths
@@ -1,17 +1,16 @@
 import multiprocessing
 
-import pandas as pd
-
 from expressive.args import PathPlanningEvalArguments
+from expressive.eval_harness import ResultWriter, evaluate_checkpoints
 from expressive.experiments.path_planning.absorbing_path import create_nesy_diffusion
 from expressive.methods.logger import (
     TestLog,
     TestLogger,
 )
 from expressive.experiments.path_planning.path_planning import eval
+from expressive.experiments.path_planning.pool_backend import get_pool
 from expressive.util import get_device
 from torch.utils.data import DataLoader
-import ray
 import torch
 
 from expressive.experiments.path_planning.data.dataloader import get_datasets
@@ -20,31 +19,44 @@ from expressive.experiments.path_planning.data.dataloader import get_datasets
 args = PathPlanningEvalArguments(explicit_bool=True).parse_args()
 print(args)
 
-all_results = []
+# Created once per (worker) process
+_MODEL = None
 
-if __name__ == "__main__":
+
+def evaluate_run(job: dict) -> dict:
+    global _MODEL
     device = get_device(args)
+    if _MODEL is None:
+        _MODEL = create_nesy_diffusion(args).to(device)
+    path = f"{args.model_dir}/{job['run_id']}/model_{job['epoch']}.pth"
+    _MODEL.load_state_dict(torch.load(path, map_location=device))
+    print(f"Loaded model from {path}")
 
-    if args.use_ray:
-        ray.init(num_cpus=multiprocessing.cpu_count())
+    dataset = test if args.test else val
+    loader = DataLoader(dataset, args.batch_size_test, collate_fn=dataset.collate)
+    prefix = "test" if args.test else "val"
+    test_logger = TestLogger(TestLog, args, prefix, enable_wandb=False)
+    return eval(loader, test_logger, _MODEL, device, args)
 
-    model = create_nesy_diffusion(args).to(device)
-    _, val, test = get_datasets(args.grid_size)
 
-    for run_id, eval_at_epoch in zip(args.run_ids, args.eval_at_epoch):
-        model.load_state_dict(torch.load(f"{args.model_dir}/{run_id}/model_{eval_at_epoch}.pth"))
-        print(f"Loaded model from {args.model_dir}/{run_id}/model_{eval_at_epoch}.pth")
+if __name__ == "__main__":
+    if args.eval_workers > 0 and args.use_ray and args.shortest_path_solver in ["dijkstra", "astar"]:
+        # ray can not be used from forked workers, so they share the pool of solver processes instead (same paths)
+        print(f"Using the pool shortest path solver instead of {args.shortest_path_solver} with ray")
+        args.shortest_path_solver = "pool"
+    if args.shortest_path_solver == "pool":
+        # One pool of solver processes, started before the workers are forked and shared by all of them
+        get_pool(args.shortest_path_workers, num_clients=max(args.eval_workers, 1))
+    elif args.use_ray and args.shortest_path_solver in ["dijkstra", "astar"]:
+        import ray
+
+        ray.init(num_cpus=multiprocessing.cpu_count())
 
-        loader = DataLoader(test, args.batch_size_test) if args.test else DataLoader(test, args.batch_size_test)
-        prefix = "test" if args.test else "val"
-        test_logger = TestLogger(TestLog, args, prefix, enable_wandb=False)
-        result = eval(loader, test_logger, model, device, args)
-        result['run_id'] = run_id
-        print(result)
-        all_results.append(result)
+    # Loaded once, and shared by all evaluations
+    _, val, test = get_datasets(args.grid_size, mmap=args.mmap_data)
 
     split_name = "test" if args.test else "val"
-    results_df = pd.DataFrame(all_results)
-    results_df.to_csv(f"out/all_results_{args.eval_name}_{split_name}.csv", index=False)
-    print(f"All results saved to {args.eval_name}_{split_name}.csv")
-
+    writer = ResultWriter(f"out/all_results_{args.eval_name}_{split_name}.csv", resume=args.resume_eval)
+    jobs = [{"run_id": run_id, "epoch": epoch} for run_id, epoch in zip(args.run_ids, args.eval_at_epoch)]
+    evaluate_checkpoints(jobs, evaluate_run, writer, args.eval_workers)
+    print(f"All results saved to {writer.csv_path}")
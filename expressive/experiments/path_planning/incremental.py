@@ -0,0 +1,162 @@
+import heapq
+import math
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+from torch import Tensor
+
+from expressive.experiments.path_planning.dijkstra import _neighbour_lists, _on_path, _rounding
+
+
+class LifelongPlanner:
+    """
+    Lifelong Planning A* (Koenig et al., 2004) without heuristic, for a single node-weighted grid,
+     from the top-left to the bottom-right cell.
+
+    Keeps the cost-to-come g of every cell and its one-step lookahead rhs (the cheapest cost to enter the cell from a
+     neighbour) between calls. When cell costs change, only the rhs of the changed cells is updated,
+     and the search repairs just the cells whose cost actually changes.
+
+    Gives the same paths as dijkstra: the search continues until all cells that can be as cheap as the target are
+     consistent, and predecessors are chosen as dijkstra does, as the optimal neighbour with the lowest (cost, index).
+    """
+
+    def __init__(self, matrix: np.ndarray, neighbourhood_fn: str = "8-grid"):
+        self.matrix = matrix.copy()
+        x_max, y_max = matrix.shape
+        self.N = x_max * y_max
+        self.neighbours = _neighbour_lists(x_max, y_max, neighbourhood_fn)
+        self.rnd = _rounding(matrix.dtype)
+        self.weights: List[float] = matrix.ravel().tolist()
+        self.g = [math.inf] * self.N
+        self.rhs = [math.inf] * self.N
+        self.rhs[0] = self.weights[0]
+        # Current key of every cell in the queue, None if it is not in the queue. Outdated heap entries are skipped
+        self.queue_key: List[Optional[float]] = [None] * self.N
+        self.queue = [(self.rhs[0], 0)]
+        self.queue_key[0] = self.rhs[0]
+
+    def _update_rhs(self, v: int):
+        if v == 0:
+            self.rhs[0] = self.weights[0]
+        else:
+            g, w, rnd = self.g, self.weights[v], self.rnd
+            self.rhs[v] = min((rnd(w + g[u]) for u in self.neighbours[v] if g[u] < math.inf), default=math.inf)
+        self._update_queue(v)
+
+    def _update_queue(self, v: int):
+        if self.g[v] != self.rhs[v]:
+            key = min(self.g[v], self.rhs[v])
+            if self.queue_key[v] != key:
+                self.queue_key[v] = key
+                heapq.heappush(self.queue, (key, v))
+        else:
+            self.queue_key[v] = None
+
+    def update(self, matrix: np.ndarray) -> int:
+        """Sets new cell costs. Returns the number of changed cells."""
+        changed = np.flatnonzero(matrix != self.matrix).tolist()
+        self.matrix = matrix.copy()
+        self.weights = matrix.ravel().tolist()
+        for v in changed:
+            self._update_rhs(v)
+        return len(changed)
+
+    def _compute(self):
+        g, rhs, queue, queue_key = self.g, self.rhs, self.queue, self.queue_key
+        target = self.N - 1
+        # Continue while cells with the cost of the target could still become consistent, so ties are resolved
+        while queue and (queue[0][0] <= g[target] or g[target] != rhs[target]):
+            key, u = heapq.heappop(queue)
+            if queue_key[u] != key:
+                continue
+            queue_key[u] = None
+            if g[u] > rhs[u]:
+                g[u] = rhs[u]
+                for v in self.neighbours[u]:
+                    if v != 0:
+                        new_cost = self.rnd(self.weights[v] + g[u])
+                        if new_cost < rhs[v]:
+                            rhs[v] = new_cost
+                            self._update_queue(v)
+            else:
+                old_g = g[u]
+                g[u] = math.inf
+                self._update_rhs(u)
+                for v in self.neighbours[u]:
+                    # Only cells whose cheapest entry came through u can change
+                    if v != 0 and rhs[v] == self.rnd(self.weights[v] + old_g):
+                        self._update_rhs(v)
+
+    def shortest_path(self) -> np.ndarray:
+        self._compute()
+        g, rnd = self.g, self.rnd
+        pred = [-1] * self.N
+        cur = self.N - 1
+        while cur != 0:
+            w = self.weights[cur]
+            # The optimal neighbour that dijkstra pops first
+            pred[cur] = min(
+                (g[u], u)
+                for u in self.neighbours[cur]
+                if g[u] < math.inf and rnd(w + g[u]) == g[cur] and (g[u], u) < (g[cur], cur)
+            )[1]
+            cur = pred[cur]
+        return _on_path(self.matrix, pred)
+
+
+class IncrementalShortestPath:
+    """
+    Stateful shortest path solver for a batch of grids that changes in few cells between calls,
+     such as the samples of w along a sampling trajectory.
+    Keeps a LifelongPlanner per position in the batch, and repairs it with the new costs of the grid at the same position.
+    Grids where more than max_changed_fraction of the cells changed are solved from scratch, as repairing is
+     slower than searching again beyond a few changed cells (on 30x30 grids, around 5).
+    """
+
+    def __init__(self, neighbourhood_fn: str = "8-grid", max_changed_fraction: float = 0.01):
+        self.neighbourhood_fn = neighbourhood_fn
+        self.max_changed_fraction = max_changed_fraction
+        self.planners: List[Optional[LifelongPlanner]] = []
+
+    def reset(self):
+        self.planners = []
+
+    def __call__(self, batch_weights_BHW: Tensor) -> Tensor:
+        weights = batch_weights_BHW.detach().cpu().numpy()
+        if len(self.planners) != len(weights):
+            self.planners = [None] * len(weights)
+        paths = []
+        for i, matrix in enumerate(weights):
+            planner = self.planners[i]
+            if (
+                planner is None
+                or planner.matrix.shape != matrix.shape
+                or planner.matrix.dtype != matrix.dtype
+                or np.count_nonzero(matrix != planner.matrix) > self.max_changed_fraction * planner.N
+            ):
+                planner = LifelongPlanner(matrix, self.neighbourhood_fn)
+            else:
+                planner.update(matrix)
+            self.planners[i] = planner
+            paths.append(planner.shortest_path())
+        return torch.from_numpy(np.asarray(paths)).float().to(batch_weights_BHW.device)
+
+
+class IncrementalSolvers:
+    """
+    One IncrementalShortestPath per batch size, so that the different calls of y_from_w during sampling
+     (eg. the K candidates of rejection sampling, and the S samples) each keep their own state.
+    """
+
+    def __init__(self, neighbourhood_fn: str = "8-grid", max_changed_fraction: float = 0.01):
+        self.neighbourhood_fn = neighbourhood_fn
+        self.max_changed_fraction = max_changed_fraction
+        self.solvers: Dict[int, IncrementalShortestPath] = {}
+
+    def __call__(self, batch_weights_BHW: Tensor) -> Tensor:
+        size = batch_weights_BHW.shape[0]
+        if size not in self.solvers:
+            self.solvers[size] = IncrementalShortestPath(self.neighbourhood_fn, self.max_changed_fraction)
+        return self.solvers[size](batch_weights_BHW)
@@ -1,21 +1,23 @@
-import glob
+from functools import partial
 import multiprocessing
-import os
 import time
+from typing import Tuple
 
 from expressive.args import PathPlanningArguments
+from expressive.checkpoint import CheckpointManager, resume
 from expressive.experiments.path_planning.absorbing_path import PathAbsorbing, create_nesy_diffusion
+from expressive.methods.evaluation import eval_chunks
 from expressive.methods.logger import (
     TestLog,
     TrainingLog,
     TestLogger,
     TrainLogger,
 )
+from expressive.prefetch import Prefetcher, loader_worker_kwargs
 from expressive.util import get_device
 from torch.utils.data import DataLoader
 import torch
 import wandb
-import ray
 
 from expressive.experiments.path_planning.data.dataloader import get_datasets
 
@@ -25,6 +27,11 @@ def get_cost_labels(costs: torch.Tensor, args: PathPlanningArguments) -> torch.T
         torch.abs(costs.unsqueeze(-1) - torch.tensor(args.costs, device=costs.device)), dim=-1
     )
 
+def prepare_batch(batch, args: PathPlanningArguments) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    imgs, paths, costs = batch
+    # Convert costs into label indices based on possible cost values
+    return imgs, paths, get_cost_labels(costs, args)
+
 def eval(
     loader: DataLoader,
     logger: TestLog,
@@ -33,16 +40,15 @@ def eval(
     args: PathPlanningArguments,
 ):
     print("Number of eval batches:", len(loader))
-    for i, batch in enumerate(loader):
-        imgs, paths, costs = batch
+    prefetcher = Prefetcher(loader, partial(prepare_batch, args=args), device, args.prefetch_lookahead)
+    for i, (imgs, paths, cost_labels) in enumerate(
+        eval_chunks(prefetcher, args.eval_memory_budget, args.eval_chunk_size)
+    ):
         try:
-            # Convert costs into label indices based on possible cost values
-            cost_labels = get_cost_labels(costs, args)
-
             model.evaluate(
-                imgs.to(device),
-                paths.to(device),
-                cost_labels.to(device),
+                imgs,
+                paths,
+                cost_labels,
                 logger.log,
             )
         except ValueError as e:
@@ -59,7 +65,9 @@ if __name__ == "__main__":
     args = PathPlanningArguments(explicit_bool=True).parse_args()
     device = get_device(args)
 
-    if args.use_ray:
+    if args.use_ray and args.shortest_path_solver in ["dijkstra", "astar"]:
+        import ray
+
         ray.init(num_cpus=multiprocessing.cpu_count())
 
     run = wandb.init(
@@ -74,26 +82,16 @@ if __name__ == "__main__":
     print(args)
 
     model = create_nesy_diffusion(args).to(device)
-    if args.wandb_resume_id is not None:
-        # model.load_state_dict(torch.load(args.load_model))
-        # List all model files and find latest epoch
-        model_files = glob.glob(f"{args.model_dir}/{args.wandb_resume_id}/model_*.pth")
-        if not model_files:
-            raise ValueError(f"No model files found in {args.model_dir}/{args.wandb_resume_id}")
-            
-        # Extract epoch numbers and find max
-        epochs = [int(f.split('model_')[-1].replace('.pth','')) for f in model_files]
-        latest_epoch = max(epochs)
-        model.load_state_dict(torch.load(f"{args.model_dir}/{args.wandb_resume_id}/model_{latest_epoch}.pth"))
-        print(f"Loaded model from {args.model_dir}/{args.wandb_resume_id}/model_{latest_epoch}.pth")
-
-    train, val, test = get_datasets(args.grid_size)
+
+    train, val, test = get_datasets(args.grid_size, mmap=args.mmap_data)
 
     if args.DEBUG:
         print("DEBUG MODE")
 
-    train_loader = DataLoader(train, args.batch_size, shuffle=True)
-    val_loader = DataLoader(val, args.batch_size_test, shuffle=True)
+    loader_kwargs = loader_worker_kwargs(args.num_workers, args.persistent_workers)
+    train_loader = DataLoader(train, args.batch_size, shuffle=True, collate_fn=train.collate, **loader_kwargs)
+    val_loader = DataLoader(val, args.batch_size_test, shuffle=True, collate_fn=val.collate, **loader_kwargs)
+    train_prefetcher = Prefetcher(train_loader, partial(prepare_batch, args=args), device, args.prefetch_lookahead)
 
     log_iterations = len(train_loader) // args.log_per_epoch
     if log_iterations == 0:
@@ -113,16 +111,21 @@ if __name__ == "__main__":
             model.parameters(), lr=args.lr,
         )
 
-    for epoch in range(1, args.epochs + 1):
+    start_epoch = 1
+    if args.wandb_resume_id is not None:
+        # Load the latest checkpoint, including the optimizer state
+        start_epoch = resume(
+            f"{args.model_dir}/{args.wandb_resume_id}", model, optim, exact=args.exact_resume, map_location=device
+        ) + 1
+
+    checkpoints = CheckpointManager(f"models/{run.id}", keep_last=args.keep_checkpoints, on_saved=wandb.save)
+
+    for epoch in range(start_epoch, args.epochs + 1):
         print(f"Epoch {epoch}")
         start_epoch_time = time.time()
-        for i, batch in enumerate(train_loader):
+        for i, (x, label, cost_labels) in enumerate(train_prefetcher):
             optim.zero_grad()
-            grid, label, costs = batch
-
-            x = grid.to(device)
-            label = label.to(device)
-            loss = model.loss(x, label.long(), train_logger.log, get_cost_labels(costs, args).to(device))
+            loss = model.loss(x, label.long(), train_logger.log, cost_labels)
             loss.backward()
             optim.step()
 
@@ -141,14 +144,12 @@ if __name__ == "__main__":
 
             if args.save_model:
                 print(f"Saving model to {run.id}")
-                os.makedirs(f"models/{run.id}", exist_ok=True)
-                path = f"models/{run.id}/model_{epoch}.pth"
-                torch.save(model.state_dict(), path)
-                wandb.save(path)
+                checkpoints.save(epoch, model, optim)
 
 
-    test_loader = DataLoader(test, args.batch_size_test, shuffle=True)
+    test_loader = DataLoader(test, args.batch_size_test, shuffle=True, collate_fn=test.collate, **loader_kwargs)
     test_logger = TestLogger(TestLog, args, "test")
     print("----- TESTING -----")
     print(eval(test_loader, test_logger, model, device, args))
+    checkpoints.close()
 
@@ -0,0 +1,189 @@
+import atexit
+import multiprocessing
+import os
+import queue
+import traceback
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing.util import Finalize
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from expressive.experiments.path_planning.dijkstra import dijkstra
+
+# Shared memory blocks attached by this solver process, by client slot: (weights name, weights, paths)
+_ATTACHED: Dict[int, Tuple[str, SharedMemory, SharedMemory]] = {}
+
+
+def _attach(slot: int, weights_name: str, paths_name: str) -> Tuple[SharedMemory, SharedMemory]:
+    # A new pair of buffers of a client means its old ones were released
+    if slot in _ATTACHED and _ATTACHED[slot][0] != weights_name:
+        _detach(slot)
+    if slot not in _ATTACHED:
+        # The solver processes share the resource tracker of the parent, which owns (and unlinks) the block
+        _ATTACHED[slot] = (weights_name, SharedMemory(name=weights_name), SharedMemory(name=paths_name))
+    return _ATTACHED[slot][1:]
+
+
+def _detach(slot: int):
+    _, weights_shm, paths_shm = _ATTACHED.pop(slot)
+    weights_shm.close()
+    paths_shm.close()
+
+
+def _solve_chunk(
+    slot: int,
+    weights_name: str,
+    paths_name: str,
+    shape: Tuple[int, int, int],
+    dtype: str,
+    start: int,
+    end: int,
+    neighbourhood_fn: str,
+):
+    weights_shm, paths_shm = _attach(slot, weights_name, paths_name)
+    weights_BHW = np.ndarray(shape, dtype=dtype, buffer=weights_shm.buf)
+    paths_BHW = np.ndarray(shape, dtype=dtype, buffer=paths_shm.buf)
+    for b in range(start, end):
+        paths_BHW[b] = dijkstra(weights_BHW[b], neighbourhood_fn).shortest_path
+
+
+def _serve(tasks, replies):
+    """Loop of a solver process: solves the chunks of tasks, and replies to the slot of their client, until None"""
+    for task in iter(tasks.get, None):
+        slot = task[0]
+        try:
+            _solve_chunk(*task)
+            replies[slot].put(None)
+        except Exception:
+            replies[slot].put(traceback.format_exc())
+    for slot in list(_ATTACHED):
+        _detach(slot)
+
+
+class ShortestPathPool:
+    """
+    Solves batches of grids with dijkstra on a persistent pool of solver processes.
+
+    The grids are copied once into a shared memory buffer, and each solver process solves a contiguous chunk of it,
+     writing the paths in place into a second shared buffer. Only the buffer names and chunk bounds are sent
+     to the solver processes, so the overhead per call does not depend on the number or size of the grids.
+    The buffers are reused between calls, and only reallocated when a larger batch arrives.
+
+    The pool can be shared by num_clients processes forked from the one that creates it (eg. evaluation workers):
+     they send their chunks to the same solver processes, and each uses its own buffers and reply queue (slot).
+    """
+
+    def __init__(self, num_workers: Optional[int] = None, chunks_per_worker: int = 1, num_clients: int = 1):
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.chunks_per_worker = chunks_per_worker
+        # The pool may be started from a process that already runs threads (prefetcher, checkpoint writer)
+        #  and has CUDA initialised, which is not safe to fork. The solver processes only need numpy and dijkstra
+        context = multiprocessing.get_context("forkserver")
+        self.tasks = context.Queue()
+        self.replies = [context.SimpleQueue() for _ in range(num_clients)]
+        self.free_slots = context.Queue()
+        for slot in range(num_clients):
+            self.free_slots.put(slot)
+        self.processes = [
+            context.Process(target=_serve, args=(self.tasks, self.replies), daemon=True)
+            for _ in range(self.num_workers)
+        ]
+        for process in self.processes:
+            process.start()
+        self.owner_pid = os.getpid()
+        # Process that the slot and buffers below belong to
+        self.client_pid: Optional[int] = None
+        self.slot: Optional[int] = None
+        self.weights_shm: Optional[SharedMemory] = None
+        self.paths_shm: Optional[SharedMemory] = None
+
+    def _claim(self):
+        if self.client_pid == os.getpid():
+            return
+        if self.client_pid is not None:
+            # Forked from a client: the slot and buffers are those of the parent, which releases them
+            self.weights_shm = self.paths_shm = None
+        self.client_pid = os.getpid()
+        try:
+            self.slot = self.free_slots.get(timeout=60)
+        except queue.Empty:
+            raise RuntimeError(f"All {len(self.replies)} client slots of the shortest path pool are in use")
+        if self.client_pid != self.owner_pid:
+            # Forked clients (eg. evaluation workers) exit without atexit, but with the finalizers of multiprocessing
+            Finalize(self, self._release_client, exitpriority=10)
+
+    def _buffers(self, nbytes: int) -> Tuple[SharedMemory, SharedMemory]:
+        if self.weights_shm is None or self.weights_shm.size < nbytes:
+            self._release()
+            self.weights_shm = SharedMemory(create=True, size=nbytes)
+            self.paths_shm = SharedMemory(create=True, size=nbytes)
+        return self.weights_shm, self.paths_shm
+
+    def solve(self, weights_BHW: np.ndarray, neighbourhood_fn: str = "8-grid") -> np.ndarray:
+        self._claim()
+        B = weights_BHW.shape[0]
+        weights_shm, paths_shm = self._buffers(max(weights_BHW.nbytes, 1))
+        shared_weights_BHW = np.ndarray(weights_BHW.shape, dtype=weights_BHW.dtype, buffer=weights_shm.buf)
+        shared_weights_BHW[:] = weights_BHW
+
+        num_chunks = min(self.num_workers * self.chunks_per_worker, B)
+        bounds = np.linspace(0, B, num_chunks + 1, dtype=int)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            self.tasks.put(
+                (
+                    self.slot,
+                    weights_shm.name,
+                    paths_shm.name,
+                    weights_BHW.shape,
+                    weights_BHW.dtype.str,
+                    start,
+                    end,
+                    neighbourhood_fn,
+                )
+            )
+        errors = [self.replies[self.slot].get() for _ in range(num_chunks)]
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise RuntimeError(f"Shortest path solver failed:\n{errors[0]}")
+        paths_BHW = np.ndarray(weights_BHW.shape, dtype=weights_BHW.dtype, buffer=paths_shm.buf)
+        return paths_BHW.copy()
+
+    def _release(self):
+        for shm in [self.weights_shm, self.paths_shm]:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self.weights_shm = self.paths_shm = None
+
+    def _release_client(self):
+        self._release()
+        if self.slot is not None:
+            self.free_slots.put(self.slot)
+            self.slot = None
+
+    def close(self):
+        if os.getpid() != self.owner_pid:
+            self._release_client()
+            return
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+        self._release()
+
+
+_POOL: Optional[ShortestPathPool] = None
+
+
+def get_pool(num_workers: Optional[int] = None, num_clients: int = 1) -> ShortestPathPool:
+    """
+    Returns the pool shared by all calls of compute_shortest_path, starting it on first use.
+    num_workers and num_clients are only used when the pool is started: to share one pool between processes
+     (eg. the workers of evaluate_checkpoints), start it before they are forked, with one client per process.
+    """
+    global _POOL
+    if _POOL is None:
+        _POOL = ShortestPathPool(num_workers, num_clients=num_clients)
+        atexit.register(_POOL.close)
+    return _POOL
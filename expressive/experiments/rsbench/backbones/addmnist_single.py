@@ -1,6 +1,7 @@
 import torch.nn
 from torch import nn
 from backbones.base.ops import *
+from backbones.onehot_linear import one_hot_linear, unexpand
 
 
 class MNISTSingleEncoder(nn.Module):
@@ -173,19 +174,35 @@ class MNISTNeSyDiffClassifier(nn.Module):
             out_features=self.c_dim,
         )
 
-    def forward(self, x_encodings, w_0_BWD, image_to_classify: int = -1):
-        w_0_1_BD = w_0_BWD[..., 0, :]
-        w_0_2_BD = w_0_BWD[..., 1, :]
+    def forward(self, x_encodings, w_0_BW, image_to_classify: int = -1):
+        # dense_c is applied to the one-hot encodings of both w (including the mask value), then the encodings.
+        #  The one-hot inputs are never built, see one_hot_linear
+        num_values = self.c_dim + 1
+        w_swapped_BW = w_0_BW.flip(-1)
         if self.embed_all_images:
             # Commutativity equivariance: Ensure the image to classify is always the first one, then share weights
             # Ie, this predicts p(y_1|x_1, x_2, w) = f(w, x_1, x_2), and p(y_2|x_1, x_2, w) = f(w, x_2, x_1)
-            c1 = self.dense_c(torch.cat((w_0_1_BD, w_0_2_BD, x_encodings), dim=-1))
-            encoding_split = torch.split(x_encodings, x_encodings.size(-1) // self.n_images, dim=-1)
-            c2 = self.dense_c(torch.cat((w_0_2_BD, w_0_1_BD, encoding_split[1], encoding_split[0]), dim=-1))
+            c1 = one_hot_linear(self.dense_c, x_encodings, w_0_BW, num_values, w_first=True)
+            encoding_split = torch.split(unexpand(x_encodings), x_encodings.size(-1) // self.n_images, dim=-1)
+            c2 = one_hot_linear(
+                self.dense_c, torch.cat((encoding_split[1], encoding_split[0]), dim=-1), w_swapped_BW, num_values, w_first=True
+            )
             return torch.stack([c1, c2], dim=-2)
 
         if image_to_classify == 0:
-            return self.dense_c(torch.cat((w_0_1_BD, w_0_2_BD, x_encodings), dim=-1))
+            return one_hot_linear(self.dense_c, x_encodings, w_0_BW, num_values, w_first=True)
         elif image_to_classify == 1:
-            return self.dense_c(torch.cat((w_0_2_BD, w_0_1_BD, x_encodings), dim=-1))
-        raise ValueError(f"Invalid image to classify: {image_to_classify}")
\ No newline at end of file
+            return one_hot_linear(self.dense_c, x_encodings, w_swapped_BW, num_values, w_first=True)
+        raise ValueError(f"Invalid image to classify: {image_to_classify}")
+
+    def forward_grouped(self, x_encodings, w_0_BW):
+        """
+        Classifies all images at once, given the encodings of all images concatenated (as split in the disentangled
+         backbone). The same as calling forward(encoding_split[i], w_0_BW, i) for every image i and stacking,
+         but dense_c (shared by the images) runs once on the inputs of all images.
+        """
+        assert not self.embed_all_images
+        # For image i, its own w comes first
+        w_BIW = torch.stack([w_0_BW, w_0_BW.flip(-1)], dim=-2)
+        x_BIE = x_encodings.unflatten(-1, (self.n_images, -1))
+        return one_hot_linear(self.dense_c, x_BIE, w_BIW, self.c_dim + 1, w_first=True)
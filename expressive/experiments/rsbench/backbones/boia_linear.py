@@ -1,6 +1,7 @@
 from typing import Optional
 import torch
 import torch.nn as nn
+from backbones.onehot_linear import one_hot_linear
 
 
 """
@@ -105,18 +106,19 @@ class BOIAConceptizerMLP(nn.Module):
         encoded_1: predicted known concepts
     """
 
-    def forward(self, x, one_hot_w_SBWD: Optional[torch.Tensor] = None):
-        if one_hot_w_SBWD is not None:
-            one_hot_w_SBWtD = one_hot_w_SBWD.view(one_hot_w_SBWD.shape[:-2] + (-1,))
-            p = torch.cat((x, one_hot_w_SBWtD), dim=-1)
+    def forward(self, x, w_SBW: Optional[torch.Tensor] = None):
+        if w_SBW is not None:
+            # enc1 on x concatenated with the one-hot encoding of w (including the mask value)
+            num_values = (self.din - x.shape[-1]) // w_SBW.shape[-1]
+            p = one_hot_linear(self.enc1, x, w_SBW, num_values)
         else:
             # resize
-            p = x.view(x.size(0), -1)
+            p = self.enc1(x.view(x.size(0), -1))
 
-        p = self.dropout(self.relu(self.enc1(p)))
+        p = self.dropout(self.relu(p))
         logits_c = self.classifier(p)
 
-        if one_hot_w_SBWD is not None:
+        if w_SBW is not None:
             logits_c = logits_c.unsqueeze(-1)
             # For compatibility with later softmax
             # Since softmax([0, l])[1] = sigmoid(l)
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from backbones.onehot_linear import one_hot_linear
+
 
 class MNISTAdditionCNN(nn.Module):
     def __init__(self):
@@ -44,17 +46,15 @@ class EntangledDiffusionClassifier(nn.Module):
         self.fc1 = nn.Linear(32 * 7 * 14 + n_images * (n_classes + 1), 128)
         self.fc2 = nn.Linear(128, 64)
         self.fc3 = nn.Linear(64, n_images * n_classes)
-        self.softmax = nn.Softmax(dim=1)
         self.n_images = n_images
         self.n_classes = n_classes
 
-    def forward(self, w_BWD: torch.Tensor, x_encoding: torch.Tensor):
-        x = torch.cat((x_encoding, torch.reshape(w_BWD, w_BWD.shape[:-2] + (-1,))), dim=-1)
-        x = F.relu(self.fc1(x))
+    def forward(self, x_encoding: torch.Tensor, w_BW: torch.Tensor):
+        # fc1 on x concatenated with the one-hot encoding of w (including the mask value)
+        x = F.relu(one_hot_linear(self.fc1, x_encoding, w_BW, self.n_classes + 1))
         x = F.relu(self.fc2(x))
-        x = self.fc3(x).reshape(w_BWD.shape[:-2] + (self.n_images, self.n_classes))
-        x = self.softmax(x)
-        return x
+        # Logits per image, like the other classifiers: distribution applies the softmax over the classes
+        return self.fc3(x).reshape(x.shape[:-1] + (self.n_images, self.n_classes))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,36 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def unexpand(x: torch.Tensor) -> torch.Tensor:
+    # Keeps a single copy of leading dimensions that are expanded (stride 0), eg. the encodings repeated per sample
+    for d in range(x.dim() - 1):
+        if x.stride(d) == 0 and x.shape[d] > 1:
+            x = x.narrow(d, 0, 1)
+    return x
+
+
+def one_hot_linear(
+    linear: nn.Linear, x: torch.Tensor, w: torch.Tensor, num_values: int, w_first: bool = False
+) -> torch.Tensor:
+    """
+    Computes linear(cat(x, one_hot(w, num_values).flatten(-2))) (or with the one-hot first, if w_first)
+     without building the one-hot input or the concatenation:
+    - The one-hot block of the input selects one column of the weight per position of w, so its contribution is
+       a sum of gathered columns (embedding_bag).
+    - The x block is computed on x with its expanded dimensions removed, so once per batch rather than once per sample,
+       and broadcast.
+    Uses the parameters of linear as they are, so it works with existing checkpoints.
+    x: (..., E), w: integer (..., W), with broadcastable leading dimensions.
+    """
+    E, W = x.shape[-1], w.shape[-1]
+    w_columns = slice(0, W * num_values) if w_first else slice(E, E + W * num_values)
+    x_columns = slice(W * num_values, W * num_values + E) if w_first else slice(0, E)
+    x_out = F.linear(unexpand(x), linear.weight[:, x_columns], linear.bias)
+
+    # Row i * num_values + v of the table is the column of value v at position i
+    table = linear.weight[:, w_columns].t()
+    index = w.long() + torch.arange(W, device=w.device) * num_values
+    w_out = F.embedding_bag(index.reshape(-1, W), table, mode="sum").reshape(w.shape[:-1] + (-1,))
+    return x_out + w_out
@@ -0,0 +1,56 @@
+# Checks that looking up the MNIST datasets through the registry of datasets/ does not import the heavy modules
+#  that only other datasets need. Each dataset is looked up in a fresh interpreter, so earlier imports do not hide
+#  a regression. Exits with an error if any heavy module is imported.
+# Usage: python check_lazy_imports.py
+import subprocess
+import sys
+
+MNIST_DATASETS = ["addmnist", "halfmnist", "restrictedmnist", "shortmnist"]
+
+# Prefixes of the modules that the MNIST datasets should not import
+HEAVY_MODULES = [
+    "clip",
+    "problog",
+    "models.sddoiadpl",
+    "expressive.experiments.rsbench.models.sddoiadpl",
+    "datasets.utils.kand_creation",
+    "datasets.utils.sddoia_creation",
+    "datasets.utils.presddoia_creation",
+    "datasets.utils.boia_creation",
+    "datasets.utils.clip_mnst_creation",
+]
+
+CHECK = """
+import sys
+from datasets import get_dataset_class
+get_dataset_class({name!r})
+heavy = {heavy!r}
+print("\\n".join(h for h in heavy if any(m == h or m.startswith(h + ".") for m in sys.modules)))
+"""
+
+
+def imported_heavy_modules(name: str):
+    result = subprocess.run(
+        [sys.executable, "-c", CHECK.format(name=name, heavy=HEAVY_MODULES)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout.split()
+
+
+def main():
+    failed = False
+    for name in MNIST_DATASETS:
+        modules = imported_heavy_modules(name)
+        if modules:
+            failed = True
+            print(f"{name} imports {', '.join(modules)}")
+        else:
+            print(f"{name} ok")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,39 @@
-import os
 import inspect
 import importlib
 from argparse import Namespace
 
-def get_all_datasets():
-    return [
-        data.split(".")[0]
-        for data in os.listdir("datasets")
-        if not data.find("__") > -1 and "py" in data
-    ]
+# Name of each dataset -> its module in datasets/. Modules are only imported when their dataset is requested,
+#  as some pull in heavy dependencies (CLIP, the problog DPL models, the KAND/SDDOIA creators)
+NAMES = {
+    "addmnist": "addmnist",
+    "boia": "boia",
+    "clipboia": "clipboia",
+    "clipsddoia": "clipsddoia",
+    "clipshortmnist": "clipshortcutmnist",
+    "halfmnist": "halfmnist",
+    "mnmath": "mnmath",
+    "presddoia": "presddoia",
+    "restrictedmnist": "restrictedmnist",
+    "shortmnist": "shortcutmnist",
+    "xor": "xor",
+}
 
 
-NAMES = {}
-for dataset in get_all_datasets():
-    dat = importlib.import_module("datasets." + dataset)
-
-    dataset_classes_name = [
-        x
-        for x in dat.__dir__()
-        if "type" in str(type(getattr(dat, x)))
-        and "BaseDataset" in str(inspect.getmro(getattr(dat, x))[1:])
-    ]
-    for d in dataset_classes_name:
-        c = getattr(dat, d)
-        NAMES[c.NAME] = c
+def get_dataset_class(name: str):
+    """
+    Imports the module of dataset name, and returns its dataset class
+    """
+    assert name in NAMES, f"{name} in {list(NAMES)}"
+    dat = importlib.import_module("datasets." + NAMES[name])
+    for x in dat.__dir__():
+        c = getattr(dat, x)
+        if (
+            inspect.isclass(c)
+            and "BaseDataset" in str(inspect.getmro(c)[1:])
+            and getattr(c, "NAME", None) == name
+        ):
+            return c
+    raise ValueError(f"Module datasets.{NAMES[name]} does not define dataset {name}")
 
 
 def get_dataset(args: Namespace):
@@ -32,5 +42,4 @@ def get_dataset(args: Namespace):
     :param args: the arguments which contains the hyperparameters
     :return: the continual dataset
     """
-    assert args.dataset in NAMES.keys(), f"{args.dataset} in {NAMES}"
-    return NAMES[args.dataset](args)
+    return get_dataset_class(args.dataset)(args)
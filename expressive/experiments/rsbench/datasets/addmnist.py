@@ -1,5 +1,5 @@
 from datasets.utils.base_dataset import BaseDataset, get_loader
-from datasets.utils.mnist_creation import load_2MNIST
+from datasets.utils.mnist_creation import cached_2MNIST_splits, load_2MNIST
 from backbones.addmnist_joint import MNISTPairsEncoder, MNISTPairsDecoder
 from backbones.addmnist_repeated import MNISTRepeatedEncoder
 from backbones.addmnist_single import MNISTSingleEncoder
@@ -12,9 +12,8 @@ class ADDMNIST(BaseDataset):
     DATADIR = "data/raw"
 
     def get_data_loaders(self):
-        dataset_train, dataset_val, dataset_test = load_2MNIST(
-            c_sup=self.args.c_sup, which_c=self.args.which_c, args=self.args
-        )
+        splits = cached_2MNIST_splits(self.NAME, self.build_splits, self.args)
+        dataset_train, dataset_val, dataset_test = (splits[split] for split in ["train", "val", "test"])
 
         self.dataset_train = dataset_train
         self.dataset_val = dataset_val
@@ -28,6 +27,12 @@ class ADDMNIST(BaseDataset):
 
         return self.train_loader, self.val_loader, self.test_loader
 
+    def build_splits(self):
+        dataset_train, dataset_val, dataset_test = load_2MNIST(
+            c_sup=self.args.c_sup, which_c=self.args.which_c, args=self.args
+        )
+        return {"train": dataset_train, "val": dataset_val, "test": dataset_test}
+
     def get_backbone(self):
         if self.args.joint:
             if not self.args.splitted:
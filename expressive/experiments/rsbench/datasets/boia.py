@@ -1,11 +1,12 @@
+import os
 from argparse import Namespace
 
-from typing import Tuple
+from typing import List, Tuple
 
 import torch
 from torch._C import Size
 from datasets.utils.base_dataset import BaseDataset, BOIA_get_loader
-from datasets.utils.boia_creation import BOIADataset
+from datasets.utils.boia_creation import BOIADataset, PackedBOIADataset, packed_paths
 from datasets.utils.sddoia_creation import CONCEPTS_ORDER
 from backbones.boia_linear import BOIAConceptizer, BOIAConceptizerMLP
 from backbones.boia_mlp import BOIAMLP
@@ -15,6 +16,10 @@ from expressive.experiments.rsbench.models.sddoiadpl import SDDOIADPL
 from torch.nn import functional as F
 import torch.nn as nn
 
+# Splits packed by pack_boia.py
+PACKED_DIR = "data/bdd2048/packed"
+
+
 class BOIA(BaseDataset):
     NAME = "boia"
 
@@ -27,6 +32,35 @@ class BOIA(BaseDataset):
     def get_data_loaders(self):
         start = time.time()
 
+        if getattr(self.args, "boia_packed", False):
+            self.load_packed(PACKED_DIR)
+        else:
+            self.load_per_sample()
+
+        print(f"Loaded datasets in {time.time()-start} s.")
+
+        print(
+            "Len loaders: \n train:",
+            len(self.dataset_train),
+            "\n val:",
+            len(self.dataset_val),
+        )
+        print(" len test:", len(self.dataset_test))
+
+        workers = self.worker_kwargs(default_workers=0)
+        self.train_loader = BOIA_get_loader(
+            self.dataset_train, self.args.batch_size, val_test=False, **workers
+        )
+        self.val_loader = BOIA_get_loader(
+            self.dataset_val, self.args.batch_size, val_test=True, **workers
+        )
+        self.test_loader = BOIA_get_loader(
+            self.dataset_test, self.args.batch_size, val_test=True, **workers
+        )
+
+        return self.train_loader, self.val_loader, self.test_loader
+
+    def load_per_sample(self):
         image_dir = "data/bdd2048/"
         train_data_path = "data/bdd2048/train_BDD_OIA.pkl"
         val_data_path = "data/bdd2048/val_BDD_OIA.pkl"
@@ -62,27 +96,17 @@ class BOIA(BaseDataset):
             transform=None,
         )
 
-        print(f"Loaded datasets in {time.time()-start} s.")
-
-        print(
-            "Len loaders: \n train:",
-            len(self.dataset_train),
-            "\n val:",
-            len(self.dataset_val),
-        )
-        print(" len test:", len(self.dataset_test))
-
-        self.train_loader = BOIA_get_loader(
-            self.dataset_train, self.args.batch_size, val_test=False
-        )
-        self.val_loader = BOIA_get_loader(
-            self.dataset_val, self.args.batch_size, val_test=True
-        )
-        self.test_loader = BOIA_get_loader(
-            self.dataset_test, self.args.batch_size, val_test=True
+    def load_packed(self, packed_dir):
+        for split in ["train", "val", "test"]:
+            if not os.path.exists(packed_paths(packed_dir, split)["index"]):
+                raise FileNotFoundError(
+                    f"No packed {split} split in {packed_dir}, create it with python pack_boia.py"
+                )
+        self.dataset_train = PackedBOIADataset(
+            packed_dir, "train", c_sup=self.args.c_sup, which_c=self.args.which_c
         )
-
-        return self.train_loader, self.val_loader, self.test_loader
+        self.dataset_val = PackedBOIADataset(packed_dir, "val")
+        self.dataset_test = PackedBOIADataset(packed_dir, "test")
 
     def get_backbone(self):
         if self.args.backbone == "neural":
@@ -110,20 +134,12 @@ class BOIA(BaseDataset):
         return (3, 4)
 
     def y_from_w(self, w_SBW: torch.Tensor) -> torch.Tensor:
-        # Stupid hack: Do full probabilistic inference on deterministic 'distributions' over concepts, then pick argmax
-        one_hot_w_SBW2 = F.one_hot(w_SBW, num_classes=2)
-        one_hot_w_StBW2 = one_hot_w_SBW2.reshape(-1, w_SBW.shape[-1], 2)
-        one_hot_w_StBWt2 = one_hot_w_StBW2.reshape(-1, w_SBW.shape[-1]*2)
-
-        y_StB8 = self.dpl_model.problog_inference(one_hot_w_StBWt2.float())
-        y_SB8 = y_StB8
-        if len(w_SBW.shape) > 2:
-            y_SB8 = y_StB8.reshape(w_SBW.shape[:-1] + (8,))
-        fs_SB = torch.max(y_SB8[..., :4], dim=-1)[1]
-        l_SB = torch.max(y_SB8[..., 4:6], dim=-1)[1]
-        r_SB = torch.max(y_SB8[..., 6:8], dim=-1)[1]
-
-        return torch.stack([fs_SB, l_SB, r_SB], dim=-1)
+        # w is deterministic, so each label is a lookup on the world of its concepts
+        return self.dpl_model.deterministic_inference(w_SBW)
+
+    def y_factorisation(self) -> List[Tuple[List[int], List[int]]]:
+        # Forward/stop from concepts 0-8, left from 9-14, right from 15-20
+        return [(list(range(0, 9)), [0]), (list(range(9, 15)), [1]), (list(range(15, 21)), [2])]
 
     def get_backbone_nesydiff(self) -> Tuple[nn.Module, nn.Module]:
         n_concepts = self.get_w_dim()[0]
@@ -1,5 +1,5 @@
 from datasets.utils.base_dataset import BaseDataset, get_loader
-from datasets.utils.clip_mnst_creation import load_2MNIST
+from datasets.utils.clip_mnst_creation import cached_2MNIST_splits, load_2MNIST
 from backbones.identity import Identity
 from backbones.addmnist_joint import MNISTPairsEncoder, MNISTPairsDecoder
 from backbones.addmnist_single import MNISTSingleEncoder
@@ -18,14 +18,11 @@ class CLIPSHORTMNIST(BaseDataset):
     DATADIR = "data/raw"
 
     def get_data_loaders(self):
-        dataset_train, dataset_val, dataset_test = load_2MNIST(
-            c_sup=self.args.c_sup, which_c=self.args.which_c, args=self.args
+        splits = cached_2MNIST_splits(self.NAME, self.build_splits, self.args)
+        dataset_train, dataset_val, dataset_test, ood_test = (
+            splits[split] for split in ["train", "val", "test", "ood"]
         )
 
-        ood_test = self.get_ood_test(dataset_test)
-
-        self.filtrate(dataset_train, dataset_val, dataset_test)
-
         self.dataset_train = dataset_train
         self.dataset_val = dataset_val
         self.dataset_test = dataset_test
@@ -40,6 +37,17 @@ class CLIPSHORTMNIST(BaseDataset):
 
         return self.train_loader, self.val_loader, self.test_loader
 
+    def build_splits(self):
+        dataset_train, dataset_val, dataset_test = load_2MNIST(
+            c_sup=self.args.c_sup, which_c=self.args.which_c, args=self.args
+        )
+
+        ood_test = self.get_ood_test(dataset_test)
+
+        self.filtrate(dataset_train, dataset_val, dataset_test)
+
+        return {"train": dataset_train, "val": dataset_val, "test": dataset_test, "ood": ood_test}
+
     def get_backbone(self):
         if self.args.joint:
             if self.args.backbone == "neural":
@@ -1,6 +1,6 @@
 import torch
 from datasets.utils.base_dataset import BaseDataset, get_loader
-from datasets.utils.mnist_creation import load_2MNIST
+from datasets.utils.mnist_creation import cached_2MNIST_splits, load_2MNIST
 from backbones.addmnist_joint import MNISTPairsEncoder, MNISTPairsDecoder
 from backbones.addmnist_single import MNISTNeSyDiffClassifier, MNISTNeSyDiffEncoder, MNISTSingleEncoder
 from backbones.mnistcnn import EntangledDiffusionClassifier, EntangledDiffusionEncoder, MNISTAdditionCNN
@@ -14,14 +14,9 @@ class HALFMNIST(BaseDataset):
     DATADIR = "data/raw"
 
     def get_data_loaders(self):
-        dataset_train, dataset_val, dataset_test = load_2MNIST(
-            c_sup=self.args.c_sup, which_c=self.args.which_c, args=self.args
-        )
-
-        ood_test = self.get_ood_test(dataset_test)
-
-        dataset_train, dataset_val, dataset_test = self.filtrate(
-            dataset_train, dataset_val, dataset_test
+        splits = cached_2MNIST_splits(self.NAME, self.build_splits, self.args)
+        dataset_train, dataset_val, dataset_test, ood_test = (
+            splits[split] for split in ["train", "val", "test", "ood"]
         )
 
         self.dataset_train = dataset_train
@@ -29,15 +24,29 @@ class HALFMNIST(BaseDataset):
         self.dataset_test = dataset_test
         self.ood_test = ood_test
 
+        workers = self.worker_kwargs(default_workers=4)
         self.train_loader = get_loader(
-            dataset_train, self.args.batch_size, val_test=False
+            dataset_train, self.args.batch_size, val_test=False, **workers
         )
-        self.val_loader = get_loader(dataset_val, self.args.batch_size, val_test=True)
-        self.test_loader = get_loader(dataset_test, self.args.batch_size, val_test=True)
-        self.ood_loader = get_loader(ood_test, self.args.batch_size, val_test=True)
+        self.val_loader = get_loader(dataset_val, self.args.batch_size, val_test=True, **workers)
+        self.test_loader = get_loader(dataset_test, self.args.batch_size, val_test=True, **workers)
+        self.ood_loader = get_loader(ood_test, self.args.batch_size, val_test=True, **workers)
 
         return self.train_loader, self.val_loader, self.test_loader
 
+    def build_splits(self):
+        dataset_train, dataset_val, dataset_test = load_2MNIST(
+            c_sup=self.args.c_sup, which_c=self.args.which_c, args=self.args
+        )
+
+        ood_test = self.get_ood_test(dataset_test)
+
+        dataset_train, dataset_val, dataset_test = self.filtrate(
+            dataset_train, dataset_val, dataset_test
+        )
+
+        return {"train": dataset_train, "val": dataset_val, "test": dataset_test, "ood": ood_test}
+
     def get_ood_loaders(self):
         return [self.ood_loader]
 
@@ -1,6 +1,6 @@
 import torch
 from datasets.utils.base_dataset import BaseDataset, get_loader
-from datasets.utils.mnist_creation import load_2MNIST
+from datasets.utils.mnist_creation import cached_2MNIST_splits, load_2MNIST
 from backbones.addmnist_joint import MNISTPairsEncoder, MNISTPairsDecoder
 from backbones.addmnist_single import MNISTNeSyDiffClassifier, MNISTNeSyDiffEncoder, MNISTSingleEncoder
 from backbones.mnistcnn import EntangledDiffusionClassifier, EntangledDiffusionEncoder, MNISTAdditionCNN
@@ -19,15 +19,11 @@ class SHORTMNIST(BaseDataset):
         if self.args.model == "mnistcbm":
             which_c = [4, 9, 3, 8]
 
-        dataset_train, dataset_val, dataset_test = load_2MNIST(
-            c_sup=self.args.c_sup, which_c=self.args.which_c, args=self.args
+        splits = cached_2MNIST_splits(self.NAME, self.build_splits, self.args)
+        dataset_train, dataset_val, dataset_test, ood_test, ood_test_2 = (
+            splits[split] for split in ["train", "val", "test", "ood", "ood_2"]
         )
 
-        ood_test = self.get_ood_test(dataset_test)
-        ood_test_2 = self.get_ood_test_2(dataset_test)
-
-        self.filtrate(dataset_train, dataset_val, dataset_test)
-
         self.dataset_train = dataset_train
         self.dataset_val = dataset_val
         self.dataset_test = dataset_test
@@ -36,27 +32,47 @@ class SHORTMNIST(BaseDataset):
 
         self._compute_class_weights()
 
+        workers = self.worker_kwargs(default_workers=4)
         self.train_loader = get_loader(
             dataset_train,
             self.args.batch_size,
             val_test=False,
             sampler=self.train_sampler,
+            **workers,
         )
         self.val_loader = get_loader(
-            dataset_val, self.args.batch_size, val_test=True, sampler=self.val_sampler
+            dataset_val, self.args.batch_size, val_test=True, sampler=self.val_sampler, **workers
         )
         self.test_loader = get_loader(
-            dataset_test, self.args.batch_size, val_test=True, sampler=self.test_sampler
+            dataset_test, self.args.batch_size, val_test=True, sampler=self.test_sampler, **workers
         )
         self.ood_loader = get_loader(
-            ood_test, self.args.batch_size, val_test=False, sampler=self.ood_sampler
+            ood_test, self.args.batch_size, val_test=False, sampler=self.ood_sampler, **workers
         )
         self.ood_loader_2 = get_loader(
-            ood_test_2, self.args.batch_size, val_test=False, sampler=self.ood_sampler_2
+            ood_test_2, self.args.batch_size, val_test=False, sampler=self.ood_sampler_2, **workers
         )
 
         return self.train_loader, self.val_loader, self.test_loader
 
+    def build_splits(self):
+        dataset_train, dataset_val, dataset_test = load_2MNIST(
+            c_sup=self.args.c_sup, which_c=self.args.which_c, args=self.args
+        )
+
+        ood_test = self.get_ood_test(dataset_test)
+        ood_test_2 = self.get_ood_test_2(dataset_test)
+
+        self.filtrate(dataset_train, dataset_val, dataset_test)
+
+        return {
+            "train": dataset_train,
+            "val": dataset_val,
+            "test": dataset_test,
+            "ood": ood_test,
+            "ood_2": ood_test_2,
+        }
+
     def get_ood_loaders(self):
         return [self.ood_loader, self.ood_loader_2]
 
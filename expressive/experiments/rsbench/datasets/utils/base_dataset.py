@@ -3,12 +3,14 @@ from argparse import Namespace
 from torch import nn as nn
 from torchvision.transforms import transforms
 from torch.utils.data import DataLoader
-from typing import Tuple, List
+from typing import Tuple, List, Optional
 from torchvision import datasets
 import numpy as np
 import torch.optim
 from torch.utils.data import WeightedRandomSampler
 
+from expressive.prefetch import loader_worker_kwargs
+
 
 class BaseDataset:
     """
@@ -69,12 +71,29 @@ class BaseDataset:
     def y_from_w(self, w_SBW: torch.Tensor) -> torch.Tensor:
         pass
 
+    def y_factorisation(self) -> Optional[List[Tuple[List[int], List[int]]]]:
+        """
+        Groups of concepts and the labels that only depend on them, used to tabulate y_from_w.
+        None if y_from_w is tabulated over all concepts at once.
+        """
+        return None
+
     @abstractmethod
     def get_backbone_nesydiff(self) -> Tuple[nn.Module, nn.Module]:
         pass
 
+    def worker_kwargs(self, default_workers: int) -> dict:
+        """
+        Returns the DataLoader worker settings from the arguments (if they configure them)
+        """
+        return loader_worker_kwargs(
+            getattr(self.args, "num_workers", None),
+            getattr(self.args, "persistent_workers", False),
+            default_workers,
+        )
+
 
-def get_loader(dataset, batch_size, num_workers=4, val_test=False, sampler=None):
+def get_loader(dataset, batch_size, num_workers=4, val_test=False, sampler=None, persistent_workers=False):
 
     if val_test:
         return torch.utils.data.DataLoader(
@@ -84,6 +103,8 @@ def get_loader(dataset, batch_size, num_workers=4, val_test=False, sampler=None)
             num_workers=num_workers,
             drop_last=False,
             sampler=sampler,
+            persistent_workers=persistent_workers,
+            collate_fn=getattr(dataset, "collate", None),
         )
     else:
         use_shuffle = True
@@ -113,11 +134,12 @@ def get_loader(dataset, batch_size, num_workers=4, val_test=False, sampler=None)
             )
 
         return DataLoader(
-            dataset, batch_size=batch_size, num_workers=num_workers, sampler=sampler, shuffle=use_shuffle
+            dataset, batch_size=batch_size, num_workers=num_workers, sampler=sampler, shuffle=use_shuffle,
+            persistent_workers=persistent_workers, collate_fn=getattr(dataset, "collate", None),
         )
 
 
-def KAND_get_loader(dataset, batch_size, val_test=False, preprocess=False):
+def KAND_get_loader(dataset, batch_size, val_test=False, preprocess=False, num_workers=0, persistent_workers=False):
 
     if val_test:
         return DataLoader(
@@ -125,10 +147,19 @@ def KAND_get_loader(dataset, batch_size, val_test=False, preprocess=False):
             shuffle=False,
             batch_size=batch_size,
             drop_last=False,
-            num_workers=0,
+            num_workers=num_workers,
+            persistent_workers=persistent_workers,
+            collate_fn=getattr(dataset, "collate", None),
         )
     else:
-        return DataLoader(dataset, shuffle=True, batch_size=batch_size, num_workers=0)
+        return DataLoader(
+            dataset,
+            shuffle=True,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            persistent_workers=persistent_workers,
+            collate_fn=getattr(dataset, "collate", None),
+        )
 
 
 def SDDOIA_get_loader(dataset, batch_size, num_workers=4, val_test=False):
@@ -139,6 +170,7 @@ def SDDOIA_get_loader(dataset, batch_size, num_workers=4, val_test=False):
             batch_size=batch_size,
             num_workers=num_workers,
             drop_last=False,
+            collate_fn=getattr(dataset, "collate", None),
         )
     else:
         return DataLoader(
@@ -146,10 +178,11 @@ def SDDOIA_get_loader(dataset, batch_size, num_workers=4, val_test=False):
             shuffle=True,
             batch_size=batch_size,
             num_workers=num_workers,
+            collate_fn=getattr(dataset, "collate", None),
         )
 
 
-def BOIA_get_loader(dataset, batch_size, val_test):
+def BOIA_get_loader(dataset, batch_size, val_test, num_workers=0, persistent_workers=False):
     if val_test:
         drop_last = False
         shuffle = False
@@ -158,7 +191,10 @@ def BOIA_get_loader(dataset, batch_size, val_test):
         shuffle = True
 
     return DataLoader(
-        dataset, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last
+        dataset, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last,
+        num_workers=num_workers, persistent_workers=persistent_workers,
+        # Datasets that read whole batches (PackedBOIADataset) collate them themselves
+        collate_fn=getattr(dataset, "collate", None),
     )
 
 
@@ -1,10 +1,21 @@
+import json
+import os
+import pickle
+from contextlib import ExitStack
+
+import numpy as np
 import torch
 import torch.utils.data
 from torch.utils.data import Dataset
-import pickle
+from datasets.utils.memmap_dataset import MemmapDataset
 from datasets.utils.mnist_creation import generate_r_seq
-from datasets.utils.sddoia_creation import CONCEPTS_ORDER
-
+from datasets.utils.sddoia_creation import (
+    CONCEPTS_ORDER,
+    SUPERVISED_CONCEPTS,
+    mask_concept_supervision,
+    mask_split_supervision,
+)
+from expressive.atomic import atomic_write
 
 class BOIADataset(Dataset):
     """
@@ -87,36 +98,83 @@ class BOIADataset(Dataset):
         #     self.numel += 1
 
         # filter for the concept supervision given
-
-        if self.c_sup != 1:
-            if self.r_seq[idx] > self.c_sup:
-                attr_label[:] = -1
-            elif not (self.which_c[0] == -1):
-                # print("entro?")
-                for c in range(attr_label.shape[0]):
-                    if c not in self.which_c:
-                        attr_label[c] = -1
-            else:
-                # self.numel += 1
-                for k, order in CONCEPTS_ORDER.items():
-                    if k not in [
-                        "red_light",
-                        "green_light",
-                        "car",
-                        "person",
-                        "rider",
-                        "other_obstacle",
-                        "stop_sign",
-                        "right_green_light",
-                        "left_green_light",
-                    ]:
-                        attr_label[order] = -1
+        attr_label = mask_concept_supervision(attr_label[None], self.r_seq[idx : idx + 1], self.c_sup, self.which_c)[0]
 
         class_label = class_label[:4]
 
         return img, class_label, attr_label
 
 
+def packed_paths(packed_dir, split):
+    """Files of a packed split: features, labels, concepts (.npy) and the index of image paths (.json)"""
+    return {
+        name: os.path.join(packed_dir, f"{split}_{name}.{'json' if name == 'index' else 'npy'}")
+        for name in ["features", "labels", "concepts", "index"]
+    }
+
+
+def pack_boia_split(pkl_file_path, image_dir, packed_dir, split, features_dtype="float32"):
+    """
+    Converts a split stored as one .pt file per sample and per field (as read by BOIADataset) into contiguous arrays:
+     features (N, 2048) in features_dtype, labels and concepts, in the order of the pkl file,
+     and an index with the image path of each row.
+    Rows are streamed into memory-mapped files, which are only moved in place once complete.
+    """
+    with open(pkl_file_path, "rb") as f:
+        data = pickle.load(f)
+    img_paths = [sample["img_path"] for sample in data]
+    paths = packed_paths(packed_dir, split)
+    os.makedirs(packed_dir, exist_ok=True)
+
+    def load(field, img_path):
+        return torch.load(f"{image_dir}/{field}/{img_path[:-4]}.pt").squeeze(0).numpy()
+
+    with ExitStack() as stack:
+        outputs = {}
+        for name, field, dtype in [
+            ("features", "inputs", np.dtype(features_dtype)),
+            ("labels", "labels", None),
+            ("concepts", "concepts", None),
+        ]:
+            first = load(field, img_paths[0])
+            outputs[name] = np.lib.format.open_memmap(
+                stack.enter_context(atomic_write(paths[name])),
+                mode="w+",
+                dtype=dtype or first.dtype,
+                shape=(len(img_paths),) + first.shape,
+            )
+        for i, img_path in enumerate(img_paths):
+            outputs["features"][i] = load("inputs", img_path)
+            outputs["labels"][i] = load("labels", img_path)
+            outputs["concepts"][i] = load("concepts", img_path)
+        for out in outputs.values():
+            out.flush()
+    with atomic_write(paths["index"]) as tmp_path, open(tmp_path, "w") as f:
+        json.dump(img_paths, f)
+
+
+class PackedBOIADataset(MemmapDataset):
+    """
+    BOIADataset on a split packed by pack_boia_split.
+    Features are memory-mapped, and labels and concepts (with the concept supervision already masked) are kept in memory.
+    """
+
+    def __init__(self, packed_dir, split, c_sup=1, which_c=[-1]):
+        paths = packed_paths(packed_dir, split)
+        super().__init__(paths["features"])
+        self.packed_dir = packed_dir
+        self.split = split
+        self.c_sup = c_sup
+        self.which_c = which_c
+        self.class_label = torch.from_numpy(np.load(paths["labels"]))[:, :4]
+        self.attr_label = mask_split_supervision(torch.from_numpy(np.load(paths["concepts"])), c_sup, which_c)
+
+    def make_batch(self, indices):
+        features = torch.from_numpy(self.read(indices)).float()
+        indices = torch.from_numpy(indices)
+        return features, self.class_label[indices], self.attr_label[indices]
+
+
 ## --------------------------------------------------------------------------------------------------------
 
 
@@ -11,6 +11,8 @@ from torchvision import datasets
 from tqdm import tqdm
 import copy, itertools
 
+from datasets.utils.split_cache import cached_splits, split_cache_key
+
 
 def get_label(c1, c2, labels, args):
     if args.task == "addition":
@@ -385,6 +387,31 @@ def load_2MNIST(
     return train_set, val_set, test_set
 
 
+def cached_2MNIST_splits(name, build, args, n_digits=10):
+    """
+    Returns the splits computed by build from load_2MNIST (eg. filtered, with OOD sets), materialised by cached_splits
+     and keyed by the dataset file, the CLIP features and the arguments they depend on.
+    With args.split_cache off, build is called directly.
+    """
+    if not getattr(args, "split_cache", True):
+        return build()
+    data_folder = os.path.join("data", f"2mnist_{n_digits}digits")
+    data_file = f"2mnist_{n_digits}digits.pt"
+    if not os.path.exists(os.path.join(data_folder, data_file)):
+        check_dataset(n_digits, data_folder, data_file, {"train": 42000, "val": 12000, "test": 6000})
+    features = [
+        os.path.join("data", "saved_activations", f"shortcutmnist_{split}_clip_ViT-B32_{i}.pt")
+        for split in ["train", "val", "test"]
+        for i in range(2)
+    ]
+    key = split_cache_key(
+        [os.path.join(data_folder, data_file)] + features,
+        task=getattr(args, "task", None),
+        model=getattr(args, "model", None),
+    )
+    return cached_splits(name, key, build, images=False)
+
+
 def generate_r_seq(size):
     # fixed since the seed is fixed
     return np.random.rand(size)
@@ -0,0 +1,87 @@
+import json
+import os
+from typing import List, Optional, Sequence, Union
+
+import numpy as np
+import torch
+from torchvision.datasets.folder import pil_loader
+
+from datasets.utils.memmap_dataset import MemmapDataset
+from expressive.atomic import atomic_write
+
+
+def image_store_paths(store_dir, split):
+    """Files of a packed split: images, labels, concepts (.npy) and the index of image paths and names (.json)"""
+    return {
+        name: os.path.join(store_dir, f"{split}_{name}.{'json' if name == 'index' else 'npy'}")
+        for name in ["images", "labels", "concepts", "index"]
+    }
+
+
+def decode_image(paths: Union[str, Sequence[str]]) -> np.ndarray:
+    """Decodes an image as uint8 (H, W, 3), or several images concatenated along the width"""
+    if isinstance(paths, str):
+        return np.asarray(pil_loader(paths))
+    return np.concatenate([np.asarray(pil_loader(path)) for path in paths], axis=1)
+
+
+def pack_image_split(
+    store_dir,
+    split,
+    image_paths: List[Union[str, List[str]]],
+    labels: np.ndarray,
+    concepts: np.ndarray,
+    names: Optional[List[str]] = None,
+    extra: Optional[dict] = None,
+):
+    """
+    Decodes the images of a split once (each entry of image_paths is a path, or a list of paths concatenated along
+     the width) into a memory-mapped uint8 array (N, H, W, 3), and stores labels and concepts as arrays.
+    Each file is written to a temporary file of this process and moved in place once complete, and the index
+     (image paths, names and extra) is written last, so a split is complete iff its index exists.
+    """
+    paths = image_store_paths(store_dir, split)
+    os.makedirs(store_dir, exist_ok=True)
+    first = decode_image(image_paths[0])
+    with atomic_write(paths["images"]) as tmp_path:
+        images = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=(len(image_paths),) + first.shape)
+        images[0] = first
+        for i in range(1, len(image_paths)):
+            images[i] = decode_image(image_paths[i])
+        images.flush()
+        del images
+    for name, array in [("labels", labels), ("concepts", concepts)]:
+        with atomic_write(paths[name]) as tmp_path:
+            np.save(tmp_path, np.asarray(array))
+    with atomic_write(paths["index"]) as tmp_path, open(tmp_path, "w") as f:
+        json.dump({"paths": image_paths, "names": names, **(extra or {})}, f)
+
+
+def is_packed(store_dir, split) -> bool:
+    return os.path.exists(image_store_paths(store_dir, split)["index"])
+
+
+class PackedImageDataset(MemmapDataset):
+    """
+    Split packed by pack_image_split. Images are memory-mapped, labels and concepts are kept in memory.
+    Batches of images are converted at once to float tensors (B, 3, H, W) in [0, 1], like ToTensor per image.
+    """
+
+    def __init__(self, store_dir, split):
+        paths = image_store_paths(store_dir, split)
+        assert os.path.exists(paths["index"]), f"{split} is not packed in {store_dir}"
+        super().__init__(paths["images"])
+        self.store_dir = store_dir
+        self.split = split
+        self.labels = np.load(paths["labels"])
+        self.concepts = np.load(paths["concepts"])
+        with open(paths["index"]) as f:
+            self.index = json.load(f)
+        self.list_images = self.index["paths"]
+
+    def make_batch(self, indices):
+        return (
+            torch.from_numpy(self.read(indices)).permute(0, 3, 1, 2).float().div(255),
+            torch.from_numpy(self.labels[indices]),
+            torch.from_numpy(self.concepts[indices]),
+        )
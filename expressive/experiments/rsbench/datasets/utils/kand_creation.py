@@ -8,6 +8,8 @@ from PIL import Image
 
 from torchvision.datasets.folder import pil_loader
 
+from datasets.utils.image_store import PackedImageDataset, pack_image_split
+
 import re
 
 import re
@@ -44,6 +46,52 @@ def clean_and_sort_filenames(filenames):
     return sorted_filenames
 
 
+def kand_meta_path(base_path, split, item):
+    return os.path.join(base_path, split, "meta", str(item).zfill(5) + ".joblib")
+
+
+def kand_image_path(base_path, split, item):
+    return os.path.join(base_path, split, "images", str(item).zfill(5) + ".png")
+
+
+def minikand_meta_path(base_path, split, item):
+    return os.path.join(base_path, split + "_meta", str(item).zfill(5) + ".joblib")
+
+
+def minikand_image_paths(base_path, split, item):
+    # The 9 images of a sample, concatenated along the width
+    return [os.path.join(base_path, split, str(item).zfill(5), str(i).zfill(5) + ".png") for i in range(9)]
+
+
+def read_kand_metas(meta_paths):
+    """
+    Returns the labels (N, 4) (the label of each figure, 3 * y[0] + y[1], and the label of the sample)
+     and the concepts (N, 3, 6) (the first two concepts of each figure) from the meta file of each sample
+    """
+    all_labels, all_concepts = [], []
+    for target_id in meta_paths:
+        meta = joblib.load(target_id)
+
+        label = meta["y"]
+        concepts, labels = [], []
+        for i in range(3):
+            concept = meta["fig" + str(i)]["c"][:2]
+            concepts.append(concept)
+
+            y = meta["fig" + str(i)]["y"]
+            y = 3 * y[0] + y[1]
+            labels.append(y)
+
+        labels.append(label)
+        labels = np.array(labels).reshape(1, -1)
+        all_labels.append(labels)
+
+        concepts = np.concatenate(concepts, axis=0).reshape(1, -1, 6)
+        all_concepts.append(concepts)
+
+    return np.concatenate(all_labels, axis=0), np.concatenate(all_concepts, axis=0)
+
+
 class KAND_Dataset(torch.utils.data.Dataset):
     def __init__(self, base_path, split, preprocess=False, finetuning=0):
 
@@ -64,35 +112,9 @@ class KAND_Dataset(torch.utils.data.Dataset):
         self.transform = transforms.Compose([transforms.ToTensor()])
         self.concept_mask = np.array([False] * len(self.list_images))
 
-        self.labels, self.concepts = [], []
-        for item in range(len(self.list_images)):
-            target_id = os.path.join(
-                self.base_path,
-                self.split,
-                "meta",
-                str(self.img_number[item]).zfill(5) + ".joblib",
-            )
-            meta = joblib.load(target_id)
-
-            label = meta["y"]
-            concepts, labels = [], []
-            for i in range(3):
-                concept = meta["fig" + str(i)]["c"][:2]
-                concepts.append(concept)
-
-                y = meta["fig" + str(i)]["y"]
-                y = 3 * y[0] + y[1]
-                labels.append(y)
-
-            labels.append(label)
-            labels = np.array(labels).reshape(1, -1)
-            self.labels.append(labels)
-
-            concepts = np.concatenate(concepts, axis=0).reshape(1, -1, 6)
-            self.concepts.append(concepts)
-
-        self.concepts = np.concatenate(self.concepts, axis=0)
-        self.labels = np.concatenate(self.labels, axis=0)
+        self.labels, self.concepts = read_kand_metas(
+            [kand_meta_path(self.base_path, self.split, item) for item in self.img_number]
+        )
 
         # self.metas=[]
         # for item in range(len(self.list_images)):
@@ -140,9 +162,7 @@ class KAND_Dataset(torch.utils.data.Dataset):
         concepts = self.concepts[item]
 
         img_id = self.img_number[item]
-        image_id = os.path.join(
-            self.base_path, self.split, "images", str(img_id).zfill(5) + ".png"
-        )
+        image_id = kand_image_path(self.base_path, self.split, img_id)
         image = pil_loader(image_id)
 
         if not self.preprocess:
@@ -244,37 +264,10 @@ class miniKAND_Dataset(torch.utils.data.Dataset):
         self.transform = transforms.Compose([transforms.ToTensor()])
         self.concept_mask = np.array([False] * len(self.list_images))
 
-        self.labels, self.concepts = [], []
-        for item in range(len(self.list_images)):
-            target_id = os.path.join(
-                self.base_path,
-                self.split + "_meta",
-                str(self.img_number[item]).zfill(5) + ".joblib",
-            )
-            meta = joblib.load(target_id)
-
-            label = meta["y"]
-            concepts, labels = [], []
-            for i in range(3):
-                concept = meta["fig" + str(i)]["c"][:2]
-                concepts.append(concept)
-
-                y = meta["fig" + str(i)]["y"]
-                y = 3 * (y[0]) + y[1]
-                labels.append(y)
-
-            labels.append(label)
-            labels = np.array(labels).reshape(1, -1)
-            self.labels.append(labels)
-
-            concepts = np.concatenate(concepts, axis=0).reshape(1, -1, 6)
-            self.concepts.append(concepts)
-
-        self.concepts = np.concatenate(self.concepts, axis=0)
-        import copy
-
-        self.original_concepts = copy.deepcopy(self.concepts)
-        self.labels = np.concatenate(self.labels, axis=0)
+        self.labels, self.concepts = read_kand_metas(
+            [minikand_meta_path(self.base_path, self.split, item) for item in self.img_number]
+        )
+        self.original_concepts = np.copy(self.concepts)
 
     def mask_concepts(self, cond, obj=None):
         start = self.finetuning
@@ -362,13 +355,7 @@ class miniKAND_Dataset(torch.utils.data.Dataset):
 
         img_id = self.img_number[item]
         all_imgs = []
-        for i in range(9):
-            image_id = os.path.join(
-                self.base_path,
-                self.split,
-                str(img_id).zfill(5),
-                str(i).zfill(5) + ".png",
-            )
+        for image_id in minikand_image_paths(self.base_path, self.split, img_id):
             image = pil_loader(image_id)
 
             # image = Image.open(image_id)
@@ -388,6 +375,54 @@ class miniKAND_Dataset(torch.utils.data.Dataset):
         return len(self.list_images)
 
 
+def pack_kand_split(base_path, store_dir, split):
+    """Packs the images, labels and concepts of a split read by KAND_Dataset into store_dir"""
+    n = len(glob.glob(os.path.join(base_path, split, "images", "*")))
+    labels, concepts = read_kand_metas([kand_meta_path(base_path, split, item) for item in range(n)])
+    pack_image_split(store_dir, split, [kand_image_path(base_path, split, item) for item in range(n)], labels, concepts)
+
+
+def pack_minikand_split(base_path, store_dir, split):
+    """Packs the images (the 9 of each sample concatenated), labels and concepts of a split read by miniKAND_Dataset"""
+    n = len(glob.glob(os.path.join(base_path, split, "*")))
+    labels, concepts = read_kand_metas([minikand_meta_path(base_path, split, item) for item in range(n)])
+    pack_image_split(
+        store_dir, split, [minikand_image_paths(base_path, split, item) for item in range(n)], labels, concepts
+    )
+
+
+class PackedKAND_Dataset(PackedImageDataset):
+    """KAND_Dataset on a split packed by pack_kand_split, with the same batches and concept masking"""
+
+    mask_concepts = KAND_Dataset.mask_concepts
+
+    def __init__(self, store_dir, split, preprocess=False, finetuning=0):
+        super().__init__(store_dir, split)
+        self.finetuning = finetuning
+        self.preprocess = preprocess
+        self.concept_mask = np.array([False] * len(self))
+
+    def make_batch(self, indices):
+        batch = super().make_batch(indices)
+        if not self.preprocess:
+            return batch
+        return (torch.as_tensor(indices),) + batch
+
+
+class PackedMiniKAND_Dataset(PackedImageDataset):
+    """miniKAND_Dataset on a split packed by pack_minikand_split, with the same batches and concept masking"""
+
+    mask_concepts = miniKAND_Dataset.mask_concepts
+    mask_concepts_specific = miniKAND_Dataset.mask_concepts_specific
+
+    def __init__(self, store_dir, split, preprocess=False, finetuning=0):
+        super().__init__(store_dir, split)
+        self.finetuning = finetuning
+        self.preprocess = preprocess
+        self.concept_mask = np.array([False] * len(self))
+        self.original_concepts = np.copy(self.concepts)
+
+
 class CLIP_KAND_Dataset(torch.utils.data.Dataset):
     def __init__(self, base_path, split, preprocess=False, finetuning=0):
         self.base_path = base_path
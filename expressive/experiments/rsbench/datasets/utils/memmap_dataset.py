@@ -0,0 +1,56 @@
+from typing import Optional, Tuple
+
+import numpy as np
+from torch.utils.data import Dataset
+
+
+class MemmapDataset(Dataset):
+    """
+    Dataset on an array memory-mapped from a .npy file (eg. the images of a split), with the other arrays kept in
+     memory by subclasses, which build a batch from the rows returned by read in make_batch.
+    Batches are built at once through __getitems__, and collate passes them on.
+    If rows is set, the dataset serves only these rows of the memory-mapped array.
+    """
+
+    def __init__(self, path: str, rows: Optional[np.ndarray] = None):
+        self.path = path
+        self.rows = rows
+        self.memmap = np.load(path, mmap_mode="r")
+
+    def __getstate__(self):
+        # Pickling a memory map copies its data, so workers started with spawn map the file again instead
+        state = self.__dict__.copy()
+        state["memmap"] = None
+        return state
+
+    def mapped(self) -> np.ndarray:
+        if self.memmap is None:
+            self.memmap = np.load(self.path, mmap_mode="r")
+        return self.memmap
+
+    def __len__(self):
+        return len(self.mapped() if self.rows is None else self.rows)
+
+    def read(self, indices: np.ndarray) -> np.ndarray:
+        """Rows of the memory-mapped array for indices of the dataset"""
+        memmap = self.mapped()
+        if self.rows is not None:
+            indices = self.rows[indices]
+        # Sorted indices read the memory map in order, the batch keeps the order of indices
+        order = np.argsort(indices)
+        rows = np.empty((len(indices),) + memmap.shape[1:], dtype=memmap.dtype)
+        rows[order] = memmap[indices[order]]
+        return rows
+
+    def make_batch(self, indices: np.ndarray) -> Tuple:
+        raise NotImplementedError
+
+    def __getitem__(self, idx):
+        return tuple(field[0] for field in self.__getitems__([idx]))
+
+    def __getitems__(self, indices):
+        return self.make_batch(np.asarray(indices))
+
+    @staticmethod
+    def collate(batch):
+        return batch
@@ -11,6 +11,8 @@ from torchvision import datasets
 from tqdm import tqdm
 import copy, itertools
 
+from datasets.utils.split_cache import cached_splits, split_cache_key
+
 
 def get_label(c1, c2, labels, args):
     if args.task == "addition":
@@ -217,6 +219,11 @@ def check_dataset(n_digits, data_folder, data_file, dataset_dim):
         print(f"Dataset saved in {data_folder}")
 
 
+def get_2MNIST_folder(n_digits=10):
+    data_folder = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(data_folder, f"2mnist_{n_digits}digits"), f"2mnist_{n_digits}digits.pt"
+
+
 def load_2MNIST(
     n_digits=10,
     dataset_dimensions={"train": 42000, "val": 12000, "test": 6000},
@@ -225,9 +232,7 @@ def load_2MNIST(
     args=None,
 ):
     # Load data
-    data_folder = os.path.dirname(os.path.abspath(__file__))
-    data_folder = os.path.join(data_folder, f"2mnist_{n_digits}digits")
-    data_file = f"2mnist_{n_digits}digits.pt"
+    data_folder, data_file = get_2MNIST_folder(n_digits)
 
     # Check whether dataset exists, if not build it
     check_dataset(n_digits, data_folder, data_file, dataset_dimensions)
@@ -242,6 +247,27 @@ def load_2MNIST(
     return train_set, val_set, test_set
 
 
+def cached_2MNIST_splits(name, build, args, n_digits=10):
+    """
+    Returns the splits computed by build from load_2MNIST (eg. filtered, with OOD sets), materialised by cached_splits
+     and keyed by the dataset file, the concept supervision sequence and the arguments they depend on.
+    With args.split_cache off, build is called directly.
+    """
+    if not getattr(args, "split_cache", True):
+        return build()
+    data_folder, data_file = get_2MNIST_folder(n_digits)
+    if not os.path.exists(os.path.join(data_folder, data_file)):
+        check_dataset(n_digits, data_folder, data_file, {"train": 42000, "val": 12000, "test": 6000})
+    key = split_cache_key(
+        [os.path.join(data_folder, data_file), "data/rn.npy"],
+        c_sup=args.c_sup,
+        which_c=args.which_c,
+        task=getattr(args, "task", None),
+        model=getattr(args, "model", None),
+    )
+    return cached_splits(name, key, build)
+
+
 def generate_r_seq(size):
     # fixed since the seed is fixed
     return np.random.rand(size)
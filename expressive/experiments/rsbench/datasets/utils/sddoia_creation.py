@@ -8,6 +8,8 @@ import matplotlib.pyplot as plt
 import json
 from torchvision.datasets.folder import pil_loader
 from datasets.utils.mnist_creation import generate_r_seq
+from preprocessing.feature_store import is_complete, load_features
+from datasets.utils.image_store import PackedImageDataset, pack_image_split
 
 
 CONCEPTS_ORDER = {
@@ -34,9 +36,109 @@ CONCEPTS_ORDER = {
     "clear": 2,
 }
 
+# Concepts that keep their supervision for samples with concept supervision, when which_c is not given
+SUPERVISED_CONCEPTS = [
+    "red_light",
+    "green_light",
+    "car",
+    "person",
+    "rider",
+    "other_obstacle",
+    "stop_sign",
+    "right_green_light",
+    "left_green_light",
+]
+
+
+def mask_concept_supervision(attr_label_NC, r_N, c_sup, which_c):
+    """
+    Sets the concept labels without supervision to -1, for a batch of samples with random numbers r_N:
+     all concepts of samples with r > c_sup, and the concepts not in which_c (or not in SUPERVISED_CONCEPTS) of the others.
+    """
+    if c_sup == 1:
+        return attr_label_NC
+    attr_label_NC = attr_label_NC.clone()
+    unsupervised_N = torch.as_tensor(np.asarray(r_N) > c_sup)
+    if which_c[0] != -1:
+        kept_C = torch.tensor([c in which_c for c in range(attr_label_NC.shape[1])])
+    else:
+        kept_C = torch.ones(attr_label_NC.shape[1], dtype=torch.bool)
+        kept_C[[order for k, order in CONCEPTS_ORDER.items() if k not in SUPERVISED_CONCEPTS]] = False
+    attr_label_NC[unsupervised_N[:, None] | ~kept_C[None, :]] = -1
+    return attr_label_NC
+
+
+def mask_split_supervision(attr_label_NC, c_sup, which_c, n_random=None):
+    """
+    mask_concept_supervision for all samples of a split, with the first numbers of generate_r_seq(n_random)
+     (by default, one per sample). The per-sample and the packed datasets of a split draw the same sequence,
+     so the same samples have concept supervision in both.
+    """
+    r_seq = generate_r_seq(len(attr_label_NC) if n_random is None else n_random)
+    return mask_concept_supervision(attr_label_NC, r_seq[: len(attr_label_NC)], c_sup, which_c)
+
+
 PREFIX = "MINI_BOIA_"
 
 
+def extract_number(path):
+    match = re.search(r"\d+", path)
+    return int(match.group()) if match else 0
+
+
+def read_sddoia_scenes(base_path, split, scenes_name="scenes"):
+    """
+    Reads the scene of each image of a split (sorted by number), and returns the paths of the images that have
+     a scene, their labels, concepts (in the order of CONCEPTS_ORDER) and names, and the number of images listed.
+    """
+    list_images = sorted(glob.glob(os.path.join(base_path, split, "*")), key=extract_number)
+
+    # sort the keys of the dictionary
+    sorted_concepts = sorted(CONCEPTS_ORDER, key=CONCEPTS_ORDER.get)
+
+    images, labels, concepts, names = [], [], [], []
+    for item in list_images:
+        name = os.path.splitext(os.path.basename(item))[0]
+        # extract the ids out of the images
+        target_id = name.split("_")[-1]
+
+        # get the target scene
+        target_scene = os.path.join(base_path, scenes_name, PREFIX + str(target_id) + ".json")
+        if not os.path.exists(target_scene):
+            continue
+
+        with open(target_scene, "r") as f:
+            # Load the JSON data
+            data = json.load(f)
+
+        c = data["concepts"]
+        images.append(item)
+        labels.append(np.array(data["label"]))
+        concepts.append(np.array([int(c[key]) for key in sorted_concepts]))
+        names.append(name)
+
+    return images, np.stack(labels, axis=0), np.stack(concepts, axis=0), np.stack(names, axis=0), len(list_images)
+
+
+def ood_k_indices(n):
+    """Indices of the 500 samples of the OOD knowledge split, drawn once and saved to data/random_indices.npy"""
+    # File path for saving/loading indices
+    indices_file = "data/random_indices.npy"
+
+    # Check if the indices file exists
+    if os.path.exists(indices_file):
+        print("Loading indices...")
+        # Load the indices from the file
+        return np.load(indices_file)
+
+    print("Saving indices...")
+    random_indices = np.random.choice(n, 500, replace=False)
+
+    # Save the random indices to a file
+    np.save(indices_file, random_indices)
+    return random_indices
+
+
 class SDDOIADataset(torch.utils.data.Dataset):
     def __init__(
         self,
@@ -52,168 +154,37 @@ class SDDOIADataset(torch.utils.data.Dataset):
         self.base_path = base_path
         self.split = split
 
-        # collecting images
-        self.list_images = glob.glob(os.path.join(self.base_path, self.split, "*"))
-        # sort the images
-        self.list_images = sorted(self.list_images, key=self._extract_number)
-
-
         # ok transform
         self.transform = transforms.Compose(
             [transforms.ToTensor()]
         )
-        self.labels, self.concepts = [], []
-
-        # sort the keys of the dictionary
-        sorted_concepts = sorted(CONCEPTS_ORDER, key=CONCEPTS_ORDER.get)
-
-        # lmao
-        new_images = self.list_images.copy()
 
         # whether to return the embeddings, means to return also the name of the image
         self.return_embeddings = return_embeddings
-        self.names = []
 
         scenes_name = "scenes"
         if is_ood_k:
             scenes_name = "scenes_ambulance"
 
         # extract labels and concepts
-        for item in self.list_images:
-            name = os.path.splitext(os.path.basename(item))[0]
-            # extract the ids out of the images
-            target_id = name.split("_")[-1]
-
-            # get the target scene
-            target_scene = os.path.join(
-                self.base_path,
-                scenes_name,
-                PREFIX + str(target_id) + ".json",
-            )
-
-            if not os.path.exists(target_scene):
-                new_images.remove(
-                    os.path.join(
-                        self.base_path, self.split, PREFIX + str(target_id) + ".png"
-                    )
-                )
-                continue
-
-            # concepts and labels
-            concepts, labels = [], []
-
-            with open(target_scene, "r") as f:
-                # Load the JSON data
-                data = json.load(f)
-
-            # take the label
-            label = data["label"]
-            c = data["concepts"]
-
-            # read out the concepts
-            concept_values = [int(c[key]) for key in sorted_concepts]
-
-            labels = np.array(label)
-            self.labels.append(labels)
-
-            concepts = np.array(concept_values)
-            self.concepts.append(concepts)
-
-            # append the name
-            self.names.append(name)
-
-        r_seq = generate_r_seq(len(self.list_images))
+        list_images, self.labels, self.concepts, self.names, n_listed = read_sddoia_scenes(
+            self.base_path, self.split, scenes_name
+        )
 
         # filter for the concept supervision given
-        numel = 0
-
-        if c_sup != 1:
-            for i in range(len(self.list_images)):
-                if r_seq[i] > c_sup:
-                    self.concepts[i][:] = -1
-                elif not (which_c[0] == -1):
-                    for c in range(self.concepts.shape[1]):
-                        if c not in which_c:
-                            self.concepts[i, c] = -1
-                else:
-                    numel += 1
-                    for k, order in CONCEPTS_ORDER.items():
-                        if k not in [
-                            "red_light",
-                            "green_light",
-                            "car",
-                            "person",
-                            "rider",
-                            "other_obstacle",
-                            "stop_sign",
-                            "right_green_light",
-                            "left_green_light",
-                        ]:
-                            self.concepts[i][order] = -1
-
-        # print("Giving supervision to", numel)
-
-        # print(self.concepts.shape)
-        self.concepts = np.stack(self.concepts, axis=0)
-        self.labels = np.stack(self.labels, axis=0)
-        self.list_images = np.array(new_images)
-        self.names = np.stack(self.names, axis=0)
+        self.concepts = mask_split_supervision(torch.from_numpy(self.concepts), c_sup, which_c, n_listed).numpy()
+        self.list_images = np.array(list_images)
 
         if is_ood_k:
-            # File path for saving/loading indices
-            indices_file = "data/random_indices.npy"
-
-            # Check if the indices file exists
-            if os.path.exists(indices_file):
-                print("Loading indices...")
-                # Load the indices from the file
-                random_indices = np.load(indices_file)
-            else:
-                print("Saving indices...")
-                # Get the total number of elements
-                # chosen_elements = []
-                # stop = []
-                # red = []
-                # solid_line = []
-                # to_insert = []
-
-                # for i in range(self.concepts.shape[0]):
-                #     if self.concepts[i, 3] or self.concepts[i, 4] or self.concepts[i, 11] or self.concepts[i, 17]:
-                #         to_insert.append(i)
-
-                #         if self.concepts[i, 3]:
-                #             red.append(i)
-                #         elif self.concepts[i, 4]:
-                #             stop.append(i)
-                #         else:
-                #             solid_line.append(i)
-                #     else:
-                #         chosen_elements.append(i)
-
-                # print(len(to_insert), len(red), len(stop), len(solid_line))
-
-                # # Select 500 random indices without replacement
-                # if len(to_insert) >= 500:
-                #     random_indices = to_insert
-                # else:
-                #     random_indices = np.random.choice(chosen_elements, 500 - len(to_insert), replace=False)
-
-                random_indices = np.random.choice(
-                    self.concepts.shape[0], 500, replace=False
-                )
-
-                # Save the random indices to a file
-                np.save(indices_file, random_indices)
-
             # Select elements at these random indices
+            random_indices = ood_k_indices(self.concepts.shape[0])
             self.concepts = self.concepts[random_indices]
             self.labels = self.labels[random_indices]
             self.list_images = self.list_images[random_indices]
             self.names = self.names[random_indices]
 
     def _extract_number(self, path):
-        match = re.search(r"\d+", path)
-        return int(match.group()) if match else 0
+        return extract_number(path)
 
     def __getitem__(self, item):
 
@@ -232,6 +203,58 @@ class SDDOIADataset(torch.utils.data.Dataset):
         return len(self.list_images)
 
 
+def packed_sddoia_split(split, is_ood_k=False):
+    return split + "_ambulance" if is_ood_k else split
+
+
+def pack_sddoia_split(base_path, store_dir, split, is_ood_k=False):
+    """
+    Packs the images with a scene of a split read by SDDOIADataset, with their labels, concepts (without masking)
+     and names, into store_dir. The scenes of the ambulance are packed as the split {split}_ambulance
+    """
+    images, labels, concepts, names, n_listed = read_sddoia_scenes(
+        base_path, split, "scenes_ambulance" if is_ood_k else "scenes"
+    )
+    pack_image_split(
+        store_dir,
+        packed_sddoia_split(split, is_ood_k),
+        images,
+        labels,
+        concepts,
+        names=names.tolist(),
+        extra={"n_listed": n_listed},
+    )
+
+
+class PackedSDDOIADataset(PackedImageDataset):
+    """
+    SDDOIADataset on a split packed by pack_sddoia_split, with the same concept supervision and OOD knowledge samples
+    """
+
+    def __init__(self, store_dir, split, c_sup=1, which_c=[-1], return_embeddings=False, is_ood_k=False):
+        super().__init__(store_dir, packed_sddoia_split(split, is_ood_k))
+        self.return_embeddings = return_embeddings
+        self.names = np.array(self.index["names"])
+        self.list_images = np.array(self.list_images)
+
+        self.concepts = mask_split_supervision(
+            torch.from_numpy(self.concepts), c_sup, which_c, self.index["n_listed"]
+        ).numpy()
+
+        if is_ood_k:
+            self.rows = ood_k_indices(self.concepts.shape[0])
+            self.concepts = self.concepts[self.rows]
+            self.labels = self.labels[self.rows]
+            self.list_images = self.list_images[self.rows]
+            self.names = self.names[self.rows]
+
+    def make_batch(self, indices):
+        batch = super().make_batch(indices)
+        if not self.return_embeddings:
+            return batch
+        return batch + (self.names[indices].tolist(),)
+
+
 ## --------------------------------------------------------------- ##
 
 
@@ -253,12 +276,22 @@ class ClIP_SDDOIADataset(torch.utils.data.Dataset):
 
         self.split = split
 
-        # collecting images
-        self.list_images = glob.glob(
-            os.path.join(
-                "data/saved_activations/SDDOIA-preprocessed", self.split, "*"
+        # collecting images: from the sharded feature store written by preprocessing, else one file per image
+        self.features, self.feature_rows = None, None
+        store = os.path.join("data/saved_activations", f"sddoia_{self.split}_clip_ViT-B32")
+        if is_complete(store):
+            self.features, image_paths = load_features(store)
+            self.list_images = [
+                os.path.join(self.base_path, self.split, os.path.splitext(os.path.basename(path))[0] + ".pt")
+                for path in image_paths
+            ]
+            self.feature_rows = {path: row for row, path in enumerate(self.list_images)}
+        else:
+            self.list_images = glob.glob(
+                os.path.join(
+                    "data/saved_activations/SDDOIA-preprocessed", self.split, "*"
+                )
             )
-        )
         # sort the images
         self.list_images = sorted(self.list_images, key=self._extract_number)
 
@@ -418,7 +451,10 @@ class ClIP_SDDOIADataset(torch.utils.data.Dataset):
         img_path = self.list_images[item]
         names = self.names[item]
         # image = self.imgs[item]
-        image = torch.load(img_path).to(torch.float64)
+        if self.features is not None:
+            image = self.features[self.feature_rows[img_path]].to(torch.float64)
+        else:
+            image = torch.load(img_path).to(torch.float64)
 
         if self.return_embeddings:
             return image, labels, concepts, names
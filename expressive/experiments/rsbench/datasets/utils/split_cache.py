@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+from typing import Callable, Dict
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from datasets.utils.memmap_dataset import MemmapDataset
+from expressive.atomic import atomic_write
+
+SPLIT_CACHE_DIR = "data/split_cache"
+# Part of every key: increment it when the way splits are computed or stored changes, so older caches are not used
+CACHE_VERSION = 1
+# Arrays of a split that are cached
+FIELDS = ["data", "concepts", "targets"]
+
+
+def file_fingerprint(path):
+    """Identifies the content of a file by its path, size and modification time, so without reading it"""
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def split_cache_key(sources, **params) -> str:
+    """Hash of the source files of the splits, of the parameters they are computed with and of CACHE_VERSION"""
+    description = json.dumps(
+        {"version": CACHE_VERSION, "sources": [file_fingerprint(path) for path in sources], "params": params},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha1(description.encode()).hexdigest()[:16]
+
+
+def split_paths(directory, split):
+    return {field: os.path.join(directory, f"{split}_{field}.npy") for field in FIELDS}
+
+
+def cached_splits(
+    name: str, key: str, build: Callable[[], Dict[str, Dataset]], images: bool = True
+) -> Dict[str, "CachedSplit"]:
+    """
+    Returns the splits computed by build (eg. the filtered train, val and test sets and the OOD sets, by name),
+     materialised once in SPLIT_CACHE_DIR/{name}_{key} and read back from there afterwards.
+    Each split is stored as its data, concepts and targets arrays, with images as uint8.
+    The splits are written into a temporary directory of this process, which is then renamed into place as a whole,
+     so processes building the same key at once (eg. a sweep) never see or leave a partial cache.
+    """
+    directory = os.path.join(SPLIT_CACHE_DIR, f"{name}_{key}")
+    index_path = os.path.join(directory, "index.json")
+    if not os.path.exists(index_path):
+        splits = build()
+        os.makedirs(SPLIT_CACHE_DIR, exist_ok=True)
+        with atomic_write(directory, directory=True) as tmp_directory:
+            for split, dataset in splits.items():
+                arrays = {field: np.asarray(getattr(dataset, field)) for field in FIELDS}
+                if images:
+                    # Same conversion as the transform of nMNIST
+                    arrays["data"] = arrays["data"].astype(np.uint8)
+                for field, path in split_paths(tmp_directory, split).items():
+                    np.save(path, arrays[field])
+            with open(os.path.join(tmp_directory, "index.json"), "w") as f:
+                json.dump({"splits": list(splits), "images": images}, f)
+    with open(index_path) as f:
+        index = json.load(f)
+    return {split: CachedSplit(directory, split, index["images"]) for split in index["splits"]}
+
+
+class CachedSplit(MemmapDataset):
+    """
+    Split stored by cached_splits. The data is memory-mapped, concepts and targets are kept in memory.
+    Batches of images are transformed at once to float tensors (1, H, W) in [0, 1], like ToPILImage and ToTensor
+     per image.
+    """
+
+    def __init__(self, directory, split, images=True):
+        paths = split_paths(directory, split)
+        super().__init__(paths["data"])
+        self.images = images
+        self.concepts = np.load(paths["concepts"])
+        self.targets = np.load(paths["targets"])
+
+    @property
+    def data(self):
+        return self.mapped()
+
+    def make_batch(self, indices):
+        data = torch.from_numpy(self.read(indices))
+        if self.images:
+            data = data.unsqueeze(1).float().div(255)
+        return data, torch.from_numpy(self.targets[indices]), torch.from_numpy(self.concepts[indices])
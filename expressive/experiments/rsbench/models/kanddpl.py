@@ -152,11 +152,7 @@ class KandDPL(DeepProblogModel):
         worlds_prob = worlds_tensor.reshape(-1, 3**self.n_facts)
 
         # Compute query probability P(q)
-        query_prob = torch.zeros(size=(len(pCs), self.n_predicates), device=pCs.device)
-
-        for i in range(self.n_predicates):
-            query = i
-            query_prob[:, i] = self.compute_query(query, worlds_prob).view(-1)
+        query_prob = compute_queries(worlds_prob, self.w_q, self.n_predicates)
 
         # add a small offset
         # query_prob += 1e-5
@@ -178,36 +174,10 @@ class KandDPL(DeepProblogModel):
         """
         y_worlds = outer_product(*preds).reshape(-1, 9**self.n_images)
 
-        py = torch.zeros(size=(len(preds[0]), self.nr_classes), device=preds[0].device)
-
-        for i in range(self.nr_classes):
-            and_rule = self.and_rule[:, i]
-            query_prob = torch.sum(and_rule * y_worlds, dim=1, keepdim=True)
-
-            py[:, i] = query_prob.view(-1)
+        py = compute_queries(y_worlds, self.and_rule, self.nr_classes)
 
         return py
 
-    def compute_query(self, query, worlds_prob):
-        """Computes query probability given the worlds probability P(w).
-
-        Args:
-            self: instance
-            query: query
-            worlds_prob: world probabilities
-
-        Returns:
-            query_prob: query probabilities
-        """
-        # Select the column of w_q matrix corresponding to the current query
-        w_q = self.w_q[:, query]
-        # Compute query probability by summing the probability of all the worlds where the query is true
-        query_prob = torch.sum(w_q * worlds_prob, dim=1, keepdim=True)
-
-        # for concepts in torch.split(latents):
-        #     s1, c1, s2, c2, s3, c3, s4, c4 = torch.split(concepts, 3, dim=-1)
-        return query_prob
-
     def normalize_concepts(self, z):
         """Computes the probability for each ProbLog fact given the latent vector z
 
@@ -150,17 +150,8 @@ class MiniKandDPL(DeepProblogModel):
         colors_prob = colors_worlds_tensor.reshape(-1, 3 ** (self.n_facts // 2))
 
         # Compute query probability
-        shapes_query_prob = torch.zeros(
-            size=(len(pCs), self.n_predicates), device=pCs.device
-        )
-        colors_query_prob = torch.zeros(
-            size=(len(pCs), self.n_predicates), device=pCs.device
-        )
-        for i in range(self.n_predicates):
-            query = i
-
-            shapes_query_prob[:, i] = self.compute_query(query, shapes_prob).view(-1)
-            colors_query_prob[:, i] = self.compute_query(query, colors_prob).view(-1)
+        shapes_query_prob = compute_queries(shapes_prob, self.w_q, self.n_predicates)
+        colors_query_prob = compute_queries(colors_prob, self.w_q, self.n_predicates)
 
         # shapes_check = torch.zeros(size=(len(pCs), self.nr_classes), device=pCs.device)
         # colors_check = torch.zeros(size=(len(pCs), self.nr_classes), device=pCs.device)
@@ -187,55 +178,15 @@ class MiniKandDPL(DeepProblogModel):
         s_worlds = outer_product(*spreds).reshape(-1, 3**self.n_images)
         c_worlds = outer_product(*cpreds).reshape(-1, 3**self.n_images)
 
-        ps = torch.zeros(
-            size=(len(spreds[0]), self.nr_classes), device=spreds[0].device
-        )
-        pc = torch.zeros(
-            size=(len(cpreds[0]), self.nr_classes), device=cpreds[0].device
-        )
-
-        for i in range(self.nr_classes):
-            and_rule = self.and_rule[:, i]
-            prob_s = torch.sum(and_rule * s_worlds, dim=1, keepdim=True)
-            prob_c = torch.sum(and_rule * c_worlds, dim=1, keepdim=True)
-
-            ps[:, i] = prob_s.view(-1)
-            pc[:, i] = prob_c.view(-1)
+        ps = compute_queries(s_worlds, self.and_rule, self.nr_classes)
+        pc = compute_queries(c_worlds, self.and_rule, self.nr_classes)
 
         total_prob = outer_product(ps, pc).reshape(-1, 4)
 
-        py = torch.zeros(
-            size=(len(spreds[0]), self.nr_classes), device=spreds[0].device
-        )
-
-        for i in range(self.nr_classes):
-            or_rule = self.or_rule[:, i]
-            query_prob = torch.sum(or_rule * total_prob, dim=1, keepdim=True)
-
-            py[:, i] = query_prob.view(-1)
+        py = compute_queries(total_prob, self.or_rule, self.nr_classes)
 
         return py
 
-    def compute_query(self, query, worlds_prob):
-        """Computes query probability given the worlds probability P(w).
-
-        Args:
-            self: instance
-            query: query
-            worlds_prob: worlds probability
-
-        Returns:
-            query_prob: query probability
-        """
-        # Select the column of w_q matrix corresponding to the current query
-        w_q = self.w_q[:, query]
-        # Compute query probability by summing the probability of all the worlds where the query is true
-        query_prob = torch.sum(w_q * worlds_prob, dim=1, keepdim=True)
-
-        # for concepts in torch.split(latents):
-        #     s1, c1, s2, c2, s3, c3, s4, c4 = torch.split(concepts, 3, dim=-1)
-        return query_prob
-
     def normalize_concepts(self, z):
         """Computes the probability for each ProbLog fact given the latent vector z
 
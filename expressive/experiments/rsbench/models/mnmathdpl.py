@@ -144,90 +144,17 @@ class MNMATHDPL(DeepProblogModel):
         worlds_prob_prod = probs_for_prod.reshape(-1, int(self.n_facts ** (self.n_images / 2)))
 
         # Compute query probability P(q)
-        query_prob_sum = torch.zeros(
-            size=(len(worlds_prob_sum), self.nr_classes), device=probs_for_sum.device
-        )
-        query_prob_prod = torch.zeros(
-            size=(len(worlds_prob_prod), self.nr_classes), device=probs_for_prod.device
-        )
-
-        for i in range(self.nr_classes):
-            query = i
-            query_prob_sum[:, i] = self.compute_query_sum(query, worlds_prob_sum).view(-1)
-
-        for i in range(self.nr_classes):
-            query = i
-            query_prob_prod[:, i] = self.compute_query_prod(query, worlds_prob_prod).view(-1)
+        query_prob_sum = compute_queries(worlds_prob_sum, self.logic_sum, self.nr_classes)
+        query_prob_prod = compute_queries(worlds_prob_prod, self.logic_and, self.nr_classes)
 
         # add a small offset
-        query_prob_prod += 1e-5
-        with torch.no_grad():
-            Z = torch.sum(query_prob_prod, dim=-1, keepdim=True)
-        query_prob_prod = query_prob_prod / Z
-
-        # add a small offset
-        query_prob_sum += 1e-5
-        with torch.no_grad():
-            Z = torch.sum(query_prob_sum, dim=-1, keepdim=True)
-        query_prob_sum = query_prob_sum / Z
+        query_prob_prod = normalize_queries(query_prob_prod)
+        query_prob_sum = normalize_queries(query_prob_sum)
 
         combined_tensor = torch.stack((query_prob_sum[:, 1], query_prob_prod[:, 1]), dim=1)
         
         return combined_tensor, None
 
-    def compute_query_sum(self, query, worlds_prob):
-        """Computes query probability given the worlds probability P(w).
-
-        Args:
-            self: instance
-            query: query
-            worlds_probs: worlds probabilities
-
-        Returns:
-            query_prob: query probabilities
-        """
-        # Select the column of w_q matrix corresponding to the current query
-        w_q = self.logic_sum[:, query]
-
-        # Compute query probability by summing the probability of all the worlds where the query is true
-        query_prob = torch.sum(w_q * worlds_prob, dim=1, keepdim=True)
-        return query_prob
-
-    def compute_query_prod(self, query, worlds_prob):
-        """Computes query probability given the worlds probability P(w).
-
-        Args:
-            self: instance
-            query: query
-            worlds_probs: worlds probabilities
-
-        Returns:
-            query_prob: query probabilities
-        """
-        # Select the column of w_q matrix corresponding to the current query
-        w_q = self.logic_and[:, query]
-
-        # Compute query probability by summing the probability of all the worlds where the query is true
-        query_prob = torch.sum(w_q * worlds_prob, dim=1, keepdim=True)
-        return query_prob
-
-    def compute_query_combine(self, query, worlds_prob):
-        """Computes query probability given the worlds probability P(w).
-
-        Args:
-            self: instance
-            query: query
-            worlds_probs: worlds probabilities
-
-        Returns:
-            query_prob: query probabilities
-        """
-        # Select the column of w_q matrix corresponding to the current query
-        w_q = self.combine[:, query]
-        # Compute query probability by summing the probability of all the worlds where the query is true
-        query_prob = torch.sum(w_q * worlds_prob, dim=1, keepdim=True)
-        return query_prob
-
     def normalize_concepts(self, z, split=8):
         """Computes the probability for each ProbLog fact given the latent vector z
 
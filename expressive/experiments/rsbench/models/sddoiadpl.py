@@ -97,6 +97,11 @@ class SDDOIADPL(DeepProblogModel):
         else:
             raise NotImplementedError("Invalid task for SDDOIA")
 
+        # World -> label lookup tables for deterministic_inference, and contraction plans for problog_inference,
+        #  built on first use
+        self._label_tables = None
+        self._inference_plans = None
+
         # opt and device
         self.opt = None
 
@@ -140,114 +145,26 @@ class SDDOIADPL(DeepProblogModel):
             worlds_prob: worlds probability
         """
 
-        # for forward
-        tl_green = pCs[:, :2]  # traffic light is green
-        follow = pCs[:, 2:4]  # follow car ahead
-        clear = pCs[:, 4:6]  # road is clear
-
-        # for stop
-        tl_red = pCs[:, 6:8]  # traffic light is red
-        t_sign = pCs[:, 8:10]  # traffic sign present
-        obs = compute_logic_obstacle(self.or_four_bits, pCs)  # generic obstacle
-
-        TLGFS = tl_green.unsqueeze(2).unsqueeze(3).unsqueeze(4).unsqueeze(5).unsqueeze(6)
-        FFS = follow.unsqueeze(1).unsqueeze(3).unsqueeze(4).unsqueeze(5).unsqueeze(6)
-        CFS = clear.unsqueeze(1).unsqueeze(2).unsqueeze(4).unsqueeze(5).unsqueeze(6)
-        TLRFS = tl_red.unsqueeze(1).unsqueeze(2).unsqueeze(3).unsqueeze(5).unsqueeze(6)
-        TSFS = t_sign.unsqueeze(1).unsqueeze(2).unsqueeze(3).unsqueeze(4).unsqueeze(6)
-        OFS = obs.unsqueeze(1).unsqueeze(2).unsqueeze(3).unsqueeze(4).unsqueeze(5)
-
-        w_FS = (
-            TLGFS.multiply(FFS).multiply(CFS).multiply(TLRFS).multiply(TSFS).multiply(OFS).view(-1, 64)
-        )
-        #
-        labels_FS = torch.einsum("bi,ik->bk", w_FS, self.FS_w_q)
-        ##
-
-        # for LEFT
-        left_lane = pCs[:, 18:20]  # there is LEFT lane
-        tl_green_left = pCs[:, 20:22]  # tl green on LEFT
-        follow_left = pCs[:, 22:24]  # follow car going LEFT
-
-        # for LEFT-STOP
-        no_left_lane = pCs[:, 24:26]  # no lane on LEFT
-        l_obs = pCs[:, 26:28]  # LEFT obstacle
-        left_line = pCs[:, 28:30]  # solid line on LEFT
-
-        AL = left_lane.unsqueeze(2).unsqueeze(3).unsqueeze(4).unsqueeze(5).unsqueeze(6)
-        BL = (
-            tl_green_left.unsqueeze(1)
-            .unsqueeze(3)
-            .unsqueeze(4)
-            .unsqueeze(5)
-            .unsqueeze(6)
-        )
-        CL = (
-            follow_left.unsqueeze(1).unsqueeze(2).unsqueeze(4).unsqueeze(5).unsqueeze(6)
-        )
-        DL = (
-            no_left_lane.unsqueeze(1)
-            .unsqueeze(2)
-            .unsqueeze(3)
-            .unsqueeze(5)
-            .unsqueeze(6)
-        )
-        EL = l_obs.unsqueeze(1).unsqueeze(2).unsqueeze(3).unsqueeze(4).unsqueeze(6)
-        FL = left_line.unsqueeze(1).unsqueeze(2).unsqueeze(3).unsqueeze(4).unsqueeze(5)
-
-        w_L = (
-            AL.multiply(BL)
-            .multiply(CL)
-            .multiply(DL)
-            .multiply(EL)
-            .multiply(FL)
-            .view(-1, 64)
-        )
+        B = pCs.shape[0]
+        # Distribution of each concept, (batch_size, n_concepts, 2)
+        pCs_BC2 = pCs.reshape(B, -1, 2)
+        obstacle_plan, heads_plan = self.inference_plans(pCs.device)
 
-        label_L = torch.einsum("bi,ik->bk", w_L, self.L_w_q)
-        ##
-
-        # for RIGHT
-        rigt_lane = pCs[:, 30:32]  # there is RIGHT lane
-        tl_green_rigt = pCs[:, 32:34]  # tl green on RIGHT
-        follow_rigt = pCs[:, 34:36]  # follow car going RIGHT
-
-        # for RIGHT-STOP
-        no_rigt_lane = pCs[:, 36:38]  # no lane on RIGHT
-        r_obs = pCs[:, 38:40]  # RIGHT obstacle
-        rigt_line = pCs[:, 40:42]  # solid line on RIGHT
-
-        AL = rigt_lane.unsqueeze(2).unsqueeze(3).unsqueeze(4).unsqueeze(5).unsqueeze(6)
-        BL = (
-            tl_green_rigt.unsqueeze(1)
-            .unsqueeze(3)
-            .unsqueeze(4)
-            .unsqueeze(5)
-            .unsqueeze(6)
-        )
-        CL = (
-            follow_rigt.unsqueeze(1).unsqueeze(2).unsqueeze(4).unsqueeze(5).unsqueeze(6)
-        )
-        DL = (
-            no_rigt_lane.unsqueeze(1)
-            .unsqueeze(2)
-            .unsqueeze(3)
-            .unsqueeze(5)
-            .unsqueeze(6)
-        )
-        EL = r_obs.unsqueeze(1).unsqueeze(2).unsqueeze(3).unsqueeze(4).unsqueeze(6)
-        FL = rigt_line.unsqueeze(1).unsqueeze(2).unsqueeze(3).unsqueeze(4).unsqueeze(5)
-
-        w_R = (
-            AL.multiply(BL)
-            .multiply(CL)
-            .multiply(DL)
-            .multiply(EL)
-            .multiply(FL)
-            .view(-1, 64)
-        )
+        # generic obstacle: car, person, rider, other obstacle
+        obs = obstacle_plan.query_probs(obstacle_plan.worlds(pCs_BC2[:, None, 5:9]))[:, 0]
 
-        label_R = torch.einsum("bi,ik->bk", w_R, self.R_w_q)
+        # The 6 factors of the worlds of each head:
+        #  forward/stop: traffic light green, follow car ahead, road is clear, traffic light red, traffic sign, obstacle
+        #  left: left lane, tl green on left, follow car going left, no lane on left, left obstacle, solid line on left
+        #  right: the same as left, for the right
+        factors_BHFV = torch.stack(
+            [torch.cat([pCs_BC2[:, 0:5], obs[:, None]], dim=1), pCs_BC2[:, 9:15], pCs_BC2[:, 15:21]], dim=1
+        )
+        worlds_BHW = heads_plan.worlds(factors_BHFV)
+        queries_BHY = heads_plan.query_probs(worlds_BHW)
+        labels_FS = queries_BHY[:, 0, :4]
+        label_L = queries_BHY[:, 1, :2]
+        label_R = queries_BHY[:, 2, :2]
 
         # There are 3 types of labels. One 4-dim, and two 1-dim encoded as [1-p, p] (ie, [neg, pos]). 
         pred = torch.cat([labels_FS, label_L, label_R], dim=1)  # this is 8 dim
@@ -261,32 +178,54 @@ class SDDOIADPL(DeepProblogModel):
         # This part is NeSy diff specific. 
         if compute_entropies:
             assert query is not None
-            # Compute concept entropy conditioned on the query
-            entropy_FS_B = self.compute_entropy(w_FS, self.FS_w_q, labels_FS, query[:, 0])
-            entropy_L_B = self.compute_entropy(w_L, self.L_w_q, label_L, query[:, 1])
-            entropy_R_B = self.compute_entropy(w_R, self.R_w_q, label_R, query[:, 2])
+            # Compute concept entropy conditioned on the query, for each head
+            entropy_BH = heads_plan.conditional_entropy(worlds_BHW, queries_BHY, query[:, :3])
             # Normalise by number of dimensions of W for scaling consistency
-            entropy = (entropy_FS_B + entropy_L_B + entropy_R_B) / 21.
+            entropy = entropy_BH.sum(-1) / 21.
             return pred, entropy
 
         return pred
 
-    def compute_entropy(self, w_BW: torch.Tensor, L_WY: torch.Tensor, Z_BY: torch.Tensor, query_B: torch.Tensor) -> torch.Tensor:
+    def inference_plans(self, device: torch.device):
         """
-        Compute the concept distribution entropy conditioned on the query. 
+        Returns the contraction plans of problog_inference: one for the generic obstacle, and one for the three heads.
         """
-        # Choose logical formula based on query
-        L_queried_BW = L_WY[:, query_B].T
-        Z_queried_B = Z_BY[torch.arange(Z_BY.shape[0]), query_B]
-        # Filter worlds and normalise
-        w_filtered_BW = w_BW * L_queried_BW / (Z_queried_B.unsqueeze(1) + 1e-8)
-        # Compute entropy
-        entropy_terms_BW = torch.zeros_like(w_filtered_BW)
-        entropy_terms_BW[w_filtered_BW > 0] = w_filtered_BW[w_filtered_BW > 0] * torch.log(w_filtered_BW[w_filtered_BW > 0])
-        entropy_B = -torch.sum(entropy_terms_BW, dim=1)
-        return entropy_B
-
-
+        if self._inference_plans is None or self._inference_plans[0].device != torch.device(device):
+            self._inference_plans = (
+                WorldQueryPlan([self.or_four_bits]).to(device),
+                WorldQueryPlan([self.FS_w_q, self.L_w_q, self.R_w_q]).to(device),
+            )
+        return self._inference_plans
+
+    def label_tables(self, device: torch.device) -> torch.Tensor:
+        """
+        Returns, for each of the three heads (forward/stop, left, right), the label of each of its 64 worlds, shape (3, 64).
+        Labels are the argmax of the query probabilities that problog_inference gives for the world with probability 1.
+        """
+        if self._label_tables is None or self._label_tables.device != torch.device(device):
+            tables = []
+            for w_q in [self.FS_w_q, self.L_w_q, self.R_w_q]:
+                # Same operations as problog_inference, so ties are broken the same way
+                pred = (w_q.float() + 1e-5) / (1 + 2 * 1e-5)
+                tables.append(torch.max(pred, dim=-1)[1])
+            self._label_tables = torch.stack(tables).to(device)
+        return self._label_tables
+
+    def deterministic_inference(self, w_BW: torch.Tensor) -> torch.Tensor:
+        """
+        Labels (forward/stop, left, right) of deterministic concepts w_BW in {0, 1}, shape (..., 21) -> (..., 3).
+        Equal to the argmax of problog_inference on the one-hot encoding of w_BW, without computing any world probabilities:
+         the world of each head is the integer with the bits of its 6 concepts, in the order of the outer products.
+        """
+        bits_6 = torch.tensor([32, 16, 8, 4, 2, 1], device=w_BW.device, dtype=torch.long)
+        w_BW = w_BW.long()
+        # Generic obstacle: any of car, person, rider, other obstacle (or_four_bits, as in problog_inference)
+        obs_B = w_BW[..., 5:9].amax(dim=-1)
+        world_FS = (w_BW[..., 0:5] * bits_6[:5]).sum(-1) + obs_B
+        world_L = (w_BW[..., 9:15] * bits_6).sum(-1)
+        world_R = (w_BW[..., 15:21] * bits_6).sum(-1)
+        tables = self.label_tables(w_BW.device)
+        return torch.stack([tables[0][world_FS], tables[1][world_L], tables[2][world_R]], dim=-1)
 
     def normalize_concepts(self, concepts):
         """Computes the probability for each ProbLog fact given the latent vector z
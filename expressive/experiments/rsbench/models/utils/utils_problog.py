@@ -1,3 +1,5 @@
+import functools
+import inspect
 import os.path
 import random
 from datetime import datetime
@@ -266,6 +268,58 @@ def build_model_dict(sequence_len, n_digits):
     return model_dict
 
 
+def enumerate_worlds(n_values, n_positions):
+    """
+    All worlds with n_positions concepts of n_values values, shape (n_values^n_positions, n_positions).
+    World w is the mixed radix expansion of w (first position most significant), so the worlds are in the order of
+     itertools.product(range(n_values), repeat=n_positions).
+    """
+    radix = n_values ** torch.arange(n_positions - 1, -1, -1)
+    return torch.arange(n_values**n_positions)[:, None] // radix % n_values
+
+
+def one_query_matrix(query_W, n_queries):
+    """Worlds-queries matrix where world w is only consistent with query query_W[w]"""
+    return torch.nn.functional.one_hot(query_W, n_queries).float()
+
+
+def _encode_worlds_queries(w_q):
+    # Matrices where each world maps to a single query are stored as the index of that query
+    if w_q.dim() == 2 and torch.all((w_q == 0) | (w_q == 1)) and torch.all(w_q.sum(-1) == 1):
+        return {"query": w_q.argmax(-1), "n_queries": w_q.shape[1]}
+    return {"dense": w_q}
+
+
+def _decode_worlds_queries(encoded):
+    if "query" in encoded:
+        return one_query_matrix(encoded["query"], encoded["n_queries"])
+    return encoded["dense"].clone()
+
+
+def cached_worlds_queries(builder):
+    """
+    Caches the matrices returned by builder (a tensor or a tuple of tensors) for each of its arguments,
+     so models built repeatedly (eg. one per seed) share them. Every call returns new tensors.
+    """
+    signature = inspect.signature(builder)
+    cache = {}
+
+    @functools.wraps(builder)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = tuple(bound.arguments.items())
+        if key not in cache:
+            result = builder(*bound.args, **bound.kwargs)
+            matrices = result if isinstance(result, tuple) else (result,)
+            cache[key] = (isinstance(result, tuple), [_encode_worlds_queries(w_q) for w_q in matrices])
+        is_tuple, encoded = cache[key]
+        matrices = tuple(_decode_worlds_queries(w_q) for w_q in encoded)
+        return matrices if is_tuple else matrices[0]
+
+    return wrapper
+
+
 def build_worlds_queries_matrix_kandinsky(sequence_len=0, n_facts=0, n_shapes=0):
     """Build Worlds Queries Matrices
 
@@ -327,63 +381,40 @@ def build_worlds_queries_matrix_kandinsky(sequence_len=0, n_facts=0, n_shapes=0)
     return w_q
 
 
+@cached_worlds_queries
 def build_worlds_queries_matrix(sequence_len=0, n_digits=0, task="addmnist"):
     """Build Worlds-Queries matrix"""
+    if task not in ["addmnist", "productmnist", "multiopmnist"]:
+        raise NotImplementedError("Wrong choice")
+    digit1, digit2 = enumerate_worlds(n_digits, sequence_len).unbind(-1)
     if task == "addmnist":
-        possible_worlds = list(product(range(n_digits), repeat=sequence_len))
-        n_worlds = len(possible_worlds)
-        n_queries = len(range(0, 10 + 10))
-        look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-        w_q = torch.zeros(n_worlds, n_queries)  # (100, 20)
-        for w in range(n_worlds):
-            digit1, digit2 = look_up[w]
-            for q in range(n_queries):
-                if digit1 + digit2 == q:
-                    w_q[w, q] = 1
-        return w_q
+        queries = torch.arange(10 + 10)
+        return (digit1 + digit2)[:, None].eq(queries).float()  # (100, 20)
 
     elif task == "productmnist":
-        possible_worlds = list(product(range(n_digits), repeat=sequence_len))
-        n_worlds = len(possible_worlds)
-        n_queries = [0]
+        queries = [0]
         for i, j in itertools.product(range(1, 10), range(1, 10)):
-            n_queries.append(i * j)
-        n_queries = np.unique(np.array(n_queries))
-
-        look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-        w_q = torch.zeros(n_worlds, len(n_queries))  # (100, boh)
-        for w in range(n_worlds):
-            digit1, digit2 = look_up[w]
-            for i, q in enumerate(n_queries):
-                if digit1 * digit2 == q:
-                    w_q[w, i] = 1
-
-        return w_q
+            queries.append(i * j)
+        queries = torch.from_numpy(np.unique(np.array(queries)))
+        return (digit1 * digit2)[:, None].eq(queries).float()  # (100, boh)
 
     elif task == "multiopmnist":
-        possible_worlds = list(product(range(n_digits), repeat=sequence_len))
-        n_worlds = len(possible_worlds)
-        n_queries = np.array([0, 1, 2, 3])
-
-        w_q = torch.zeros(n_worlds, len(n_queries))  # (16, 4)
-        look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-        for w in range(n_worlds):
-            digit1, digit2 = look_up[w]
-            for i, q in enumerate(n_queries):
-                if digit1 + digit2 == 1 and digit1 * digit2 == 0:
-                    w_q[w, 0] = 1
-                elif digit1 + digit2 == 2 and digit1 * digit2 == 0:
-                    w_q[w, 1] = 1
-                elif digit1 + digit2 == 4 and digit1 * digit2 == 3:
-                    w_q[w, 2] = 1
-                else:
-                    w_q[w, 3] = 1
-        return w_q
+        # Conditions in order of precedence, worlds that satisfy none answer query 3
+        query_W = torch.full(digit1.shape, 3)
+        query_W[(digit1 + digit2 == 4) & (digit1 * digit2 == 3)] = 2
+        query_W[(digit1 + digit2 == 2) & (digit1 * digit2 == 0)] = 1
+        query_W[(digit1 + digit2 == 1) & (digit1 * digit2 == 0)] = 0
+        return one_query_matrix(query_W, 4)  # (16, 4)
 
-    else:
-        NotImplementedError("Wrong choice")
+
+def _kand_pattern(a, b, c):
+    """0 if the three values are all different, 2 if they are all equal, 1 if exactly two are equal"""
+    same = (a == b) & (a == c)
+    diff = (a != b) & (a != c) & (b != c)
+    return torch.where(same, 2, torch.where(diff, 0, 1))
 
 
+@cached_worlds_queries
 def build_worlds_queries_matrix_KAND(
     n_images=3, n_concepts=6, n_poss=3, task="mini_patterns"
 ):
@@ -399,143 +430,65 @@ def build_worlds_queries_matrix_KAND(
         or_rule[0, 0] = 1
         or_rule[1:, 1] = 1
 
-        and_rule = torch.zeros((3**n_images, 2))
-
-        possible_preds = list(product(range(3), repeat=3))
-        n_preds = len(possible_preds)
-
-        preds = {i: c for i, c in zip(range(n_preds), possible_preds)}
-        for p in range(n_preds):
-            res1, res2, res3 = preds[p]
+        res1, res2, res3 = enumerate_worlds(3, 3).unbind(-1)
+        and_rule = one_query_matrix(((res1 == res2) & (res2 == res3)).long(), 2)
 
-            if (res1 == res2) and (res2 == res3):
-                and_rule[p, 1] = 1
-            else:
-                and_rule[p, 0] = 1
-
-        possible_worlds = list(product(range(3), repeat=3))
-        n_worlds = len(possible_worlds)
-
-        n_queries = 3
-
-        look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-        w_q = torch.zeros(n_worlds, n_queries)  # (3^6, 9)
-        for w in range(n_worlds):
-            s1, s2, s3 = look_up[w]
-
-            if (s1 == s2) and (s1 == s3):
-                w_q[w, 2] = 1
-            elif (s1 != s2) and (s1 != s3) and (s2 != s3):
-                w_q[w, 0] = 1
-            else:
-                w_q[w, 1] = 1
+        s1, s2, s3 = enumerate_worlds(3, 3).unbind(-1)
+        w_q = one_query_matrix(_kand_pattern(s1, s2, s3), 3)  # (3^3, 3)
 
         return w_q, and_rule, or_rule
 
     elif task == "patterns":
 
-        and_or_rule = torch.zeros((9**n_images, 2))
+        im1, im2, im3 = enumerate_worlds(9, 3).unbind(-1)
+        and_or_rule = one_query_matrix(((im1 == im2) & (im1 == im3)).long(), 2)
 
-        possible_preds = list(product(range(9), repeat=3))
-        n_preds = len(possible_preds)
-
-        preds = {i: c for i, c in zip(range(n_preds), possible_preds)}
-        for p in range(n_preds):
-            im1, im2, im3 = preds[p]
-            if (im1 == im2) and (im1 == im3) and (im2 == im3):
-                and_or_rule[p, 1] = 1
-            else:
-                and_or_rule[p, 0] = 1
-
-        possible_worlds = list(product(range(n_poss), repeat=n_concepts))
-        n_worlds = len(possible_worlds)
-
-        n_queries = 9
-
-        look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-        w_q = torch.zeros(n_worlds, n_queries)  # (3^6, 9)
-        for w in range(n_worlds):
-            s1, s2, s3, c1, c2, c3 = look_up[w]
-
-            same_s = (s1 == s2) and (s1 == s3)
-            diff_s = (s1 != s2) and (s1 != s3) and (s2 != s3)
-            pair_s = not same_s and not diff_s
-
-            shapes = np.array([diff_s, pair_s, same_s])
-
-            same_c = (c1 == c2) and (c1 == c3)
-            diff_c = (c1 != c2) and (c1 != c3) and (c2 != c3)
-            pair_c = not same_c and not diff_c
-
-            colors = np.array([diff_c, pair_c, same_c])
-
-            y = 3 * np.argmax(shapes) + np.argmax(colors)
-
-            w_q[w, y] = 1
+        s1, s2, s3, c1, c2, c3 = enumerate_worlds(n_poss, n_concepts).unbind(-1)
+        y = 3 * _kand_pattern(s1, s2, s3) + _kand_pattern(c1, c2, c3)
+        w_q = one_query_matrix(y, 9)  # (3^6, 9)
 
         return w_q, and_or_rule
 
     elif task == "red_triangle":
-        possible_worlds = list(product(range(n_poss), repeat=n_concepts))
-        n_worlds = len(possible_worlds)
-
-        n_queries = 2
+        s1, s2, s3, c1, c2, c3 = enumerate_worlds(n_poss, n_concepts).unbind(-1)
 
-        look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-        w_q = torch.zeros(n_worlds, n_queries)  # (3^8, 2)
-        for w in range(n_worlds):
-            s1, s2, s3, c1, c2, c3 = look_up[w]
+        rt1 = (s1 == 0) & (c1 == 0)
+        rt2 = (s2 == 0) & (c2 == 0)
+        rt3 = (s3 == 0) & (c3 == 0)
 
-            rt1 = (s1 == 0) and (c1 == 0)
-            rt2 = (s2 == 0) and (c2 == 0)
-            rt3 = (s3 == 0) and (c3 == 0)
-
-            if rt1 or rt2 or rt3:
-                w_q[w, 1] = 1
-            else:
-                w_q[w, 0] = 1
+        w_q = one_query_matrix((rt1 | rt2 | rt3).long(), 2)  # (3^6, 2)
 
         return w_q, and_rule
 
     elif task == "base":
-        possible_worlds = list(product(range(n_poss), repeat=n_concepts))
-        n_worlds = len(possible_worlds)
+        s1, s2, s3, s4, c1, c2, c3, c4 = enumerate_worlds(n_poss, n_concepts).unbind(-1)
 
-        n_queries = 2
+        s12 = s1 == s2
+        s13 = s1 == s3
+        s14 = s1 == s4
+        c12 = c1 == c2
+        c13 = c1 == c3
+        c14 = c1 == c4
 
-        look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-        w_q = torch.zeros(n_worlds, n_queries)  # (3^8, 2)
-        for w in range(n_worlds):
-            s1, s2, s3, s4, c1, c2, c3, c4 = look_up[w]
+        s23 = s2 == s3
+        s24 = s2 == s4
+        c23 = c2 == c3
+        c24 = c2 == c4
 
-            s12 = s1 == s2
-            s13 = s1 == s3
-            s14 = s1 == s4
-            c12 = c1 == c2
-            c13 = c1 == c3
-            c14 = c1 == c4
+        s34 = s3 == s4
+        c34 = c3 == c4
 
-            s23 = s2 == s3
-            s24 = s2 == s4
-            c23 = c2 == c3
-            c24 = c2 == c4
+        # A pair of shapes has the same colour and the other not
+        p0 = s12 & s34 & (c12 != c34) & (s1 != s3)
+        p1 = s13 & s24 & (c13 != c24) & (s1 != s2)
+        p2 = s14 & s23 & (c14 != c23) & (s1 != s2)
 
-            s34 = s3 == s4
-            c34 = c3 == c4
-
-            p0 = s12 * s34 * ((c12 + c34) % 2) * (s1 != s3)
-            p1 = s13 * s24 * ((c13 + c24) % 2) * (s1 != s2)
-            p2 = s14 * s23 * ((c14 + c23) % 2) * (s1 != s2)
-
-            if p0 + p1 + p2 == 0:
-                w_q[w, 0] = 1
-            else:
-                w_q[w, 1] = 1
+        w_q = one_query_matrix((p0 | p1 | p2).long(), 2)  # (3^8, 2)
 
         return w_q, and_rule
 
     else:
-        NotImplementedError("Wrong choice")
+        raise NotImplementedError("Wrong choice")
 
 
 def build_clevr_worlds_queries_matrix(max_n_images=4, n_concepts=19):
@@ -597,241 +550,112 @@ if __name__ == "__main__":
     # print(9**4*np.log10(9**4))
 
 
+def _fs_queries(tl_green, follow, clear, tl_red, t_sign, obs):
+    """Not move, move forward, no-stop and stop (in that order) of each world. Inconsistent worlds answer none"""
+    can_move = tl_green + follow + clear > 0
+    invalid = (tl_green + tl_red == 2) | (clear + obs == 2)
+    stop = tl_red + t_sign + obs > 0
+    forward = can_move & ~invalid & ~stop
+    return torch.stack(
+        [
+            ~can_move | (~invalid & stop),  # not move
+            forward,  # move forward
+            forward | (~can_move & ~stop),  # no-stop
+            stop & (~can_move | ~invalid),  # stop
+        ],
+        dim=-1,
+    ).float()
+
+
+@cached_worlds_queries
 def build_world_queries_matrix_complete_FS():
-
-    possible_worlds = list(product(range(2), repeat=9))
-    n_worlds = len(possible_worlds)
-    n_queries = 4
-    look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-
-    w_q = torch.zeros(n_worlds, n_queries)  # (100, 20)
-    for w in range(n_worlds):
-        tl_green, follow, clear, tl_red, t_sign, ob1, ob2, ob3, ob4 = look_up[w]
-
-        obs = min(ob1 + ob2 + ob3 + ob4, 1)
-
-        if tl_green + follow + clear > 0:
-            if tl_green + tl_red == 2 or clear + obs == 2:
-                pass
-            elif tl_red + t_sign + obs > 0:
-                w_q[w, 0] = 1  # not move
-                w_q[w, 3] = 1  # stop
-            else:
-                w_q[w, 1] = 1  # move forward
-                w_q[w, 2] = 1  # no-stop
-        else:
-            w_q[w, 0] = 1  # not move
-            if tl_red + t_sign + obs > 0:
-                w_q[w, 3] = 1  # stop
-            else:
-                w_q[w, 2] = 1  # no-stop
-    return w_q
+    tl_green, follow, clear, tl_red, t_sign, ob1, ob2, ob3, ob4 = enumerate_worlds(2, 9).unbind(-1)
+    obs = (ob1 + ob2 + ob3 + ob4).clamp(max=1)
+    return _fs_queries(tl_green, follow, clear, tl_red, t_sign, obs)
 
 
+@cached_worlds_queries
 def build_world_queries_matrix_FS():
-    possible_worlds = list(product(range(2), repeat=6))
-    n_worlds = len(possible_worlds)
-    n_queries = 4
-    look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-
-    w_q = torch.zeros(n_worlds, n_queries)  # (100, 20)
-    for w in range(n_worlds):
-        tl_green, follow, clear, tl_red, t_sign, obs = look_up[w]
-
-        if tl_green + follow + clear > 0:
-            if tl_green + tl_red == 2 or clear + obs == 2:
-                pass
-            elif tl_red + t_sign + obs > 0:
-                w_q[w, 0] = 1  # not move
-                w_q[w, 3] = 1  # stop
-            else:
-                w_q[w, 1] = 1  # move forward
-                w_q[w, 2] = 1  # no-stop
-        else:
-            w_q[w, 0] = 1  # not move
-            if tl_red + t_sign + obs > 0:
-                w_q[w, 3] = 1  # stop
-            else:
-                w_q[w, 2] = 1  # no-stop
-    return w_q
+    return _fs_queries(*enumerate_worlds(2, 6).unbind(-1))  # (64, 4)
 
 
+@cached_worlds_queries
 def build_world_queries_matrix_nesydiff_FS():
-    possible_worlds = list(product(range(2), repeat=6))
-    n_worlds = len(possible_worlds)
+    tl_green, follow, clear, tl_red, t_sign, obs = enumerate_worlds(2, 6).unbind(-1)
     # There are 4 different possibilities:
     # Invalid world
     # Forward
     # Stop
     # Neither forward nor stop
     # Assume in that order
-    n_queries = 4
-    look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-
-    w_q = torch.zeros(n_worlds, n_queries)  # (100, 20)
-    for w in range(n_worlds):
-        tl_green, follow, clear, tl_red, t_sign, obs = look_up[w]
-
-        if tl_green + follow + clear > 0:
-            if tl_green + tl_red == 2 or clear + obs == 2:
-                # Invalid world
-                w_q[w, 0] = 1
-                pass
-            elif tl_red + t_sign + obs > 0:
-                # Stop
-                w_q[w, 2] = 1
-            else:
-                # Forward
-                w_q[w, 1] = 1
-        else:
-            if tl_red + t_sign + obs > 0:
-                # Stop
-                w_q[w, 2] = 1
-            else:
-                # Neither forward nor stop
-                w_q[w, 3] = 1
-    return w_q
+    can_move = tl_green + follow + clear > 0
+    invalid = (tl_green + tl_red == 2) | (clear + obs == 2)
+    stop = tl_red + t_sign + obs > 0
+    query_W = torch.where(stop, 2, torch.where(can_move, 1, 3))
+    query_W[can_move & invalid] = 0
+    return one_query_matrix(query_W, 4)
 
 
 # Case of the ambulance, predict forward
+@cached_worlds_queries
 def build_world_queries_matrix_FS_ambulance():
+    tl_green, follow, clear, tl_red, t_sign, obs = enumerate_worlds(2, 6).unbind(-1)
 
-    possible_worlds = list(product(range(2), repeat=6))
-    n_worlds = len(possible_worlds)
-    n_queries = 4
-    look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-
-    w_q = torch.zeros(n_worlds, n_queries)  # (100, 20)
-    for w in range(n_worlds):
-        tl_green, follow, clear, tl_red, t_sign, obs = look_up[w]
-
-        # stop only if there is an obstacle
-        if obs > 0:
-            w_q[w, 0] = 1  # not move
-            w_q[w, 3] = 1  # stop
-        else:
-            w_q[w, 1] = 1  # move forward
-            w_q[w, 2] = 1  # no-stop
-    return w_q
+    # stop only if there is an obstacle
+    stop = obs > 0
+    return torch.stack([stop, ~stop, ~stop, stop], dim=-1).float()  # not move, move forward, no-stop, stop
 
 
+@cached_worlds_queries
 def build_world_queries_matrix_LR():
+    tl_red, no_left_lane, left_solid_line, obs, left_lane, tl_green, follow = enumerate_worlds(2, 7).unbind(-1)
 
-    possible_worlds = list(product(range(2), repeat=7))
-    n_worlds = len(possible_worlds)
-    n_queries = 2
-    look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-
-    w_q = torch.zeros(n_worlds, n_queries)  # (100, 20)
-    for w in range(n_worlds):
-        tl_red, no_left_lane, left_solid_line, obs, left_lane, tl_green, follow = (
-            look_up[w]
-        )
-
-        if left_lane + tl_green + follow > 0:
-            if tl_green + tl_red == 2 or no_left_lane == 1:
-                pass  # invalid
-            elif tl_red + obs + left_solid_line > 0:
-                w_q[w, 0] = 1  # not move
-            else:
-                w_q[w, 1] = 1  # move forward
-        else:
-            w_q[w, 0] = 1  # not move
-    # for i in range(n_worlds):
-    #     print(look_up[i], '->',w_q[i])
+    can_move = left_lane + tl_green + follow > 0
+    invalid = (tl_green + tl_red == 2) | (no_left_lane == 1)
+    stop = tl_red + obs + left_solid_line > 0
+    w_q = one_query_matrix(torch.where(can_move & ~stop, 1, 0), 2)  # not move, move forward
+    w_q[can_move & invalid] = 0
     return w_q
 
 
+@cached_worlds_queries
 def build_world_queries_matrix_L():
+    worlds_WF = enumerate_worlds(2, 6)
+    left_lane, tl_green, follow, no_left_lane, obs, left_solid_line = worlds_WF.unbind(-1)
 
-    possible_worlds = list(product(range(2), repeat=6))
-    n_worlds = len(possible_worlds)
-    n_queries = 2
-    look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-
-    w_q = torch.zeros(n_worlds, n_queries)
-    for w in range(n_worlds):
-        left_lane, tl_green, follow, no_left_lane, obs, left_solid_line = look_up[w]
-
-        if left_lane + tl_green + follow + no_left_lane + obs + left_solid_line == 0:
-            w_q[w, 0] = 0.5
-            w_q[w, 1] = 0.5
-        elif left_lane + tl_green + follow > 0:
-            w_q[w, 1] = 1
-        else:
-            w_q[w, 0] = 1
+    w_q = one_query_matrix((left_lane + tl_green + follow > 0).long(), 2)
+    # Without any evidence, both are equally likely
+    w_q[worlds_WF.sum(-1) == 0] = 0.5
     return w_q
 
 
 # OOD knowledge (Ambulance)
+@cached_worlds_queries
 def build_world_queries_matrix_L_ambulance():
+    left_lane, tl_green, follow, no_left_lane, obs, left_solid_line = enumerate_worlds(2, 6).unbind(-1)
 
-    possible_worlds = list(product(range(2), repeat=6))
-    n_worlds = len(possible_worlds)
-    n_queries = 2
-    look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-
-    w_q = torch.zeros(n_worlds, n_queries)
-    for w in range(n_worlds):
-        left_lane, tl_green, follow, no_left_lane, obs, left_solid_line = look_up[w]
-
-        if no_left_lane + obs == 0:
-            w_q[w, 0] = 1  # not turn
-            w_q[w, 1] = 0  # turn
-        elif left_lane > 0:
-            w_q[w, 0] = 0  # not turn
-            w_q[w, 1] = 1  # turn
-        else:
-            w_q[w, 0] = 1  # not turn
-            w_q[w, 1] = 0  # turn
-    return w_q
+    turn = (no_left_lane + obs > 0) & (left_lane > 0)
+    return one_query_matrix(turn.long(), 2)  # not turn, turn
 
 
+@cached_worlds_queries
 def build_world_queries_matrix_R():
+    worlds_WF = enumerate_worlds(2, 6)
+    right_lane, tl_green, follow, no_right_lane, obs, right_solid_line = worlds_WF.unbind(-1)
 
-    possible_worlds = list(product(range(2), repeat=6))
-    n_worlds = len(possible_worlds)
-    n_queries = 2
-    look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-
-    w_q = torch.zeros(n_worlds, n_queries)
-    for w in range(n_worlds):
-        right_lane, tl_green, follow, no_right_lane, obs, right_solid_line = look_up[w]
-
-        if right_lane + tl_green + follow + no_right_lane + obs + right_solid_line == 0:
-            w_q[w, 0] = 0.5
-            w_q[w, 1] = 0.5
-        elif right_lane + tl_green + follow > 0:
-            if obs + right_solid_line + no_right_lane > 0:
-                w_q[w, 0] = 1  # not move
-            else:
-                w_q[w, 1] = 1  # move
-        else:
-            w_q[w, 0] = 1  # not move
+    move = (right_lane + tl_green + follow > 0) & (obs + right_solid_line + no_right_lane == 0)
+    w_q = one_query_matrix(move.long(), 2)  # not move, move
+    # Without any evidence, both are equally likely
+    w_q[worlds_WF.sum(-1) == 0] = 0.5
     return w_q
 
 
+@cached_worlds_queries
 def build_world_queries_matrix_R_ambulance():
+    right_lane, tl_green, follow, no_right_lane, obs, right_solid_line = enumerate_worlds(2, 6).unbind(-1)
 
-    possible_worlds = list(product(range(2), repeat=6))
-    n_worlds = len(possible_worlds)
-    n_queries = 2
-    look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-
-    w_q = torch.zeros(n_worlds, n_queries)
-    for w in range(n_worlds):
-        right_lane, tl_green, follow, no_right_lane, obs, right_solid_line = look_up[w]
-
-        if no_right_lane + obs == 0:
-            w_q[w, 0] = 1  # not turn
-            w_q[w, 1] = 0  # turn
-        elif right_lane > 0:
-            w_q[w, 0] = 0  # not turn
-            w_q[w, 1] = 1  # turn
-        else:
-            w_q[w, 0] = 1  # not turn
-            w_q[w, 1] = 0  # turn
-    return w_q
+    turn = (no_right_lane + obs > 0) & (right_lane > 0)
+    return one_query_matrix(turn.long(), 2)  # not turn, turn
 
 
 def compute_logic_forward(or_three_bits, concepts: torch.Tensor):
@@ -966,20 +790,84 @@ def compute_logic_no_left_lane(or_two_bits, pC):
     return no_left_lane
 
 
-def compute_logic_obstacle(or_four_bits, pC):
+def compute_queries(worlds_prob, w_q, n_queries=None):
+    """
+    Query probabilities P(q) = sum_w P(w) w_q[w, q] of the first n_queries queries of w_q (all if None),
+     shape (batch, n_queries). All queries are computed by a single matmul, rather than a masked sum per query.
+    """
+    return worlds_prob @ w_q[:, :n_queries].to(worlds_prob.dtype)
 
-    o_car = pC[:, 10:12].unsqueeze(2).unsqueeze(3).unsqueeze(4)  # car
-    o_person = pC[:, 12:14].unsqueeze(1).unsqueeze(3).unsqueeze(4)  # person
-    o_rider = pC[:, 14:16].unsqueeze(1).unsqueeze(2).unsqueeze(4)  # rider
-    o_other = pC[:, 16:18].unsqueeze(1).unsqueeze(2).unsqueeze(3)  # other obstacle
 
-    obs_worlds = (
-        o_car.multiply(o_person).multiply(o_rider).multiply(o_other).view(-1, 16)
-    )
+def normalize_queries(query_prob, offset=1e-5):
+    """Adds a small offset to the query probabilities and normalises them, without differentiating the normaliser"""
+    query_prob = query_prob + offset
+    with torch.no_grad():
+        Z = torch.sum(query_prob, dim=-1, keepdim=True)
+    return query_prob / Z
+
 
-    obs_active = torch.einsum("bi,ik->bk", obs_worlds, or_four_bits)
+class WorldQueryPlan:
+    """
+    Contraction plan for query probabilities of worlds made of independent concepts, for several heads at once.
+
+    Each head h has a worlds-queries matrix of shape (n_values^n_factors, Y_h), with the worlds enumerated in the order
+     of the outer product of its factors (as in problog_inference). The matrices are padded with zero columns to
+     the largest Y and stacked, so that the worlds of all heads are built with a single einsum over the factors,
+     and contracted with the matrices by a single batched matmul.
+    The world probabilities are kept, so they are shared by query probabilities and conditional entropies.
+    """
 
-    return obs_active
+    def __init__(self, w_q_list, n_values: int = 2):
+        n_worlds = w_q_list[0].shape[0]
+        self.n_factors = round(np.log(n_worlds) / np.log(n_values))
+        assert n_values**self.n_factors == n_worlds and all(w_q.shape[0] == n_worlds for w_q in w_q_list)
+        self.n_queries = [w_q.shape[1] for w_q in w_q_list]
+        max_queries = max(self.n_queries)
+        self.w_q_HWY = torch.stack(
+            [torch.nn.functional.pad(w_q.float(), (0, max_queries - w_q.shape[1])) for w_q in w_q_list]
+        )
+        # w_q log w_q, for the entropy of worlds that are only partially consistent with a query (eg. weights of 0.5)
+        self.w_q_log_HWY = torch.special.xlogy(self.w_q_HWY, self.w_q_HWY)
+        letters = "acdefghijklmnopqrstuvwxz"[: self.n_factors]
+        self.equation = ",".join(f"bh{l}" for l in letters) + "->bh" + letters
+
+    @property
+    def device(self) -> torch.device:
+        return self.w_q_HWY.device
+
+    def to(self, device) -> "WorldQueryPlan":
+        self.w_q_HWY = self.w_q_HWY.to(device)
+        self.w_q_log_HWY = self.w_q_log_HWY.to(device)
+        return self
+
+    def worlds(self, factors_BHFV: torch.Tensor) -> torch.Tensor:
+        """World probabilities (B, H, n_worlds) from the factor distributions (B, H, n_factors, n_values)"""
+        B, H = factors_BHFV.shape[:2]
+        return torch.einsum(self.equation, *factors_BHFV.unbind(2)).reshape(B, H, -1)
+
+    def query_probs(self, worlds_BHW: torch.Tensor) -> torch.Tensor:
+        """Query probabilities (B, H, max Y), padded queries have probability 0"""
+        return torch.einsum("bhw,hwy->bhy", worlds_BHW, self.w_q_HWY)
+
+    def conditional_entropy(
+        self, worlds_BHW: torch.Tensor, queries_BHY: torch.Tensor, query_BH: torch.Tensor, eps: float = 1e-8
+    ) -> torch.Tensor:
+        """
+        Entropy of the worlds of each head conditioned on its query, shape (B, H).
+        With p(w|q) = p(w) w_q[w, q] / Z_q, the sum over worlds of p(w|q) log p(w|q) splits into contractions of
+         p log p and p with the worlds-queries matrices, so it is computed for all queries without filtering worlds.
+        """
+        index = query_BH.long().unsqueeze(-1)
+        Z_BH = queries_BHY.gather(-1, index).squeeze(-1)
+        # p log p with 0 log 0 = 0. The log is taken of 1 where p = 0, so the gradient is 0 there instead of 0/0
+        positive_BHW = worlds_BHW > 0
+        log_worlds_BHW = torch.log(torch.where(positive_BHW, worlds_BHW, torch.ones_like(worlds_BHW)))
+        plogp_worlds_BHW = torch.where(positive_BHW, worlds_BHW * log_worlds_BHW, torch.zeros_like(worlds_BHW))
+        plogp_BH = torch.einsum("bhw,hwy->bhy", plogp_worlds_BHW, self.w_q_HWY)
+        plogw_q_BH = torch.einsum("bhw,hwy->bhy", worlds_BHW, self.w_q_log_HWY)
+        plogp_BH = plogp_BH.gather(-1, index).squeeze(-1) + plogw_q_BH.gather(-1, index).squeeze(-1)
+        Z_eps_BH = Z_BH + eps
+        return -(plogp_BH - Z_BH * torch.log(Z_eps_BH)) / Z_eps_BH
 
 
 def create_w_to_y():
@@ -991,71 +879,45 @@ def create_w_to_y():
 
     return four_bits_or
 
+@cached_worlds_queries
 def create_xor(sequence_len=0, n_digits=0, task="xor"):
     """Build Worlds-Queries matrix"""
     if task == "xor":
-        possible_worlds = list(product(range(n_digits), repeat=sequence_len))
-        n_worlds = len(possible_worlds)
         n_queries = 2 # false or true
-        look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-        w_q = torch.zeros(n_worlds, n_queries)  # (16, 2)
-        for w in range(n_worlds):
-            digit1, digit2, digit3, digit4 = look_up[w]
-            if (digit1 + digit2 + digit3 + digit4) % 2 == 0:
-                w_q[w, 1] = 1
+        digits_WF = enumerate_worlds(n_digits, sequence_len)
+        w_q = torch.zeros(len(digits_WF), n_queries)  # (16, 2)
+        w_q[:, 1] = (digits_WF.sum(-1) % 2 == 0).float()
         return w_q
     else:
-        NotImplementedError("Wrong choice")
+        raise NotImplementedError("Wrong choice")
 
 
+@cached_worlds_queries
 def create_mnmath_sum(sequence_len=0, n_digits=0, task="mnmath"):
     """Build Worlds-Queries matrix"""
     if task == "mnmath":
-        possible_worlds = list(product(range(n_digits), repeat=sequence_len))
-        n_worlds = len(possible_worlds)
-        n_queries = 2 # false or true
-        look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-        w_q = torch.zeros(n_worlds, n_queries)  # (16, 2)
-        for w in range(n_worlds):
-            digit1, digit2, digit3, digit4 = look_up[w]
-            if (digit1 + digit2) == (digit3 + digit4):
-                w_q[w, 1] = 1
-            else:
-                w_q[w, 0] = 1
-        return w_q
+        digit1, digit2, digit3, digit4 = enumerate_worlds(n_digits, sequence_len).unbind(-1)
+        return one_query_matrix((digit1 + digit2 == digit3 + digit4).long(), 2)  # false or true
     else:
-        NotImplementedError("Wrong choice")
+        raise NotImplementedError("Wrong choice")
 
+@cached_worlds_queries
 def create_mnmath_prod(sequence_len=0, n_digits=0, task="mnmath"):
     """Build Worlds-Queries matrix"""
     if task == "mnmath":
-        possible_worlds = list(product(range(n_digits), repeat=sequence_len))
-        n_worlds = len(possible_worlds)
-        n_queries = 2 # false or true
-        look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-        w_q = torch.zeros(n_worlds, n_queries)  # (16, 2)
-        for w in range(n_worlds):
-            digit1, digit2, digit3, digit4 = look_up[w]
-            if (digit1 * digit2) == (digit3 * digit4):
-                w_q[w, 1] = 1
-            else:
-                w_q[w, 0] = 1
-        return w_q
+        digit1, digit2, digit3, digit4 = enumerate_worlds(n_digits, sequence_len).unbind(-1)
+        return one_query_matrix((digit1 * digit2 == digit3 * digit4).long(), 2)  # false or true
     else:
-        NotImplementedError("Wrong choice")
+        raise NotImplementedError("Wrong choice")
 
+@cached_worlds_queries
 def create_mnist_and(sequence_len=0, n_digits=0, task="mnmath"):
     """Build Worlds-Queries matrix"""
     if task == "mnmath":
-        possible_worlds = list(product(range(2), repeat=2))
-        n_worlds = len(possible_worlds)
         n_queries = 2 # false or true
-        look_up = {i: c for i, c in zip(range(n_worlds), possible_worlds)}
-        w_q = torch.zeros(n_worlds, n_queries)  # (16, 2)
-        for w in range(n_worlds):
-            digit1, digit2 = look_up[w]
-            if digit1 == digit2:
-                w_q[w, 1] = 1
+        digit1, digit2 = enumerate_worlds(2, 2).unbind(-1)
+        w_q = torch.zeros(len(digit1), n_queries)  # (4, 2)
+        w_q[:, 1] = (digit1 == digit2).float()
         return w_q
     else:
-        NotImplementedError("Wrong choice")
\ No newline at end of file
+        raise NotImplementedError("Wrong choice")
\ No newline at end of file
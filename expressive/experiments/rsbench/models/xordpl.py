@@ -126,39 +126,13 @@ class XORDPL(DeepProblogModel):
         worlds_prob = probs.reshape(-1, self.n_facts ** self.n_images)
 
         # Compute query probability P(q)
-        query_prob = torch.zeros(
-            size=(len(probs), self.nr_classes), device=probs.device
-        )
-
-        for i in range(self.nr_classes):
-            query = i
-            query_prob[:, i] = self.compute_query(query, worlds_prob).view(-1)
+        query_prob = compute_queries(worlds_prob, self.xor, self.nr_classes)
 
         # add a small offset
-        query_prob += 1e-5
-        with torch.no_grad():
-            Z = torch.sum(query_prob, dim=-1, keepdim=True)
-        query_prob = query_prob / Z
+        query_prob = normalize_queries(query_prob)
 
         return query_prob, worlds_prob
 
-    def compute_query(self, query, worlds_prob):
-        """Computes query probability given the worlds probability P(w).
-
-        Args:
-            self: instance
-            query: query
-            worlds_probs: worlds probabilities
-
-        Returns:
-            query_prob: query probabilities
-        """
-        # Select the column of w_q matrix corresponding to the current query
-        w_q = self.xor[:, query]
-        # Compute query probability by summing the probability of all the worlds where the query is true
-        query_prob = torch.sum(w_q * worlds_prob, dim=1, keepdim=True)
-        return query_prob
-
     def normalize_concepts(self, z, split=4):
         """Computes the probability for each ProbLog fact given the latent vector z
 
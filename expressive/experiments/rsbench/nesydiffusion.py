@@ -1,12 +1,16 @@
 import argparse
+from functools import partial
 import os
 import time
+from typing import Tuple
 
 from expressive.args import RSBenchArguments
+from expressive.checkpoint import CheckpointManager
 from expressive.experiments.rsbench.datasets import get_dataset
 from expressive.experiments.rsbench.rsbenchmodel import create_rsbench_diffusion
 from expressive.experiments.rsbench.utils.metrics import compute_boia_stats, compute_boia_stats_nesymdm
 from expressive.methods.base_model import BaseNeSyDiffusion
+from expressive.methods.evaluation import eval_chunks
 from expressive.methods.logger import (
     PRED_TYPES_Y,
     BOIATestLog,
@@ -15,6 +19,7 @@ from expressive.methods.logger import (
     TestLogger,
     TrainLogger,
 )
+from expressive.prefetch import Prefetcher
 from expressive.util import compute_ece_sampled, get_device
 from torch.utils.data import DataLoader
 import torch
@@ -58,6 +63,11 @@ def decode_label(labels_BY, args: RSBenchArguments):
     return labels_BY.squeeze(1)
 
 
+def prepare_batch(batch, args: RSBenchArguments) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    images, labels_B, concepts_BW = batch
+    return images, recode_label(labels_B, args), concepts_BW
+
+
 def eval(
     val_loader: DataLoader,
     test_logger: TestLog,
@@ -68,13 +78,12 @@ def eval(
     print(f"----- {test_logger.prefix} -----")
     print(f"Number of {test_logger.prefix} batches:", len(val_loader))
     master_dict = None
-    for i, batch in enumerate(val_loader):
-        imgs_BCHW, labels_B, concepts_BW = batch
-        # Convert costs into label indices based on possible cost values
-        concepts_BW = concepts_BW.to(device)
-        labels_BY = recode_label(labels_B.to(device), args)
+    prefetcher = Prefetcher(val_loader, partial(prepare_batch, args=args), device, args.prefetch_lookahead)
+    for i, (imgs_BCHW, labels_BY, concepts_BW) in enumerate(
+        eval_chunks(prefetcher, args.eval_memory_budget, args.eval_chunk_size)
+    ):
         eval_dict = model.evaluate(
-            imgs_BCHW.to(device),
+            imgs_BCHW,
             labels_BY,
             concepts_BW,
             test_logger.log,
@@ -112,6 +121,7 @@ if __name__ == "__main__":
     n_images, c_split = dataset.get_split()
 
     train_loader, val_loader, test_loader = dataset.get_data_loaders()
+    train_prefetcher = Prefetcher(train_loader, partial(prepare_batch, args=args), device, args.prefetch_lookahead)
 
     log_iterations = len(train_loader) // args.log_per_epoch
     if log_iterations == 0:
@@ -128,6 +138,10 @@ if __name__ == "__main__":
         model.parameters(), lr=args.lr, betas=(0.9, 0.999), eps=1e-08, weight_decay=0.0
     )
 
+    checkpoints = None
+    if args.save_model:
+        checkpoints = CheckpointManager(f"models/{run.id}", keep_last=args.keep_checkpoints, on_saved=wandb.save)
+
     for epoch in range(0, args.epochs):
         print(f"Epoch {epoch}")
         if epoch % args.test_every_epochs == 0:
@@ -141,16 +155,8 @@ if __name__ == "__main__":
                 print(ood_stats)
         
         start_epoch_time = time.time()
-        for i, batch in enumerate(train_loader):
+        for i, (images, labels, concepts) in enumerate(train_prefetcher):
             optim.zero_grad()
-            images, labels, concepts = batch
-            labels_BY = recode_label(labels.to(device), args)
-
-            images, labels, concepts = (
-                images.to(device),
-                labels_BY,
-                concepts.to(device),
-            )
             loss = model.loss(images, labels.long(), train_logger.log, concepts)
             loss.backward()
             optim.step()
@@ -162,11 +168,10 @@ if __name__ == "__main__":
 
         args.entropy_weight += args.entropy_epoch_increase
 
-    if args.save_model:
+    if checkpoints is not None:
         print(f"Saving model to {run.id}")
-        wandb.save(f"model_{epoch}_{run.id}.pth")
-        os.makedirs(f"models/{run.id}", exist_ok=True)
-        torch.save(model.state_dict(), f"models/{run.id}/model_{epoch}.pth")
+        # Written in the background while testing
+        checkpoints.save(epoch, model, optim)
 
     test_logger = TestLogger(clazz, args, "test")
     stats = eval(test_loader, test_logger, model, device, args)
@@ -176,4 +181,7 @@ if __name__ == "__main__":
         stats = eval(ood_loader, ood_loggers[i], model, device, args)
         print(stats)
 
+    if checkpoints is not None:
+        checkpoints.close()
+
     
\ No newline at end of file
@@ -0,0 +1,30 @@
+# Packs the preprocessed BDD-OIA splits (one .pt file per sample) into contiguous arrays, read with --boia_packed.
+# Usage: python pack_boia.py [--features_dtype float16]
+from tap import Tap
+
+from datasets.boia import PACKED_DIR
+from datasets.utils.boia_creation import pack_boia_split
+
+
+class PackBOIAArguments(Tap):
+    data_dir: str = "data/bdd2048"
+    packed_dir: str = PACKED_DIR
+    # float16 halves the size of the features, float32 keeps them exact
+    features_dtype: str = "float32"
+
+
+def main():
+    args = PackBOIAArguments().parse_args()
+    for split in ["train", "val", "test"]:
+        print(f"Packing {split}")
+        pack_boia_split(
+            f"{args.data_dir}/{split}_BDD_OIA.pkl",
+            f"{args.data_dir}/{split}",
+            args.packed_dir,
+            split,
+            args.features_dtype,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+# Decodes the Kandinsky, mini Kandinsky or SDDOIA images once into memory-mapped uint8 stores with their labels and
+#  concepts, read by PackedKAND_Dataset, PackedMiniKAND_Dataset and PackedSDDOIADataset.
+# Usage: python pack_images.py --dataset sddoia --data_dir data/mini_boia_out --store_dir data/mini_boia_out/packed
+from typing import List, Literal
+
+from tap import Tap
+
+from datasets.utils.image_store import is_packed
+from datasets.utils.kand_creation import pack_kand_split, pack_minikand_split
+from datasets.utils.sddoia_creation import pack_sddoia_split, packed_sddoia_split
+
+
+class PackImagesArguments(Tap):
+    dataset: Literal["kandinsky", "minikandinsky", "sddoia"]
+    data_dir: str
+    store_dir: str
+    splits: List[str] = ["train", "val", "test"]
+    # SDDOIA: also pack the scenes of the ambulance (OOD knowledge) of these splits
+    ood_k_splits: List[str] = []
+    # Packs the splits again even if they are already packed
+    overwrite: bool = False
+
+
+def main():
+    args = PackImagesArguments().parse_args()
+    jobs = [(split, False) for split in args.splits] + [(split, True) for split in args.ood_k_splits]
+    for split, is_ood_k in jobs:
+        name = packed_sddoia_split(split, is_ood_k)
+        if is_packed(args.store_dir, name) and not args.overwrite:
+            print(f"{name} is already packed")
+            continue
+        print(f"Packing {name}")
+        if args.dataset == "kandinsky":
+            pack_kand_split(args.data_dir, args.store_dir, split)
+        elif args.dataset == "minikandinsky":
+            pack_minikand_split(args.data_dir, args.store_dir, split)
+        else:
+            pack_sddoia_split(args.data_dir, args.store_dir, split, is_ood_k)
+
+
+if __name__ == "__main__":
+    main()
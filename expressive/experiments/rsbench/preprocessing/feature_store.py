@@ -0,0 +1,109 @@
+import json
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from expressive.atomic import atomic_write
+
+MANIFEST = "manifest.json"
+
+
+def _write_json(path, data):
+    with atomic_write(path) as tmp_path, open(tmp_path, "w") as f:
+        json.dump(data, f)
+
+
+def read_manifest(directory) -> Optional[dict]:
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def is_complete(directory) -> bool:
+    manifest = read_manifest(directory)
+    return manifest is not None and all(shard["complete"] for shard in manifest["shards"])
+
+
+class ShardedFeatureWriter:
+    """
+    Streams the rows of a (num_rows, dim) feature matrix, in order, into preallocated shards of shard_size rows
+     (directory/shard_{i}.npy), instead of one file per row.
+    directory/manifest.json records the shape and dtype, and per shard its rows, the names of its rows (eg. image paths)
+     and whether it is complete. A shard is only marked complete once all its rows are written and flushed.
+    Opening a store that has the same number of rows and dtype continues after its last complete shard:
+     start is the first row that still has to be written.
+    """
+
+    def __init__(self, directory, num_rows: int, dtype: str = "float32", shard_size: int = 10000):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        manifest = read_manifest(directory)
+        if manifest is None or manifest["num_rows"] != num_rows or manifest["dtype"] != dtype:
+            bounds = list(range(0, num_rows, shard_size)) + [num_rows]
+            manifest = {
+                "num_rows": num_rows,
+                "dim": None,
+                "dtype": dtype,
+                "shards": [
+                    {"file": f"shard_{i}.npy", "start": start, "end": end, "complete": False, "names": None}
+                    for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))
+                ],
+            }
+            _write_json(os.path.join(directory, MANIFEST), manifest)
+        self.manifest = manifest
+        self.start = next((shard["start"] for shard in manifest["shards"] if not shard["complete"]), num_rows)
+        self.row = self.start
+        self.shard: Optional[np.ndarray] = None
+        self.names: List[str] = []
+
+    def _current(self) -> dict:
+        return next(shard for shard in self.manifest["shards"] if shard["start"] <= self.row < shard["end"])
+
+    def write(self, features_BD, names: Optional[List[str]] = None):
+        """Writes the next rows. features_BD is a numpy array or tensor"""
+        if isinstance(features_BD, torch.Tensor):
+            features_BD = features_BD.detach().cpu().float().numpy()
+        if self.manifest["dim"] is None:
+            self.manifest["dim"] = int(features_BD.shape[1])
+        offset = 0
+        while offset < len(features_BD):
+            shard = self._current()
+            if self.shard is None:
+                self.shard = np.lib.format.open_memmap(
+                    os.path.join(self.directory, shard["file"]),
+                    mode="w+",
+                    dtype=self.manifest["dtype"],
+                    shape=(shard["end"] - shard["start"], self.manifest["dim"]),
+                )
+                self.names = []
+            count = min(len(features_BD) - offset, shard["end"] - self.row)
+            self.shard[self.row - shard["start"] : self.row - shard["start"] + count] = features_BD[
+                offset : offset + count
+            ]
+            if names is not None:
+                self.names.extend(names[offset : offset + count])
+            self.row += count
+            offset += count
+            if self.row == shard["end"]:
+                self.shard.flush()
+                self.shard = None
+                shard["complete"] = True
+                shard["names"] = self.names if names is not None else None
+                _write_json(os.path.join(self.directory, MANIFEST), self.manifest)
+
+
+def load_features(directory) -> Tuple[torch.Tensor, Optional[List[str]]]:
+    """Returns all rows of a complete store as a float32 tensor, and the names of the rows (None if not written)"""
+    manifest = read_manifest(directory)
+    assert manifest is not None and is_complete(directory), f"{directory} is not a complete feature store"
+    features = np.concatenate(
+        [np.load(os.path.join(directory, shard["file"]), mmap_mode="r") for shard in manifest["shards"]]
+    )
+    names = None
+    if all(shard["names"] is not None for shard in manifest["shards"]):
+        names = [name for shard in manifest["shards"] for name in shard["names"]]
+    return torch.from_numpy(features).float(), names
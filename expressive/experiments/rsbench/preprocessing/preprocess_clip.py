@@ -40,6 +40,8 @@ def preprocess_w_CLIP(args):
                 device=args.device,
                 pool_mode="avg",
                 save_dir=args.activation_dir,
+                dtype=args.feature_dtype,
+                shard_size=args.shard_size,
                 stance=0,
             )
 
@@ -53,6 +55,8 @@ def preprocess_w_CLIP(args):
                 device=args.device,
                 pool_mode="avg",
                 save_dir=args.activation_dir,
+                dtype=args.feature_dtype,
+                shard_size=args.shard_size,
                 stance=1,
             )
     else:
@@ -67,6 +71,8 @@ def preprocess_w_CLIP(args):
                 device=args.device,
                 pool_mode="avg",
                 save_dir=args.activation_dir,
+                dtype=args.feature_dtype,
+                shard_size=args.shard_size,
                 stance=None,
             )
     ### END HERE PREPROCESSING
@@ -123,6 +129,18 @@ def get_args():
         default="data/saved_activations",
         help="save location for backbone and CLIP activations",
     )
+    parser.add_argument(
+        "--feature_dtype",
+        type=str,
+        default="float32",
+        help="dtype of the stored activations, float16 halves their size",
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=10000,
+        help="Rows per shard of the stored activations. Interrupted runs resume from the last complete shard",
+    )
     parser.add_argument(
         "--save_dir",
         type=str,
@@ -7,7 +7,9 @@ import preprocessing.data_utils as data_utils
 import numpy as np
 
 from tqdm import tqdm
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
+
+from preprocessing.feature_store import ShardedFeatureWriter, is_complete, load_features
 
 
 def extract_after_underscore(s):
@@ -40,6 +42,23 @@ def extract_numbers_from_path(path):
 PM_SUFFIX = {"max": "_max", "avg": ""}
 
 
+def store_dir(save_name):
+    """Directory of the sharded feature store of save_name (a .pt path)"""
+    return os.path.splitext(save_name)[0]
+
+
+def _remaining(dataset, start):
+    # The samples that still have to be encoded when resuming at row start
+    return dataset if start == 0 else Subset(dataset, range(start, len(dataset)))
+
+
+def _consolidate(save_name):
+    # Single tensor file with all features, as read by the datasets
+    if not os.path.exists(save_name):
+        features, _ = load_features(store_dir(save_name))
+        torch.save(features, save_name)
+
+
 def save_target_activations(
     target_model,
     dataset,
@@ -48,9 +67,13 @@ def save_target_activations(
     batch_size=1000,
     device="cuda",
     pool_mode="avg",
+    dtype="float32",
+    shard_size=10000,
 ):
     """
     save_name: save_file path, should include {} which will be formatted by layer names
+    Activations are streamed into a sharded store per layer (see ShardedFeatureWriter), and resumed from the last
+     complete shard, before they are saved to save_name.
     """
     _make_save_dir(save_name)
     save_names = {}
@@ -60,26 +83,35 @@ def save_target_activations(
     if _all_saved(save_names):
         return
 
-    all_features = {target_layer: [] for target_layer in target_layers}
+    writers = {
+        target_layer: ShardedFeatureWriter(store_dir(save_names[target_layer]), len(dataset), dtype, shard_size)
+        for target_layer in target_layers
+    }
+    start = min(writer.start for writer in writers.values())
+    for writer in writers.values():
+        writer.row = writer.start = start
+
+    batch_features = {target_layer: [] for target_layer in target_layers}
 
     hooks = {}
     for target_layer in target_layers:
-        command = "target_model.{}.register_forward_hook(get_activation(all_features[target_layer], pool_mode))".format(
+        command = "target_model.{}.register_forward_hook(get_activation(batch_features[target_layer], pool_mode))".format(
             target_layer
         )
         hooks[target_layer] = eval(command)
 
     with torch.no_grad():
         for images, labels in tqdm(
-            DataLoader(dataset, batch_size, num_workers=8, pin_memory=True)
+            DataLoader(_remaining(dataset, start), batch_size, num_workers=8, pin_memory=True)
         ):
-            features = target_model(images.to(device))
+            target_model(images.to(device))
+            for target_layer in target_layers:
+                writers[target_layer].write(torch.cat(batch_features[target_layer]))
+                batch_features[target_layer].clear()
 
     for target_layer in target_layers:
-        torch.save(torch.cat(all_features[target_layer]), save_names[target_layer])
+        _consolidate(save_names[target_layer])
         hooks[target_layer].remove()
-    # free memory
-    del all_features
     torch.cuda.empty_cache()
     return
 
@@ -93,64 +125,34 @@ def save_clip_image_features(
     mnist=True,
     n_images=1,
     d_probe="dataset_train",
+    dtype="float32",
+    shard_size=10000,
 ):
+    """
+    Encodes the images of dataset once, and streams the features into a sharded store next to save_name
+     (see ShardedFeatureWriter), with the image paths as names. Resumes from the last complete shard.
+    Once complete, the features are also saved to save_name.
+    """
     _make_save_dir(save_name)
-    all_features = []
-    # if os.path.exists(save_name):
-    #     return
-    save_dir = save_name[: save_name.rfind("/")]
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
-
-    split = extract_after_underscore(d_probe)
+    if os.path.exists(save_name) and is_complete(store_dir(save_name)):
+        return
 
-    os.makedirs(
-        os.path.join(save_name[: save_name.rfind("/")], "SDDOIA-preprocessed", split),
-        exist_ok=True,
-    )
+    writer = ShardedFeatureWriter(store_dir(save_name), len(dataset), dtype, shard_size)
+    if writer.start > 0:
+        print(f"Resuming {save_name} from row {writer.start}")
     with torch.no_grad():
-        save_paths = []
-
         for images, labels in tqdm(
             DataLoader(
-                dataset, batch_size, num_workers=8, pin_memory=True, shuffle=False
+                _remaining(dataset, writer.start), batch_size, num_workers=8, pin_memory=True, shuffle=False
             )
         ):
             features = model.encode_image(images.to(device))
+            names = None
+            if isinstance(labels, (list, tuple)) and len(labels) and isinstance(labels[0], str):
+                names = list(labels)
+            writer.write(features, names)
 
-            features = model.encode_image(images.to(device))
-
-            for i, label in enumerate(labels):
-
-                # print(extract_numbers_from_path(label))
-                # print(label)
-
-                save_path = os.path.join(
-                    save_name[: save_name.rfind("/")],
-                    "SDDOIA-preprocessed",
-                    split,
-                    extract_numbers_from_path(label) + ".pt",
-                )
-
-                save_paths.append(save_path)
-
-                if list(features[i, :].shape) != [512]:
-                    print(features[i].shape)
-
-                torch.save(features[i].detach().cpu().to(torch.float32), save_path)
-            all_features.append(features.cpu())
-
-        print(
-            "Len comparison",
-            len(np.unique(np.array(save_paths))),
-            len(torch.cat(all_features)),
-        )
-
-        # all_features.append(features.cpu())
-
-    # torch.save(torch.cat(all_features), save_name)
-    # free memory
-    del all_features
+    _consolidate(save_name)
     torch.cuda.empty_cache()
     return
 
@@ -184,6 +186,8 @@ def save_activations(
     pool_mode,
     save_dir,
     stance=0,
+    dtype="float32",
+    shard_size=10000,
 ):
 
     target_save_name, clip_save_name, text_save_name = get_save_names(
@@ -193,8 +197,8 @@ def save_activations(
     for target_layer in target_layers:
         save_names[target_layer] = target_save_name.format(target_layer)
 
-    # if _all_saved(save_names):
-    #     return
+    if os.path.exists(text_save_name) and os.path.exists(clip_save_name) and is_complete(store_dir(clip_save_name)):
+        return
 
     clip_model, clip_preprocess = clip.load(clip_name, device=device)
 
@@ -221,7 +225,7 @@ def save_activations(
 
     save_clip_text_features(clip_model, text, text_save_name, batch_size)
     save_clip_image_features(
-        clip_model, data_c, clip_save_name, batch_size, device, d_probe=d_probe
+        clip_model, data_c, clip_save_name, batch_size, device, d_probe=d_probe, dtype=dtype, shard_size=shard_size
     )
 
     # if target_name.startswith("clip_"):
@@ -230,7 +234,7 @@ def save_activations(
     # else:
     #     print('Passed through the others')
     #     save_target_activations(target_model, data_t, target_save_name, target_layers,
-    #                             batch_size, device, pool_mode)
+    #                             batch_size, device, pool_mode, dtype, shard_size)
 
     return
 
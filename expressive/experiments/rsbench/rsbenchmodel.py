@@ -8,9 +8,9 @@ from expressive.experiments.rsbench.datasets.utils.base_dataset import BaseDatas
 from expressive.methods.base_model import BaseNeSyDiffusion, Problem
 from expressive.methods.cond_model import CondNeSyDiffusion
 from expressive.methods.simple_nesy_diff import SimpleNeSyDiffusion
+from expressive.methods.tabulated import TabulatedProblem
 from expressive.models.diffusion_model import WY_DATA, UnmaskingModel
 import torch.nn as nn
-from torch.nn.functional import one_hot
 
 class RSBenchModel(UnmaskingModel):
     def __init__(self, args: RSBenchArguments, dataset: BaseDataset) -> None:
@@ -32,22 +32,30 @@ class RSBenchModel(UnmaskingModel):
         w_SBW = wy_t
         if not isinstance(wy_t, Tensor):
             w_SBW = wy_t[0]
-        one_hot_w = one_hot(w_SBW, self.vocab_dim + 1)
+        # The classifiers take w as integers, and use its one-hot encoding (with the mask value) without building it
         if self.args.backbone in ["partialentangled", "fullentangled"]:
-            return self.classifier(x_encodings, one_hot_w)
+            return self.classifier(x_encodings, w_SBW)
         if self.args.backbone == "disentangled":
+            if hasattr(self.classifier, "forward_grouped"):
+                # All concepts in one call of the classifier
+                concept_preds = self.classifier.forward_grouped(x_encodings, w_SBW)
+                if len(w_SBW.shape) == 4:
+                    concept_preds = concept_preds.reshape(
+                        w_SBW.shape[0], w_SBW.shape[1], self.w_dims, concept_preds.shape[-1]
+                    )
+                return concept_preds
             concept_preds = []
             for i in range(self.w_dims):
                 encoding_split = torch.split(x_encodings, x_encodings.size(-1) // self.w_dims, dim=-1)
-                enc_flat = self.classifier(encoding_split[i], one_hot_w, i)
-                if len(one_hot_w.shape) == 5:
-                    enc_flat = enc_flat.reshape(one_hot_w.shape[0], one_hot_w.shape[1], enc_flat.shape[-1])
+                enc_flat = self.classifier(encoding_split[i], w_SBW, i)
+                if len(w_SBW.shape) == 4:
+                    enc_flat = enc_flat.reshape(w_SBW.shape[0], w_SBW.shape[1], enc_flat.shape[-1])
                 concept_preds.append(enc_flat)
             return torch.stack(concept_preds, dim=-2)
         raise NotImplementedError(f"Backbone {self.args.backbone} not implemented")
 
 
-class RSBenchAdapter(Problem, nn.Module):
+class RSBenchAdapter(TabulatedProblem, nn.Module):
     def __init__(self, args: RSBenchArguments, dataset: BaseDataset):
         super().__init__()
         self.debug = args.DEBUG
@@ -61,9 +69,13 @@ class RSBenchAdapter(Problem, nn.Module):
         return self.dataset.get_y_dim()
 
     @override
-    def y_from_w(self, w_SBW: torch.Tensor) -> torch.Tensor:
+    def symbolic_y_from_w(self, w_SBW: torch.Tensor) -> torch.Tensor:
         return self.dataset.y_from_w(w_SBW)
 
+    @override
+    def y_factorisation(self):
+        return self.dataset.y_factorisation()
+
 
 def create_rsbench_diffusion(args: RSBenchArguments, dataset: BaseDataset) -> BaseNeSyDiffusion:
     model = RSBenchModel(args, dataset)
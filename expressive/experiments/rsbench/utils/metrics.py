@@ -10,6 +10,7 @@ import torch
 import torch.nn.functional as F
 from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
 from scipy.special import softmax
+from scipy.sparse import csr_matrix
 
 from expressive.methods.logger import PRED_TYPES_W, PRED_TYPES_Y
 
@@ -877,6 +878,59 @@ def get_world_probabilities_matrix(
     return decomposed_world_prob, worlds_prob
 
 
+def world_means(values: ndarray, c_true: ndarray) -> Tuple[ndarray, ndarray]:
+    """Get the mean of values over the samples of each groundtruth world
+
+    Args:
+        values (ndarray): values of each sample, shape (N, ...)
+        c_true (ndarray): groundtruth concepts, shape (N,) or (N, K)
+
+    Returns:
+        mean (ndarray): mean of the values of each world, shape (R,) * K + values.shape[1:]
+            with R the largest concept + 1, worlds without samples have mean 0
+        counts (ndarray): number of samples of each world, shape (R,) * K
+    """
+    values = np.asarray(values)
+    c_true = np.asarray(c_true).astype(np.int64)
+    if c_true.ndim == 1:
+        c_true = c_true[:, None]
+    n_values = int(c_true.max()) + 1 if len(c_true) > 0 else 1
+    grid = (n_values,) * c_true.shape[1]
+    # Integer id of the world of each sample, the concepts in mixed radix
+    ids = np.ravel_multi_index(tuple(c_true.T), grid)
+    counts = np.bincount(ids, minlength=n_values ** c_true.shape[1])
+    # Sum the samples of each world with a sparse (worlds x samples) indicator matrix, in one pass over values
+    indicator = csr_matrix((np.ones(len(ids)), (ids, np.arange(len(ids)))), shape=(len(counts), len(ids)))
+    sums = np.asarray(indicator @ values.reshape(len(values), int(np.prod(values.shape[1:]))))
+    sums = sums.reshape((len(counts),) + values.shape[1:])
+    mean = sums / np.maximum(counts, 1).reshape((-1,) + (1,) * (values.ndim - 1))
+    return mean.reshape(grid + values.shape[1:]), counts.reshape(grid)
+
+
+def _world_dicts(
+    mean: ndarray, counts: ndarray, c_true: ndarray
+) -> Tuple[Dict[str, ndarray], Dict[str, int]]:
+    """Dictionaries of world_means with the worlds as keys (the concepts as concatenated strings),
+    in order of first appearance in c_true"""
+    c_true = np.asarray(c_true).astype(np.int64)
+    if c_true.ndim == 1:
+        c_true = c_true[:, None]
+    ids, first = np.unique(np.ravel_multi_index(tuple(c_true.T), counts.shape), return_index=True)
+    mean_world_prob = dict()
+    world_counter = dict()
+    for world in np.stack(np.unravel_index(ids[np.argsort(first)], counts.shape), axis=-1):
+        world_label = "".join(str(c) for c in world)
+        world_mean, world_count = mean[tuple(world)], int(counts[tuple(world)])
+        # Different worlds can have the same key when concepts have several digits, they are merged
+        if world_label in world_counter:
+            total = world_counter[world_label] + world_count
+            world_mean = (mean_world_prob[world_label] * world_counter[world_label] + world_mean * world_count) / total
+            world_count = total
+        mean_world_prob[world_label] = world_mean
+        world_counter[world_label] = world_count
+    return mean_world_prob, world_counter
+
+
 def get_mean_world_probability(
     decomposed_world_prob: ndarray, c_true_cc: ndarray
 ) -> Tuple[Dict[str, float], Dict[str, int]]:
@@ -890,32 +944,20 @@ def get_mean_world_probability(
         mean_world_prob (ndarray): mean world probability
         world_counter (ndarray): world counter
     """
-    mean_world_prob = dict()
-    world_counter = dict()
-
-    # loop over the grountruth concept of each sample (concept1, concept2)
-    for i, (c_1, c_2) in enumerate(c_true_cc):
-        world_label = str(c_1) + str(
-            c_2
-        )  # get the world as a string for the key of the dictionary
+    c_true_cc = np.asarray(c_true_cc).astype(np.int64)
+    # probability of the groundtruth world of each sample
+    true_world_prob = decomposed_world_prob[
+        np.arange(len(c_true_cc)), c_true_cc[:, 0], c_true_cc[:, 1]
+    ]
+    mean, counts = world_means(true_world_prob, c_true_cc)
+    return _world_dicts(mean, counts, c_true_cc)
 
-        # fill if it is zero
-        if world_label not in world_counter:
-            mean_world_prob[world_label] = 0
-            world_counter[world_label] = 0
 
-        # get that world concept probability
-        mean_world_prob[world_label] += decomposed_world_prob[i, c_1, c_2]
-        # count that world
-        world_counter[world_label] += 1
-
-    # Normalize
+def _check_alpha(mean_world_prob: Dict[str, ndarray]):
     for el in mean_world_prob:
-        mean_world_prob[el] = (
-            0 if world_counter[el] == 0 else mean_world_prob[el] / world_counter[el]
-        )
-
-    return mean_world_prob, world_counter
+        assert (
+            np.sum(mean_world_prob[el]) > 0.99 and np.sum(mean_world_prob[el]) < 1.01
+        ), mean_world_prob[el]
 
 
 def get_alpha(
@@ -932,40 +974,9 @@ def get_alpha(
         mean_world_prob (ndarray): mean world probability
         world_counter (ndarray): world counter
     """
-
-    mean_world_prob = dict()
-    world_counter = dict()
-
-    # loop over the grountruth concept of each sample (concept1, concept2)
-    for i, (c_1, c_2) in enumerate(c_true_cc):
-        world_label = str(c_1) + str(
-            c_2
-        )  # get the world as a string for the key of the dictionary
-
-        # fill if it is zero
-        if world_label not in world_counter:
-            mean_world_prob[world_label] = np.zeros(n_facts**2)
-            world_counter[world_label] = 0
-
-        # get that world concept probability
-        mean_world_prob[world_label] += e_world_counter[i]
-        # count that world
-        world_counter[world_label] += 1
-
-    # Normalize
-    for el in mean_world_prob:
-        mean_world_prob[el] = (
-            np.zeros(n_facts**2)
-            if world_counter[el] == 0
-            else mean_world_prob[el] / world_counter[el]
-        )
-
-        if world_counter[el] != 0:
-            assert (
-                np.sum(mean_world_prob[el]) > 0.99
-                and np.sum(mean_world_prob[el]) < 1.01
-            ), mean_world_prob[el]
-
+    mean, counts = world_means(np.asarray(e_world_counter).reshape(-1, n_facts**2), c_true_cc)
+    mean_world_prob, world_counter = _world_dicts(mean, counts, c_true_cc)
+    _check_alpha(mean_world_prob)
     return mean_world_prob, world_counter
 
 
@@ -983,38 +994,9 @@ def get_alpha_single(
         mean_world_prob (ndarray): mean world probability
         world_counter (ndarray): world counter
     """
-
-    mean_world_prob = dict()
-    world_counter = dict()
-
-    # loop over the grountruth concept of each sample (concept)
-    for i, c in enumerate(c_true):
-        world_label = str(c)  # get the world as a string for the key of the dictionary
-
-        # fill if it is zero
-        if world_label not in world_counter:
-            mean_world_prob[world_label] = np.zeros(n_facts)
-            world_counter[world_label] = 0
-
-        # get that world concept probability
-        mean_world_prob[world_label] += e_world_counter[i]
-        # count that world
-        world_counter[world_label] += 1
-
-    # Normalize
-    for el in mean_world_prob:
-        mean_world_prob[el] = (
-            np.zeros(n_facts)
-            if world_counter[el] == 0
-            else mean_world_prob[el] / world_counter[el]
-        )
-
-        if world_counter[el] != 0:
-            assert (
-                np.sum(mean_world_prob[el]) > 0.99
-                and np.sum(mean_world_prob[el]) < 1.01
-            ), mean_world_prob[el]
-
+    mean, counts = world_means(np.asarray(e_world_counter).reshape(-1, n_facts), c_true)
+    mean_world_prob, world_counter = _world_dicts(mean, counts, c_true)
+    _check_alpha(mean_world_prob)
     return mean_world_prob, world_counter
 
 
@@ -1031,24 +1013,19 @@ def get_concept_probability(model, loader):
         c_prb_2 (ndarray): probabilities of concept 2
         gs (ndarray): groundtruth concepts
     """
-    for i, data in enumerate(loader):
+    c_prbs, c_trues = [], []
+    for data in loader:
         images, labels, concepts = data
-        images, labels, concepts = (
-            images.to(model.device),
-            labels.to(model.device),
-            concepts.to(model.device),
-        )
+        images = images.to(model.device)
 
         out_dict = model(images)
 
-        if i == 0:
-            c_prb = out_dict["pCS"].detach().cpu().numpy()
-            c_true = concepts.detach().cpu().numpy()
-        else:
-            c_prb = np.concatenate(
-                [c_prb, out_dict["pCS"].detach().cpu().numpy()], axis=0
-            )
-            c_true = np.concatenate([c_true, concepts.detach().cpu().numpy()], axis=0)
+        c_prbs.append(out_dict["pCS"].detach().cpu().numpy())
+        c_trues.append(concepts.detach().cpu().numpy())
+
+    # concatenate once, rather than after every batch
+    c_prb = np.concatenate(c_prbs, axis=0)
+    c_true = np.concatenate(c_trues, axis=0)
 
     c_prb_1 = c_prb[:, 0, :]  # [#dati, #facts]
     c_prb_2 = c_prb[:, 1, :]  # [#dati, #facts]
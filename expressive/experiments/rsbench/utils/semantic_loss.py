@@ -2,6 +2,7 @@
 import torch
 import torch.nn.functional as F
 from utils.normal_kl_divergence import kl_divergence
+from models.utils.utils_problog import compute_queries, normalize_queries
 
 
 class ADDMNIST_SL(torch.nn.Module):
@@ -26,23 +27,6 @@ class ADDMNIST_SL(torch.nn.Module):
             self.n_facts = 5
             self.nr_classes = 3
 
-    def compute_query(self, query, worlds_prob):
-        """Computes query probability given the worlds probability P(w).
-
-        Args:
-            self: instance
-            query: query
-            worlds_prob: worlds probability
-
-        Returns:
-            query prob: query probability
-        """
-        # Select the column of w_q matrix corresponding to the current query
-        w_q = self.logic[:, query]
-        # Compute query probability by summing the probability of all the worlds where the query is true
-        query_prob = torch.sum(w_q * worlds_prob, dim=1, keepdim=True)
-        return query_prob
-
     def forward(self, out_dict, args):
         """Forward step of the loss function
 
@@ -72,19 +56,10 @@ class ADDMNIST_SL(torch.nn.Module):
         worlds_prob = probs.reshape(-1, self.n_facts * self.n_facts)
 
         # Compute query probability P(q)
-        query_prob = torch.zeros(
-            size=(len(probs), self.nr_classes), device=probs.device
-        )
-
-        for i in range(self.nr_classes):
-            query = i
-            query_prob[:, i] = self.compute_query(query, worlds_prob).view(-1)
+        query_prob = compute_queries(worlds_prob, self.logic, self.nr_classes)
 
         # add a small offset
-        query_prob += 1e-5
-        with torch.no_grad():
-            Z = torch.sum(query_prob, dim=-1, keepdim=True)
-        query_prob = query_prob / Z
+        query_prob = normalize_queries(query_prob)
 
         sl = F.nll_loss(query_prob.log(), Y.to(torch.long), reduction="mean")
 
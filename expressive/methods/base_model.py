@@ -400,6 +400,9 @@ class BaseNeSyDiffusion(nn.Module, ABC):
     ) -> torch.Tensor:
         # Returns all predictions of w
         self.eval()
+        # Metrics are summed over examples (instead of averaged over the batch),
+        #  so that they do not depend on how the evaluation data is batched
+        B = x_BX.shape[0]
         # Initialize w and y with mask vectors
         w_t_BW = torch.full(
             (x_BX.shape[0],) + self.problem.shape_w()[:-1],
@@ -429,13 +432,13 @@ class BaseNeSyDiffusion(nn.Module, ABC):
             hat_w_0_SBW, hat_y_0_SBY = res
             # Compare sampled y prediction to gt
             log.y_acc_avg += (
-                self.problem.eval_y(hat_y_0_SBY, y_0_BY, w_0_BW).float().mean().item()
+                self.problem.eval_y(hat_y_0_SBY, y_0_BY, w_0_BW).float().mean().item() * B
             )
             # Compute majority voting on y (this has to take all dimensions of y into account)
             # TODO: Note that this uses the marginal mode to be backwards compatible. Probably incorrect. 
             hat_y_0_BY = marginal_mode(hat_y_0_SBY, dim=0)
             log.y_acc_top += (
-                self.problem.eval_y(hat_y_0_BY, y_0_BY, w_0_BW).float().mean().item()
+                self.problem.eval_y(hat_y_0_BY, y_0_BY, w_0_BW).float().mean().item() * B
             )
 
         result_dict = {}
@@ -444,25 +447,26 @@ class BaseNeSyDiffusion(nn.Module, ABC):
 
         # Compare sampled w to ground truth
         w_accuracy_SBW = (hat_w_0_SBW == w_0_BW).float()
-        log.w_acc_avg += w_accuracy_SBW.mean().item()
+        log.w_acc_avg += w_accuracy_SBW.mean().item() * B
 
         pred_options_w, pred_options_y, hat_y_0_SBY = self.all_pred_options(hat_w_0_SBW)
 
         for pred_type in PRED_TYPES_W:
             w_BW = pred_options_w[pred_type]
-            log.pred_types[pred_type] += (w_BW == w_0_BW).float().mean().item()
+            log.pred_types[pred_type] += (w_BW == w_0_BW).float().mean().item() * B
             result_dict[f"{pred_type}"] = w_BW
 
         # Evaluate accuracy on y for different prediction options
         for pred_type in PRED_TYPES_Y:
             y_BY = pred_options_y[pred_type]
             log.pred_types[pred_type] += (
-                self.problem.eval_y(y_BY, y_0_BY, w_0_BW).float().mean().item()
+                self.problem.eval_y(y_BY, y_0_BY, w_0_BW).float().mean().item() * B
             )
             result_dict[f"{pred_type}"] = y_BY
 
         result_dict["W_SAMPLES"] = hat_w_0_SBW
         result_dict["Y_SAMPLES"] = hat_y_0_SBY
+        log.num_examples += B
 
         if isinstance(log, BOIATestLog):
             for pred_type in PRED_TYPES_W:
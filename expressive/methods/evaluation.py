@@ -0,0 +1,75 @@
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import torch
+from torch import Tensor
+
+BATCH = Tuple[Tensor, ...]
+
+
+def rebatch(batches: Iterable[BATCH], chunk_size: int) -> Iterator[BATCH]:
+    """
+    Merges and splits batches (tuples of tensors with the batch in the first dimension) into chunks of chunk_size.
+    Only the last chunk can be smaller. The order of the examples is kept.
+    """
+    buffer: List[BATCH] = []
+    buffered = 0
+    for batch in batches:
+        buffer.append(batch)
+        buffered += batch[0].shape[0]
+        while buffered >= chunk_size:
+            merged = _concat(buffer)
+            yield tuple(tensor[:chunk_size] for tensor in merged)
+            rest = tuple(tensor[chunk_size:] for tensor in merged)
+            buffered -= chunk_size
+            buffer = [rest] if buffered > 0 else []
+    if buffered > 0:
+        yield _concat(buffer)
+
+
+def _concat(buffer: List[BATCH]) -> BATCH:
+    if len(buffer) == 1:
+        return buffer[0]
+    return tuple(torch.cat(tensors, dim=0) for tensors in zip(*buffer))
+
+
+def eval_chunks(
+    batches: Iterable[BATCH],
+    memory_budget_gb: Optional[float] = None,
+    chunk_size: Optional[int] = None,
+) -> Iterator[BATCH]:
+    """
+    Re-batches evaluation data into the largest chunks that fit in the memory budget.
+    Evaluation runs without gradients, so its memory is dominated by the samples of the sampler,
+     which scale linearly with the number of examples in a chunk.
+
+    The first batch is yielded as-is. On CUDA, the peak memory used while the caller evaluates it
+     (sample + all_pred_options in BaseNeSyDiffusion.evaluate) is measured, and the remaining data
+     is re-batched into chunks of budget / (peak memory per example).
+    If chunk_size is given, it is used directly instead of probing.
+    Without a chunk size or a budget, or on other devices, the batches are yielded unchanged.
+
+    Metrics are identical to per-batch evaluation as TestLog weights them by number of examples.
+    """
+    iterator = iter(batches)
+    first = next(iterator, None)
+    if first is None:
+        return
+    device = first[0].device
+
+    if chunk_size is None and memory_budget_gb is not None and device.type == "cuda":
+        torch.cuda.synchronize(device)
+        base_memory = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        yield first
+        torch.cuda.synchronize(device)
+        used_memory = torch.cuda.max_memory_allocated(device) - base_memory
+        memory_per_example = max(used_memory, 1) / first[0].shape[0]
+        chunk_size = max(int(memory_budget_gb * 1024**3 / memory_per_example), 1)
+        print(f"Evaluating in chunks of {chunk_size} ({memory_per_example / 1024**2:.2f} MB per example)")
+    else:
+        yield first
+
+    if chunk_size is None:
+        yield from iterator
+    else:
+        yield from rebatch(iterator, chunk_size)
@@ -87,7 +87,9 @@ class TrainingLog(Log):
 
 
 class TestLog(Log):
+    # Metrics are summed over examples, and normalised by the number of evaluated examples
     def __init__(self, args: Arguments, prefix: str):
+        self.num_examples = 0
         self.y_acc_avg = 0.0
         self.w_acc_avg = 0.0
         self.w_acc_top = 0.0
@@ -102,8 +104,9 @@ class TestLog(Log):
         self.prefix = prefix
 
     def create_dict(self, iterations: int) -> dict:
+        # Normalise per example rather than per batch (iterations), so that the batch size does not matter
         def norm(x):
-            return x / iterations
+            return x / max(self.num_examples, 1)
 
         base_dict = {
             "w_acc_avg": norm(self.w_acc_avg),
@@ -0,0 +1,108 @@
+from abc import abstractmethod
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+from torch import Tensor
+
+from expressive.methods.base_model import Problem
+
+# A group of w positions, and the y positions that only depend on them
+FACTOR = Tuple[Sequence[int], Sequence[int]]
+
+
+class TabulatedProblem(Problem):
+    """
+    Problem that answers y_from_w with lookup tables instead of running the symbolic program.
+
+    The symbolic program is given by symbolic_y_from_w, and its factorisation by y_factorisation:
+     groups of w positions, each with the y positions that only depend on that group.
+    The first time y_from_w is called on a device, symbolic_y_from_w is run once on all assignments of each group
+     to build a dense table, which is checked against symbolic_y_from_w on random inputs.
+     Afterwards, y_from_w is a single gather, indexed by the assignment of each group in mixed radix.
+    """
+
+    # Largest number of assignments of a group that is tabulated
+    max_table_size: int = 2**16
+    # Number of random assignments the tables are checked on
+    num_verify: int = 1024
+
+    @abstractmethod
+    def symbolic_y_from_w(self, w_SBW: Tensor) -> Tensor:
+        pass
+
+    def y_factorisation(self) -> Optional[List[FACTOR]]:
+        """
+        Groups of w positions and the y positions computed from them.
+        None uses a single group with all positions, so it is only tabulated if the whole world space is small.
+        """
+        return None
+
+    def _factors(self) -> List[FACTOR]:
+        factors = self.y_factorisation()
+        if factors is None:
+            factors = [(range(self.shape_w()[0]), range(self.shape_y()[0]))]
+        return [(list(w_pos), list(y_pos)) for w_pos, y_pos in factors]
+
+    def _build_tables(self, device: torch.device) -> Optional[Tuple[Tensor, Tensor, Tensor]]:
+        """
+        Tabulates symbolic_y_from_w, returning:
+        - radix_WY: weight of each w position in the index of the table entry of each y position
+        - offset_Y: start of the table of each y position in table_M
+        - table_M: the tables of all y positions, flattened and concatenated
+        Returns None if a group is too large to tabulate.
+        """
+        W, D = self.shape_w()[0], self.shape_w()[-1]
+        Y = self.shape_y()[0]
+        factors = self._factors()
+        if any(D ** len(w_pos) > self.max_table_size for w_pos, _ in factors):
+            return None
+        radix_WY = torch.zeros((W, Y), device=device)
+        offset_Y = torch.zeros((Y,), device=device)
+        tables, offset = [], 0
+        covered = set()
+        for w_pos, y_pos in factors:
+            k = len(w_pos)
+            radix_K = torch.tensor([D ** (k - 1 - j) for j in range(k)], device=device)
+            # All assignments of the group, other positions set to 0
+            assignments_MK = torch.arange(D**k, device=device)[:, None] // radix_K % D
+            w_MW = torch.zeros((D**k, W), dtype=torch.long, device=device)
+            w_MW[:, w_pos] = assignments_MK
+            table_MY = self.symbolic_y_from_w(w_MW[None])[0]
+            for i in y_pos:
+                if i in covered:
+                    continue
+                covered.add(i)
+                radix_WY[w_pos, i] = radix_K.float()
+                offset_Y[i] = offset
+                tables.append(table_MY[:, i])
+                offset += D**k
+        if offset > 2**24:
+            return None
+        if len(covered) != Y:
+            raise ValueError(f"y_factorisation does not cover all {Y} y positions")
+        result = (radix_WY, offset_Y, torch.cat(tables))
+        self._verify(result, device)
+        return result
+
+    @staticmethod
+    def _lookup(tables: Tuple[Tensor, Tensor, Tensor], w_SBW: Tensor) -> Tensor:
+        radix_WY, offset_Y, table_M = tables
+        # Float matmul, which is exact for indices below 2^24 and much faster than an integer one
+        return table_M[(w_SBW.float() @ radix_WY + offset_Y).long()]
+
+    def _verify(self, tables: Tuple[Tensor, Tensor, Tensor], device: torch.device):
+        W, D = self.shape_w()[0], self.shape_w()[-1]
+        w_1BW = torch.randint(0, D, (1, self.num_verify, W), device=device)
+        if not torch.equal(self._lookup(tables, w_1BW), self.symbolic_y_from_w(w_1BW)):
+            raise ValueError("Tabulated y_from_w differs from symbolic_y_from_w, is y_factorisation correct?")
+
+    def y_from_w(self, w_SBW: Tensor) -> Tensor:
+        tables_by_device: Dict[torch.device, Optional[Tuple[Tensor, Tensor, Tensor]]] = getattr(self, "_y_tables", None)
+        if tables_by_device is None:
+            tables_by_device = self._y_tables = {}
+        if w_SBW.device not in tables_by_device:
+            tables_by_device[w_SBW.device] = self._build_tables(w_SBW.device)
+        tables = tables_by_device[w_SBW.device]
+        if tables is None:
+            return self.symbolic_y_from_w(w_SBW)
+        return self._lookup(tables, w_SBW)
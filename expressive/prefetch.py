@@ -0,0 +1,127 @@
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+
+import torch
+from torch import Tensor
+
+BATCH = Tuple[Tensor, ...]
+
+
+class _End:
+    pass
+
+
+class _Error:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+class Prefetcher:
+    """
+    Wraps a DataLoader to prepare batches in a background thread while the model computes on the previous ones.
+
+    For every batch of the loader, the background thread:
+    1. Applies transform (eg. computing the labels used by the experiment), on CPU
+    2. Pins the resulting tensors and copies them to the device on a separate CUDA stream
+    Up to lookahead prepared batches are kept in a queue. With lookahead=0, batches are prepared synchronously.
+    On devices other than CUDA, the transfer is done on the main thread.
+    """
+
+    def __init__(
+        self,
+        loader: Iterable,
+        transform: Callable[[Any], BATCH],
+        device: torch.device,
+        lookahead: int = 2,
+    ):
+        self.loader = loader
+        self.transform = transform
+        self.device = torch.device(device)
+        self.lookahead = lookahead
+        self.use_cuda = self.device.type == "cuda"
+
+    def __len__(self) -> int:
+        return len(self.loader)
+
+    def __iter__(self) -> Iterator[BATCH]:
+        if self.lookahead <= 0:
+            for batch in self.loader:
+                yield self._to_device(self.transform(batch))
+            return
+
+        queue = Queue(maxsize=self.lookahead)
+        stop = Event()
+        thread = Thread(target=self._worker, args=(queue, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = queue.get()
+                if isinstance(item, _End):
+                    break
+                if isinstance(item, _Error):
+                    raise item.exception
+                batch, copied = item
+                if copied is None:
+                    yield self._to_device(batch)
+                    continue
+                # Wait for the copy to finish, and make sure the memory is not reused while in use on this stream
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_event(copied)
+                for tensor in batch:
+                    tensor.record_stream(current_stream)
+                yield batch
+        finally:
+            stop.set()
+            # Unblock the worker if it is waiting for space in the queue
+            while thread.is_alive():
+                try:
+                    queue.get_nowait()
+                except Empty:
+                    thread.join(timeout=0.01)
+
+    def _worker(self, queue: Queue, stop: Event):
+        stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+        try:
+            for batch in self.loader:
+                if stop.is_set():
+                    return
+                batch = self.transform(batch)
+                copied = None
+                if self.use_cuda:
+                    with torch.cuda.stream(stream):
+                        batch = tuple(
+                            tensor.pin_memory().to(self.device, non_blocking=True) for tensor in batch
+                        )
+                    copied = torch.cuda.Event()
+                    copied.record(stream)
+                if not self._put(queue, stop, (batch, copied)):
+                    return
+            self._put(queue, stop, _End())
+        except BaseException as e:
+            self._put(queue, stop, _Error(e))
+
+    def _put(self, queue: Queue, stop: Event, item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _to_device(self, batch: BATCH) -> BATCH:
+        return tuple(tensor.to(self.device) for tensor in batch)
+
+
+def loader_worker_kwargs(num_workers: Optional[int], persistent_workers: bool, default_workers: int = 0) -> dict:
+    """
+    DataLoader keyword arguments for the worker settings.
+    If num_workers is None, uses default_workers. Persistent workers are only possible with at least one worker.
+    """
+    if num_workers is None:
+        num_workers = default_workers
+    return {
+        "num_workers": num_workers,
+        "persistent_workers": persistent_workers and num_workers > 0,
+    }